@@ -0,0 +1,76 @@
+"""
+Report for every AES backend that is installed how long it takes to load and
+decrypt the first password, then the decrypt throughput for password sized
+data and for larger blocks. Each backend is timed in a new interpreter so
+the first use includes its imports.
+
+    python -m benchmarks.aes
+"""
+from __future__ import print_function
+
+
+from novaagent.common import aes
+
+
+import subprocess
+import timeit
+import sys
+import os
+
+
+ITERATIONS = 20000
+
+
+# A password as sent by the host and a larger block
+SIZES = (32, 4096)
+
+
+def measure(name):
+    key = os.urandom(16)
+    iv = os.urandom(16)
+    data = os.urandom(SIZES[0])
+    start = timeit.default_timer()
+    try:
+        backend = aes.load_backend(name)
+    except ImportError as e:
+        print('{0:<14} not available: {1}'.format(name, str(e)))
+        return
+
+    backend.decrypt(key, iv, data)
+    first_use = timeit.default_timer() - start
+    results = []
+    for size in SIZES:
+        data = os.urandom(size)
+        seconds = timeit.timeit(
+            lambda: backend.decrypt(key, iv, data),
+            number=ITERATIONS
+        )
+        results.append(
+            '{0:>8.1f} MB/s {1:>6.2f} us/call ({2} bytes)'.format(
+                size * ITERATIONS / seconds / 1000000,
+                seconds / ITERATIONS * 1000000,
+                size
+            )
+        )
+
+    print(
+        '{0:<14} first use {1:>7.2f} ms  {2}'.format(
+            name,
+            first_use * 1000,
+            '  '.join(results)
+        )
+    )
+
+
+def main():
+    for backend_class in aes.AES_BACKENDS:
+        subprocess.call(
+            [sys.executable, '-m', 'benchmarks.aes', backend_class.name]
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        measure(sys.argv[1])
+    else:
+        main()
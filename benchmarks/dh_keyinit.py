@@ -0,0 +1,91 @@
+"""
+Time the Diffie-Hellman exponentiation with a pure Python square and
+multiply and the builtin pow, and keyinit with and without a pool of
+precomputed keypairs.
+
+    python -m benchmarks.dh_keyinit
+"""
+from __future__ import print_function
+
+
+from novaagent.common import password
+
+
+import timeit
+
+
+ITERATIONS = 2000
+
+
+# A public key as sent by the host
+REMOTE_PUBLIC_KEY = 29146890515040234272807524713655
+
+
+def mod_exp(num, exp, mod):
+    """The square and multiply loop the agent used before pow"""
+    result = 1
+    while exp > 0:
+        if (exp & 1) == 1:
+            result = (result * num) % mod
+        exp = exp >> 1
+        num = (num * num) % mod
+    return result
+
+
+def report(label, seconds):
+    print(
+        '{0:<28} {1:>9.2f} us per call'.format(
+            label,
+            seconds / ITERATIONS * 1000000
+        )
+    )
+
+
+def time_pooled_keyinit(commands):
+    """Only the keyinit call is timed, the pool is refilled in between"""
+    total = 0.0
+    for count in range(ITERATIONS):
+        commands.key_pool.fill()
+        start = timeit.default_timer()
+        commands.keyinit_cmd(REMOTE_PUBLIC_KEY)
+        total += timeit.default_timer() - start
+
+    return total
+
+
+def main():
+    commands = password.PasswordCommands(key_pool_size=0)
+    private_key = commands._make_private_key()
+    report(
+        'mod_exp',
+        timeit.timeit(
+            lambda: mod_exp(
+                commands.base,
+                private_key,
+                commands.prime
+            ),
+            number=ITERATIONS
+        )
+    )
+    report(
+        'pow',
+        timeit.timeit(
+            lambda: pow(commands.base, private_key, commands.prime),
+            number=ITERATIONS
+        )
+    )
+    report(
+        'keyinit',
+        timeit.timeit(
+            lambda: commands.keyinit_cmd(REMOTE_PUBLIC_KEY),
+            number=ITERATIONS
+        )
+    )
+
+    pooled = password.PasswordCommands(key_pool_size=1)
+    pooled.key_pool.thread.join()
+    report('keyinit with a keypair pool', time_pooled_keyinit(pooled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Change one password in a generated shadow file with a large number of users,
+once reading and formatting every line like the agent used to and once with
+the streaming rewrite that only parses the line being changed.
+
+    python -m benchmarks.shadow_rewrite
+"""
+from __future__ import print_function
+
+
+from novaagent.common import password
+
+
+import tempfile
+import shutil
+import timeit
+import crypt
+import os
+
+
+USERS = 100000
+ITERATIONS = 10
+
+
+# The changed user sits in the middle of the file
+TARGET_USER = 'user{0}'.format(USERS // 2)
+
+
+def build_shadow(filename):
+    with open(filename, 'w') as f:
+        f.write('root:$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.:17333:0:99999:7:::\n')
+        for count in range(USERS):
+            f.write(
+                'user{0}:$6$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.:17352:0:99999:'
+                '7:::\n'.format(count)
+            )
+
+
+def readlines_rewrite(user, new_password, filename):
+    """The rewrite as it was done before streaming"""
+    with open(filename) as f:
+        file_data = f.readlines()
+
+    tmpfile = '{0}.tmp'.format(filename)
+    with open(tmpfile, 'w') as f:
+        for line in file_data:
+            line = line.strip()
+            try:
+                (s_user, s_password, s_rest) = line.split(':', 2)
+            except ValueError:
+                f.write('{0}\n'.format(line))
+                continue
+
+            if s_user != user:
+                f.write('{0}\n'.format(line))
+                continue
+
+            enc_pass = crypt.crypt(new_password, '$1$abcdefgh$')
+            f.write('%s:%s:%s\n' % (s_user, enc_pass, s_rest))
+
+    return tmpfile
+
+
+def streaming_rewrite(user, new_password, filename):
+    return password._rewrite_password_file(
+        filename,
+        {user: lambda old_hash: crypt.crypt(new_password, '$1$abcdefgh$')}
+    )[0]
+
+
+def run(rewrite, filename):
+    def target():
+        os.remove(rewrite(TARGET_USER, 'password', filename))
+
+    return timeit.timeit(target, number=ITERATIONS) / ITERATIONS
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'shadow')
+        build_shadow(filename)
+        print(
+            '{0} users, {1} bytes'.format(
+                USERS + 1,
+                os.path.getsize(filename)
+            )
+        )
+        for label, rewrite in (
+            ('readlines', readlines_rewrite),
+            ('streaming', streaming_rewrite)
+        ):
+            print(
+                '{0:<10} {1:>9.2f} ms per rewrite'.format(
+                    label,
+                    run(rewrite, filename) * 1000
+                )
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Run the same xenstore workload against the in-memory backend with a
+simulated round trip per request, once sending every request on its own and
+once pipelining each batch, to show what pipelining saves.
+
+    python -m benchmarks.xenstore_backends
+"""
+from __future__ import print_function
+
+
+from novaagent.xenstore import backends
+from novaagent.xenstore import xenstore
+
+
+import timeit
+import json
+import time
+
+
+INTERFACES = 8
+EVENTS = 10
+
+
+# Roughly the cost of one request through /dev/xen/xenbus
+ROUND_TRIP = 0.0005
+
+
+class RoundTripBackend(backends.MemoryBackend):
+    """Memory backend that pays a round trip for every request"""
+    def read(self, path):
+        time.sleep(ROUND_TRIP)
+        return super(RoundTripBackend, self).read(path)
+
+    def list_iter(self, path):
+        time.sleep(ROUND_TRIP)
+        return super(RoundTripBackend, self).list_iter(path)
+
+    def write(self, path, value):
+        time.sleep(ROUND_TRIP)
+        super(RoundTripBackend, self).write(path, value)
+
+    def delete(self, path):
+        time.sleep(ROUND_TRIP)
+        super(RoundTripBackend, self).delete(path)
+
+
+class PipelinedPipeline(backends.Pipeline):
+    def execute(self):
+        time.sleep(ROUND_TRIP)
+        return super(PipelinedPipeline, self).execute()
+
+
+class PipelinedBackend(backends.MemoryBackend):
+    """
+        Memory backend that pays one round trip per pipelined batch, single
+        requests are not used by the workload
+    """
+    def pipeline(self):
+        return PipelinedPipeline(self)
+
+
+def build_nodes():
+    nodes = {'vm-data/hostname': 'test-server'}
+    for count in range(INTERFACES):
+        mac = 'BC764E20{0:04X}'.format(count)
+        nodes['vm-data/networking/{0}'.format(mac)] = json.dumps({
+            'label': 'private',
+            'mac': mac,
+            'ips': [{'ip': '10.0.0.{0}'.format(count), 'enabled': '1'}]
+        })
+
+    return nodes
+
+
+def workload(backend):
+    xenstore.xenstore_snapshot(b'vm-data', backend)
+    uuids = [str(count) for count in range(EVENTS)]
+    xenstore.xenstore_update_many(
+        [],
+        [('data/host/{0}'.format(uuid), '{}') for uuid in uuids],
+        backend
+    )
+    xenstore.xenstore_update_many(
+        ['data/host/{0}'.format(uuid) for uuid in uuids],
+        [('data/guest/{0}'.format(uuid), '{}') for uuid in uuids],
+        backend
+    )
+
+
+def main():
+    nodes = build_nodes()
+    for name, backend_type in (
+        ('memory', backends.MemoryBackend),
+        ('round trip', RoundTripBackend),
+        ('pipelined', PipelinedBackend)
+    ):
+        timing = min(
+            timeit.repeat(
+                lambda: workload(backend_type(nodes)),
+                number=5,
+                repeat=3
+            )
+        ) / 5
+        print('{0:<12} {1:>8.3f} ms'.format(name, timing * 1000))
+
+
+if __name__ == '__main__':
+    main()
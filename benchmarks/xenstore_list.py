@@ -0,0 +1,95 @@
+"""
+Compare the old xenstore-ls based listing of a path with xenstore-list on a
+large tree, using canned command output so no xenstore is needed.
+
+    python -m benchmarks.xenstore_list
+"""
+from __future__ import print_function
+
+
+from novaagent.xenstore import backends
+from novaagent.xenstore import xenstore
+
+
+import timeit
+import json
+import io
+
+
+CHILDREN = 1000
+GRANDCHILDREN = 10
+
+
+class FakePopen(object):
+    """Stand in for subprocess.Popen returning canned output per command"""
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def __call__(self, args, stdout=None, stderr=None):
+        self.stdout = io.BytesIO(self.outputs[args[0]])
+        self.returncode = 0
+        return self
+
+    def communicate(self):
+        return self.stdout.read(), b''
+
+
+def build_outputs():
+    value = json.dumps({'name': 'resetnetwork', 'value': 'x' * 256})
+    value = value.replace('"', '\\"')
+    ls_lines = []
+    list_lines = []
+    for child in range(CHILDREN):
+        name = 'child-{0}'.format(child)
+        list_lines.append(name)
+        ls_lines.append('{0} = "{1}"'.format(name, value))
+        for grandchild in range(GRANDCHILDREN):
+            ls_lines.append(
+                ' grandchild-{0} = "{1}"'.format(grandchild, value)
+            )
+
+    return {
+        'xenstore-ls': '\n'.join(ls_lines).encode('utf-8'),
+        'xenstore-list': '\n'.join(list_lines).encode('utf-8')
+    }
+
+
+def xenstore_ls_list(path, client):
+    """The listing as it was done before xenstore-list was used"""
+    p = backends.Popen(
+        ['xenstore-ls', path],
+        stdout=backends.PIPE,
+        stderr=backends.PIPE
+    )
+    out, _ = p.communicate()
+    decoded_out = out.decode('utf-8').split('\n')
+    return [item.split(' = ')[0] for item in decoded_out if item]
+
+
+def main():
+    outputs = build_outputs()
+    backends.Popen = FakePopen(outputs)
+    for name, func in (
+        ('xenstore-ls', xenstore_ls_list),
+        ('xenstore-list', xenstore.xenstore_list)
+    ):
+        items = func(b'data/host', None)
+        timing = min(
+            timeit.repeat(
+                lambda: func(b'data/host', None),
+                number=20,
+                repeat=5
+            )
+        ) / 20
+        print(
+            '{0:<14} {1:>8} bytes read {2:>6} entries {3:>8.3f} ms'.format(
+                name,
+                len(outputs[name]),
+                len(items),
+                timing * 1000
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
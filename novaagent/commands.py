@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+
+
+import threading
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# Third party packages add commands by declaring an entry point in this
+# group naming a Command, or a handler function that gets the defaults
+ENTRY_POINT_GROUP = 'novaagent.commands'
+
+
+class Command(object):
+    """
+        A command the agent answers and how it may be scheduled.
+
+        The handler is called as handler(server_os, name, value, client),
+        without one the method of the same name on the ServerOS is used and
+        the command is only available on distributions that implement it.
+
+        resources
+            State the command changes, commands sharing a resource run one
+            at a time in the order they were received
+        timeout
+            Seconds the host is kept waiting before the event is answered
+            with an error, the command keeps its resources until it
+            actually finishes. None waits for as long as it takes
+        idempotent
+            Queued duplicates can be answered by running the command once
+        uses_value
+            The value changes what the command does, duplicates are only
+            merged when their values match
+        concurrent
+            Several of these commands can run at the same time
+        replay_result
+            The result of an event completed before a restart can be
+            answered from the journal instead of running it again
+    """
+    def __init__(
+        self,
+        name,
+        handler=None,
+        resources=(),
+        timeout=None,
+        idempotent=False,
+        uses_value=True,
+        concurrent=True,
+        replay_result=True
+    ):
+        self.name = name
+        self.handler = handler
+        self.resources = tuple(resources)
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.uses_value = uses_value
+        self.concurrent = concurrent
+        self.replay_result = replay_result
+
+    def is_supported(self, server_os):
+        return self.handler is not None or hasattr(server_os, self.name)
+
+    def run(self, server_os, value, client):
+        if self.handler is not None:
+            return self.handler(server_os, self.name, value, client)
+
+        return getattr(server_os, self.name)(self.name, value, client)
+
+
+def _iter_entry_points(group):
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+
+    return list(entry_points.get(group, []))
+
+
+class CommandRegistry(object):
+    """
+        Commands known to the agent. Entry points are only listed when the
+        registry is first asked about a command it does not have and each
+        one is imported the first time its command is used.
+    """
+    def __init__(self, group=ENTRY_POINT_GROUP):
+        self.group = group
+        self.lock = threading.RLock()
+        self.commands = {}
+        self.order = []
+        self.entry_points = None
+
+    def register(self, command):
+        with self.lock:
+            if command.name not in self.order:
+                self.order.append(command.name)
+
+            self.commands[command.name] = command
+
+        return command
+
+    def _discover(self):
+        if self.entry_points is not None:
+            return
+
+        self.entry_points = {}
+        try:
+            entry_points = _iter_entry_points(self.group)
+        except Exception as e:
+            log.error('Unable to list command entry points: {0}'.format(e))
+            return
+
+        for entry_point in entry_points:
+            if entry_point.name in self.commands:
+                log.warning(
+                    'Ignoring entry point for built in command {0}'.format(
+                        entry_point.name
+                    )
+                )
+                continue
+
+            self.entry_points[entry_point.name] = entry_point
+            self.order.append(entry_point.name)
+
+    def _load(self, name):
+        entry_point = self.entry_points.pop(name)
+        try:
+            loaded = entry_point.load()
+        except Exception as e:
+            log.error(
+                'Unable to load command {0}: {1}'.format(name, str(e))
+            )
+            self.order.remove(name)
+            return None
+
+        if not isinstance(loaded, Command):
+            loaded = Command(name, handler=loaded)
+
+        loaded.name = name
+        return self.register(loaded)
+
+    def get(self, name):
+        """Return the command with this name or None if it is unknown"""
+        command = self.commands.get(name)
+        if command is not None:
+            return command
+
+        with self.lock:
+            self._discover()
+            if name in self.entry_points:
+                return self._load(name)
+
+            return self.commands.get(name)
+
+    def supported(self, server_os):
+        """Names of the commands this ServerOS can run, in register order"""
+        names = []
+        with self.lock:
+            self._discover()
+            for name in self.order:
+                # Entry points bring their own handler, they are not
+                # imported just to be listed
+                if name in self.entry_points:
+                    names.append(name)
+                elif self.commands[name].is_supported(server_os):
+                    names.append(name)
+
+        return names
+
+
+# keyinit leaves its private key in memory, answering it again after a
+# restart would hand out a public key the agent can no longer use.
+# resetnetwork reads everything it needs from vm-data when it runs so its
+# value is ignored.
+BUILTIN_COMMANDS = (
+    Command('kmsactivate', resources=('rhn',)),
+    Command(
+        'resetnetwork',
+        resources=('network',),
+        idempotent=True,
+        uses_value=False
+    ),
+    Command('version', idempotent=True),
+    Command('keyinit', resources=('password',), replay_result=False),
+    Command('features', idempotent=True),
+    Command('password', resources=('password',), idempotent=True),
+    Command('batchpassword', resources=('password',), idempotent=True),
+    Command('agentupdate', resources=('agent',), concurrent=False),
+    Command('injectfile', resources=('files',))
+)
+
+
+REGISTRY = CommandRegistry()
+for builtin_command in BUILTIN_COMMANDS:
+    REGISTRY.register(builtin_command)
@@ -0,0 +1,243 @@
+"""
+AES-CBC implementations the password commands can decrypt with. None of
+them is imported until the first password is decrypted, the first one in
+AES_BACKENDS that is installed is used from then on.
+"""
+from __future__ import absolute_import
+
+
+import threading
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class AESBackend(object):
+    """
+        Encrypt and decrypt whole blocks with AES-CBC, padding is left to
+        the caller. load() imports what the backend needs and raises
+        ImportError when it is not installed.
+    """
+    name = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def encrypt(self, key, iv, data):
+        raise NotImplementedError
+
+    def decrypt(self, key, iv, data):
+        raise NotImplementedError
+
+
+class CryptographyBackend(AESBackend):
+    """pyca/cryptography"""
+    name = 'cryptography'
+
+    def load(self):
+        from cryptography.hazmat.primitives.ciphers import algorithms
+        from cryptography.hazmat.primitives.ciphers import modes
+        from cryptography.hazmat.primitives.ciphers import Cipher
+        try:
+            from cryptography.hazmat.backends import default_backend
+        except ImportError:
+            default_backend = None
+
+        self.algorithms = algorithms
+        self.modes = modes
+        self.Cipher = Cipher
+        # Releases before 3.1 require the backend argument
+        self.backend = default_backend() if default_backend else None
+
+    def _cipher(self, key, iv):
+        return self.Cipher(
+            self.algorithms.AES(key),
+            self.modes.CBC(iv),
+            self.backend
+        )
+
+    def encrypt(self, key, iv, data):
+        encryptor = self._cipher(key, iv).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, key, iv, data):
+        decryptor = self._cipher(key, iv).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+class PyCryptoBackend(AESBackend):
+    """pycrypto or pycryptodome"""
+    name = 'pycrypto'
+
+    def load(self):
+        from Crypto.Cipher import AES
+        self.AES = AES
+
+    def encrypt(self, key, iv, data):
+        return self.AES.new(key, self.AES.MODE_CBC, iv).encrypt(data)
+
+    def decrypt(self, key, iv, data):
+        return self.AES.new(key, self.AES.MODE_CBC, iv).decrypt(data)
+
+
+class OpenSSLBackend(AESBackend):
+    """The EVP interface of the system libcrypto through ctypes"""
+    name = 'openssl'
+
+    CIPHERS = {
+        16: 'EVP_aes_128_cbc',
+        24: 'EVP_aes_192_cbc',
+        32: 'EVP_aes_256_cbc'
+    }
+
+    def load(self):
+        import ctypes.util
+        import ctypes
+
+        path = ctypes.util.find_library('crypto')
+        if path is None:
+            raise ImportError('libcrypto was not found')
+
+        try:
+            libcrypto = ctypes.CDLL(path)
+            libcrypto.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+            libcrypto.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+            libcrypto.EVP_CIPHER_CTX_set_padding.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_int
+            ]
+            for function in ('EVP_EncryptInit_ex', 'EVP_DecryptInit_ex'):
+                getattr(libcrypto, function).argtypes = [
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_char_p,
+                    ctypes.c_char_p
+                ]
+
+            for function in ('EVP_EncryptUpdate', 'EVP_DecryptUpdate'):
+                getattr(libcrypto, function).argtypes = [
+                    ctypes.c_void_p,
+                    ctypes.c_char_p,
+                    ctypes.POINTER(ctypes.c_int),
+                    ctypes.c_char_p,
+                    ctypes.c_int
+                ]
+
+            for function in ('EVP_EncryptFinal_ex', 'EVP_DecryptFinal_ex'):
+                getattr(libcrypto, function).argtypes = [
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.POINTER(ctypes.c_int)
+                ]
+
+            for function in self.CIPHERS.values():
+                getattr(libcrypto, function).restype = ctypes.c_void_p
+        except (OSError, AttributeError) as e:
+            raise ImportError('libcrypto is not usable: {0}'.format(e))
+
+        self.ctypes = ctypes
+        self.libcrypto = libcrypto
+
+    def _crypt(self, operation, key, iv, data):
+        if len(iv) != 16 or len(data) % 16 != 0:
+            raise ValueError('Data must be a multiple of 16 bytes')
+
+        try:
+            cipher = getattr(self.libcrypto, self.CIPHERS[len(key)])()
+        except KeyError:
+            raise ValueError('Incorrect AES key length')
+
+        ctypes = self.ctypes
+        ctx = self.libcrypto.EVP_CIPHER_CTX_new()
+        if not ctx:
+            raise MemoryError('Unable to allocate a cipher context')
+
+        try:
+            output = ctypes.create_string_buffer(len(data) + 16)
+            length = ctypes.c_int(0)
+            final_length = ctypes.c_int(0)
+            if (
+                not getattr(self.libcrypto, operation + 'Init_ex')(
+                    ctx,
+                    cipher,
+                    None,
+                    key,
+                    iv
+                ) or
+                not self.libcrypto.EVP_CIPHER_CTX_set_padding(ctx, 0) or
+                not getattr(self.libcrypto, operation + 'Update')(
+                    ctx,
+                    output,
+                    ctypes.byref(length),
+                    data,
+                    len(data)
+                ) or
+                not getattr(self.libcrypto, operation + 'Final_ex')(
+                    ctx,
+                    ctypes.addressof(output) + length.value,
+                    ctypes.byref(final_length)
+                )
+            ):
+                raise ValueError('OpenSSL was unable to {0}'.format(
+                    'encrypt' if operation == 'EVP_Encrypt' else 'decrypt'
+                ))
+
+            return output.raw[:length.value + final_length.value]
+        finally:
+            self.libcrypto.EVP_CIPHER_CTX_free(ctx)
+
+    def encrypt(self, key, iv, data):
+        return self._crypt('EVP_Encrypt', key, iv, data)
+
+    def decrypt(self, key, iv, data):
+        return self._crypt('EVP_Decrypt', key, iv, data)
+
+
+# In order of preference, fastest first as measured by benchmarks/aes.py
+AES_BACKENDS = (CryptographyBackend, OpenSSLBackend, PyCryptoBackend)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def load_backend(name):
+    """Load the backend with this name, raises ImportError if unavailable"""
+    for backend_class in AES_BACKENDS:
+        if backend_class.name == name:
+            backend = backend_class()
+            backend.load()
+            return backend
+
+    raise ImportError('Unknown AES backend {0}'.format(name))
+
+
+def get_backend():
+    """Return the AES backend, choosing it on the first call"""
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    with _backend_lock:
+        if _backend is None:
+            for backend_class in AES_BACKENDS:
+                try:
+                    backend = load_backend(backend_class.name)
+                except ImportError as e:
+                    log.debug(
+                        'AES backend {0} is not available: {1}'.format(
+                            backend_class.name,
+                            str(e)
+                        )
+                    )
+                    continue
+
+                log.info('Using AES backend {0}'.format(backend.name))
+                _backend = backend
+                break
+            else:
+                raise ImportError('No AES backend is available')
+
+    return _backend
@@ -0,0 +1,153 @@
+"""
+Helper process that hashes passwords for the agent so an expensive hash
+does not hold up the agent process while it is computed.
+
+The agent writes one JSON [password, salt] list per line and reads back one
+JSON object per line with either the hash or the error.
+"""
+from __future__ import absolute_import
+
+
+import subprocess
+import threading
+import logging
+import select
+import crypt
+import json
+import sys
+
+
+log = logging.getLogger(__name__)
+
+
+# Seconds to wait for the helper to answer before it is killed and the hash
+# is computed in the agent instead
+REQUEST_TIMEOUT = 60
+
+
+class CryptError(Exception):
+    pass
+
+
+def _hash(password, salt):
+    result = crypt.crypt(password, salt)
+    if not result or result.startswith('*'):
+        # The C library does not know the scheme of the salt, depending on
+        # the library that is None or a string starting with *
+        raise CryptError('Unsupported salt {0}'.format(salt.split('$')[1]))
+
+    return result
+
+
+class CryptWorker(object):
+    """
+        Client for the helper process. start() launches it ahead of the
+        first hash, a helper that died or stopped answering is started again
+        on the next hash and if it cannot be used at all the hash is
+        computed in this process.
+    """
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        if self.process is not None and self.process.poll() is None:
+            return
+
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'novaagent.common.crypt_worker'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True
+        )
+
+    def start(self):
+        with self.lock:
+            try:
+                self._start()
+            except (IOError, OSError) as e:
+                log.error('Unable to start crypt worker: {0}'.format(str(e)))
+
+    def stop(self):
+        with self.lock:
+            if self.process is None:
+                return
+
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+    def _discard(self):
+        if self.process is None:
+            return
+
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+
+        self.process = None
+
+    def _request(self, password, salt):
+        self._start()
+        request = json.dumps([password, salt]) + '\n'
+        self.process.stdin.write(request.encode('utf-8'))
+        self.process.stdin.flush()
+        # A helper that hangs would otherwise hold the lock, and every later
+        # password command, forever
+        readable, _, _ = select.select(
+            [self.process.stdout],
+            [],
+            [],
+            self.timeout
+        )
+        if not readable:
+            raise IOError(
+                'Crypt worker did not answer within {0} seconds'.format(
+                    self.timeout
+                )
+            )
+
+        response = self.process.stdout.readline()
+        if not response:
+            raise IOError('Crypt worker exited')
+
+        return json.loads(response.decode('utf-8'))
+
+    def crypt(self, password, salt):
+        with self.lock:
+            try:
+                response = self._request(password, salt)
+            except (IOError, OSError, ValueError) as e:
+                log.error(
+                    'Crypt worker failed, hashing in the agent: {0}'.format(
+                        str(e)
+                    )
+                )
+                self._discard()
+                return _hash(password, salt)
+
+        if 'error' in response:
+            raise CryptError(response['error'])
+
+        return response['hash']
+
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    for line in iter(stdin.readline, b''):
+        password, salt = json.loads(line.decode('utf-8'))
+        try:
+            response = {'hash': _hash(password, salt)}
+        except Exception as e:
+            response = {'error': str(e)}
+
+        stdout.write((json.dumps(response) + '\n').encode('utf-8'))
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
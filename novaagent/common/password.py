@@ -19,15 +19,23 @@
 JSON password reset handling plugin
 """
 
+import collections
+import threading
 import binascii
 import logging
 import base64
 import crypt
+import errno
+import json
+import mmap
+import time
 import sys
 import os
 
 
-from Crypto.Cipher import AES
+from novaagent.common.crypt_worker import CryptWorker
+from novaagent.common.crypt_worker import CryptError
+from novaagent.common import aes
 
 
 try:
@@ -40,8 +48,40 @@ except:
 PASSWD_FILES = ['/etc/shadow']
 
 
+# With the tcb layout every user has a shadow file of their own in
+# TCB_DIR/<user>/shadow
+TCB_DIR = '/etc/tcb'
+
+
+# Keypairs generated ahead of time so keyinit only has to compute the shared
+# key while the host waits
+KEY_POOL_SIZE = 2
+
+
+# Keys from a keyinit are kept for SESSION_TTL seconds waiting for the
+# password that uses them, at most MAX_SESSIONS exchanges at a time
+SESSION_TTL = 300
+MAX_SESSIONS = 32
+
+
+# Session used by hosts that do not send a session id
+DEFAULT_SESSION = ''
+
+
+# Bytes copied at a time when the kernel cannot copy the password file
+COPY_BLOCK_SIZE = 65536
+
+
+# crypt scheme ids new passwords can be hashed with, by default the scheme
+# of the password being replaced is used
+HASH_SCHEMES = {'md5': '1', 'sha256': '5', 'sha512': '6'}
+SALT_LENGTHS = {'md5': 8, 'sha256': 16, 'sha512': 16}
+ROUNDS_SCHEMES = ('5', '6')
+
+
 if sys.version_info > (3,):
     long = int
+    unicode = str
 
 
 # This is to support older python versions that don't have hashlib
@@ -74,6 +114,101 @@ class PasswordError(Exception):
         return self.response
 
 
+class KeyPool(object):
+    """
+    Keypairs made by generate in a background thread. Every keypair is
+    handed out once and replaced after it is taken, an empty pool generates
+    the keypair in the caller instead of waiting for the thread.
+    """
+    def __init__(self, generate, size=KEY_POOL_SIZE):
+        self.generate = generate
+        self.size = size
+        self.keys = collections.deque()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def fill(self):
+        while len(self.keys) < self.size:
+            self.keys.append(self.generate())
+
+    def _fill(self):
+        try:
+            self.fill()
+        except Exception as exc:
+            logging.error("Couldn't generate keypair: %s" % str(exc))
+
+    def start(self):
+        if self.size < 1:
+            return
+
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+
+            self.thread = threading.Thread(target=self._fill)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get(self):
+        try:
+            keypair = self.keys.popleft()
+        except IndexError:
+            keypair = self.generate()
+
+        self.start()
+        return keypair
+
+
+class KeySessions(object):
+    """
+    AES keys derived by keyinit, by the session id the host sent with it.
+    A key expires ttl seconds after it was derived and the key closest to
+    expiring is dropped when a new session would exceed size.
+    """
+    def __init__(self, ttl=SESSION_TTL, size=MAX_SESSIONS):
+        self.ttl = ttl
+        self.size = size
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        for session, (expires, key) in list(self.keys.items()):
+            if expires <= now:
+                del self.keys[session]
+
+    def set(self, session, key):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            self.keys.pop(session, None)
+            while self.keys and len(self.keys) >= self.size:
+                oldest = min(self.keys, key=lambda item: self.keys[item][0])
+                logging.warning("Dropping key for session %r" % oldest)
+                del self.keys[oldest]
+
+            self.keys[session] = (now + self.ttl, key)
+
+    def get(self, session):
+        """Return the key for the session or None if there is none"""
+        with self.lock:
+            self._expire(time.time())
+            entry = self.keys.get(session)
+
+        if entry is None:
+            return None
+
+        return entry[1]
+
+    def pop(self, session):
+        with self.lock:
+            entry = self.keys.pop(session, None)
+
+        if entry is None:
+            return None
+
+        return entry[1]
+
+
 class PasswordCommands(object):
     """
     Class for password related commands
@@ -84,15 +219,49 @@ class PasswordCommands(object):
         self.base = 5
         self.kwargs = {}
         self.kwargs.update(kwargs)
+        self.key_pool = KeyPool(
+            self._make_keypair,
+            self.kwargs.get('key_pool_size', KEY_POOL_SIZE)
+        )
+        self.key_pool.start()
+        self.sessions = KeySessions(
+            self.kwargs.get('session_ttl', SESSION_TTL),
+            self.kwargs.get('max_sessions', MAX_SESSIONS)
+        )
+        self.crypt_worker = None
+        if self.kwargs.get('crypt_worker', True):
+            self.crypt_worker = CryptWorker()
+
+    @property
+    def aes_key(self):
+        """Key of the default session"""
+        aes_key = self.sessions.get(DEFAULT_SESSION)
+        if aes_key is None:
+            raise AttributeError('aes_key')
 
-    def _mod_exp(self, num, exp, mod):
-        result = 1
-        while exp > 0:
-            if (exp & 1) == 1:
-                result = (result * num) % mod
-            exp = exp >> 1
-            num = (num * num) % mod
-        return result
+        return aes_key
+
+    @aes_key.setter
+    def aes_key(self, aes_key):
+        self.sessions.set(DEFAULT_SESSION, aes_key)
+
+    @aes_key.deleter
+    def aes_key(self):
+        if self.sessions.pop(DEFAULT_SESSION) is None:
+            raise AttributeError('aes_key')
+
+    def _split_session(self, data):
+        """
+        Values may be sent as SESSION:VALUE so several exchanges can be in
+        progress at once, a bare value belongs to the default session
+        """
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        if hasattr(data, 'split') and ':' in data:
+            return tuple(data.split(':', 1))
+
+        return DEFAULT_SESSION, data
 
     def _make_private_key(self):
         """Create a private key using /dev/urandom"""
@@ -100,11 +269,16 @@ class PasswordCommands(object):
 
     def _dh_compute_public_key(self, private_key):
         """Given a private key, compute a public key"""
-        return self._mod_exp(self.base, private_key, self.prime)
+        return pow(self.base, private_key, self.prime)
 
     def _dh_compute_shared_key(self, public_key, private_key):
         """Given public and private keys, compute the shared key"""
-        return self._mod_exp(public_key, private_key, self.prime)
+        return pow(public_key, private_key, self.prime)
+
+    def _make_keypair(self):
+        """Create a (private, public) keypair"""
+        private_key = self._make_private_key()
+        return (private_key, self._dh_compute_public_key(private_key))
 
     def _compute_aes_key(self, key):
         """
@@ -124,8 +298,13 @@ class PasswordCommands(object):
         return (aes_key, aes_iv)
 
     def _decrypt_password(self, aes_key, data):
-        aes = AES.new(aes_key[0], AES.MODE_CBC, aes_key[1])
-        passwd = aes.decrypt(data)
+        # Checked here so every AES backend reports it the same way
+        if len(data) % 16 != 0:
+            raise PasswordError(
+                (500, "Input strings must be a multiple of 16 in length")
+            )
+
+        passwd = aes.get_backend().decrypt(aes_key[0], aes_key[1], data)
         try:
             cut_off_sz = ord(passwd[len(passwd) - 1])
         except:
@@ -137,15 +316,14 @@ class PasswordCommands(object):
         passwd = passwd[: - cut_off_sz]
         return passwd
 
-    def _decode_password(self, data):
+    def _decode_password(self, data, session=DEFAULT_SESSION):
         try:
             real_data = base64.b64decode(data)
         except Exception as exc:
             raise PasswordError((500, "Couldn't decode base64 data"))
 
-        try:
-            aes_key = self.aes_key
-        except AttributeError as exc:
+        aes_key = self.sessions.get(session)
+        if aes_key is None:
             raise PasswordError((500, "Password without key exchange"))
 
         try:
@@ -157,6 +335,14 @@ class PasswordCommands(object):
 
         return passwd
 
+    def _hash_options(self):
+        """The scheme, rounds and worker passwords are hashed with"""
+        return (
+            self.kwargs.get('hash_scheme'),
+            self.kwargs.get('hash_rounds'),
+            self.crypt_worker
+        )
+
     def _change_password(self, passwd):
         """Actually change the password"""
 
@@ -169,41 +355,96 @@ class PasswordCommands(object):
             string_passwd = str(passwd)
 
         # Make sure there are no newlines at the end
-        set_password('root', string_passwd.strip('\n'))
+        set_password(
+            'root',
+            string_passwd.strip('\n'),
+            *self._hash_options()
+        )
+
+    def _change_passwords(self, passwords):
+        """Change the password of every (user, password) pair at once"""
+
+        if self.kwargs.get('testmode', False):
+            return None
+
+        set_passwords(
+            [(user, passwd.strip('\n')) for user, passwd in passwords],
+            *self._hash_options()
+        )
+
+    def _decode_batch(self, passwd):
+        """
+        The decrypted data of a batch is a JSON list of [user, password]
+        pairs, or a JSON object of user to password
+        """
+        if isinstance(passwd, bytes):
+            passwd = passwd.decode('utf-8')
 
-    def _wipe_key(self):
-        """Remove key from a previous keyinit command"""
         try:
-            del self.aes_key
-        except AttributeError:
-            pass
+            batch = json.loads(passwd)
+            if isinstance(batch, dict):
+                batch = list(batch.items())
+
+            passwords = [(user, new) for user, new in batch]
+        except (TypeError, ValueError):
+            raise PasswordError((500, "Invalid password batch received"))
+
+        for user, new in passwords:
+            if (
+                not isinstance(user, unicode) or
+                not isinstance(new, unicode) or
+                ':' in user or
+                '\n' in user
+            ):
+                raise PasswordError((500, "Invalid password batch received"))
+
+        return passwords
+
+    def _wipe_key(self, session=DEFAULT_SESSION):
+        """Remove key from a previous keyinit command"""
+        self.sessions.pop(session)
 
     def keyinit_cmd(self, data):
         # Remote pubkey comes in as large number
         # Or well, it should come in as a large number.  It's possible
         # that some legacy client code will send it as a string.  So,
         # we'll make sure to always convert it to long.
+        session, data = self._split_session(data)
         remote_public_key = long(data)
 
-        my_private_key = self._make_private_key()
-        my_public_key = self._dh_compute_public_key(my_private_key)
+        my_private_key, my_public_key = self.key_pool.get()
 
         shared_key = str(
             self._dh_compute_shared_key(remote_public_key, my_private_key)
         )
-        self.aes_key = self._compute_aes_key(shared_key)
+        self.sessions.set(session, self._compute_aes_key(shared_key))
+        if self.crypt_worker is not None and not self.kwargs.get('testmode'):
+            # A password is expected next, have the worker ready to hash it
+            self.crypt_worker.start()
 
         # The key needs to be a string response right now
         return ("D0", str(my_public_key))
 
     def password_cmd(self, data):
+        session, data = self._split_session(data)
         try:
-            passwd = self._decode_password(data)
+            passwd = self._decode_password(data, session)
             self._change_password(passwd)
         except PasswordError as exc:
             return exc.get_response()
 
-        self._wipe_key()
+        self._wipe_key(session)
+        return ("0", "")
+
+    def batch_password_cmd(self, data):
+        session, data = self._split_session(data)
+        try:
+            passwd = self._decode_password(data, session)
+            self._change_passwords(self._decode_batch(passwd))
+        except PasswordError as exc:
+            return exc.get_response()
+
+        self._wipe_key(session)
         return ("0", "")
 
 
@@ -223,14 +464,140 @@ def _make_salt(length):
     return salt
 
 
-def _create_temp_password_file(user, password, filename):
+def _parse_hash(old_hash):
     """
-    Read original passwd file, generating a new temporary file.
-    Returns: The temporary filename
+    Return the (scheme id, rounds, salt length) of a crypt hash, rounds is
+    None when the hash does not set it
+    """
+    if not old_hash.startswith('$'):
+        # Default to MD5 as a minimum level of compatibility
+        return ('1', None, 8)
+
+    # Format is '$ID$SALT$HASH' or '$ID$rounds=N$SALT$HASH' where ID
+    # defines the ecnryption type
+    salt_data = old_hash[1:].split('$')
+    rounds = None
+    if len(salt_data) > 2 and salt_data[1].startswith('rounds='):
+        try:
+            rounds = int(salt_data[1][len('rounds='):])
+        except ValueError:
+            pass
+
+        salt_data.pop(1)
+
+    return (salt_data[0], rounds, len(salt_data[1]))
+
+
+def _hash_password(password, old_hash, scheme=None, rounds=None, worker=None):
+    """
+    Hash password with the scheme, rounds and salt length of old_hash. A
+    scheme or rounds that is given replaces the one of old_hash, rounds
+    only apply to the SHA-crypt schemes.
     """
-    with open(filename) as f:
-        file_data = f.readlines()
+    scheme_id, old_rounds, salt_length = _parse_hash(old_hash)
+    if scheme is not None:
+        if HASH_SCHEMES[scheme] != scheme_id:
+            salt_length = SALT_LENGTHS[scheme]
+
+        scheme_id = HASH_SCHEMES[scheme]
+
+    if rounds is None:
+        rounds = old_rounds
+
+    salt = '$%s$' % scheme_id
+    if rounds is not None and scheme_id in ROUNDS_SCHEMES:
+        salt += 'rounds=%d$' % rounds
 
+    salt += '%s$' % _make_salt(salt_length)
+    if worker is not None:
+        try:
+            return worker.crypt(password, salt)
+        except CryptError as exc:
+            raise PasswordError((500, str(exc)))
+
+    result = crypt.crypt(password, salt)
+    if not result or result.startswith('*'):
+        raise PasswordError((500, "Unsupported password hash %s" % scheme_id))
+
+    return result
+
+
+def _find_user_lines(data, user):
+    """
+    Return the (start, end) offsets of every line of user in data, end
+    includes the newline. Whitespace before the user name is allowed as it
+    is by the system, lines without the password and rest fields are
+    skipped.
+    """
+    needle = user + b':'
+    spans = []
+    found = data.find(needle)
+    while found != -1:
+        start = data.rfind(b'\n', 0, found) + 1
+        end = data.find(b'\n', found)
+        end = len(data) if end == -1 else end + 1
+        if (
+            not data[start:found].strip() and
+            data[start:end].count(b':') >= 2
+        ):
+            spans.append((start, end))
+
+        found = data.find(needle, end)
+
+    return spans
+
+
+def _replace_password(line, new_hash):
+    """Put new_hash in the password field of a shadow line"""
+    body = line.rstrip(b'\r\n')
+    (s_user, s_password, s_rest) = body.split(b':', 2)
+    return b':'.join(
+        (s_user, new_hash.encode('utf-8'), s_rest)
+    ) + line[len(body):]
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """
+    Append count bytes of src_fd starting at offset to dst_fd, in the
+    kernel with sendfile where it can copy between regular files
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    while count > 0:
+        if sendfile is not None:
+            try:
+                copied = sendfile(dst_fd, src_fd, offset, count)
+            except OSError as exc:
+                if exc.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+
+                sendfile = None
+                continue
+        else:
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            block = os.read(src_fd, min(count, COPY_BLOCK_SIZE))
+            copied = len(block)
+            while block:
+                block = block[os.write(dst_fd, block):]
+
+        if copied == 0:
+            raise IOError('%s bytes missing from password file' % count)
+
+        offset += copied
+        count -= copied
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _rewrite_password_file(filename, hashers):
+    """
+    Write a copy of filename where the password of every user in hashers
+    is replaced by hashers[user](old_hash). Only the changed lines are
+    parsed, the bytes around them are copied as they are.
+    Returns: The temporary filename and the users that were not found
+    """
     stat_info = os.stat(filename)
     tmpfile = '%s.tmp.%d' % (filename, os.getpid())
 
@@ -243,88 +610,153 @@ def _create_temp_password_file(user, password, filename):
         os.O_CREAT | os.O_TRUNC | os.O_WRONLY,
         stat_info.st_mode
     )
-    f = None
+    src_fd = None
+    data = None
     success = False
     try:
         os.chown(tmpfile, stat_info.st_uid, stat_info.st_gid)
-        f = os.fdopen(fd, 'w')
-        for line in file_data:
-            line = line.strip()
-            if line.startswith('#'):
-                f.write('{0}\n'.format(line))
-                continue
-
-            try:
-                (s_user, s_password, s_rest) = line.split(':', 2)
-            except ValueError as exc:
-                f.write('{0}\n'.format(line))
-                continue
-
-            if s_user != user:
-                f.write('{0}\n'.format(line))
-                continue
-
-            if s_password.startswith('$'):
-                # Format is '$ID$SALT$HASH' where ID defines the
-                # ecnryption type.  We'll re-use that, and make a salt
-                # that's the same size as the old
-                salt_data = s_password[1:].split('$')
-                salt = '$%s$%s$' % (
-                    salt_data[0],
-                    _make_salt(len(salt_data[1]))
-                )
-            else:
-                # Default to MD5 as a minimum level of compatibility
-                salt = '$1$%s$' % _make_salt(8)
-
-            enc_pass = crypt.crypt(password, salt)
-            f.write("%s:%s:%s\n" % (s_user, enc_pass, s_rest))
-
-        f.flush()
-        f.close()
-        f = None
+        src_fd = os.open(filename, os.O_RDONLY)
+        size = os.fstat(src_fd).st_size
+        spans = []
+        missing = set(hashers)
+        if size > 0:
+            data = mmap.mmap(src_fd, size, access=mmap.ACCESS_READ)
+            for user, hasher in hashers.items():
+                for start, end in _find_user_lines(
+                    data,
+                    user.encode('utf-8')
+                ):
+                    spans.append((start, end, hasher))
+                    missing.discard(user)
+
+        position = 0
+        for start, end, hasher in sorted(spans, key=lambda span: span[0]):
+            _copy_range(src_fd, fd, position, start - position)
+            line = data[start:end]
+            old_hash = line.split(b':', 2)[1].decode('utf-8')
+            _write_all(fd, _replace_password(line, hasher(old_hash)))
+            position = end
+
+        _copy_range(src_fd, fd, position, size - position)
+        os.fsync(fd)
         success = True
     except Exception as exc:
         logging.error("Couldn't create temporary password file: %s" % str(exc))
         raise
     finally:
+        if data is not None:
+            data.close()
+
+        if src_fd is not None:
+            os.close(src_fd)
+
+        os.close(fd)
         if not success:
-            # Close the file if it's open
-            if f:
-                try:
-                    f.close()
-                except Exception:
-                    pass
             # Make sure to unlink the tmpfile
             try:
                 os.unlink(tmpfile)
             except Exception:
                 pass
 
-    return tmpfile
+    return tmpfile, sorted(missing)
 
 
-def set_password(user, password):
-    """Set the password for a particular user"""
-    for filename in PASSWD_FILES:
-        if not os.path.exists(filename):
-            continue
+def _create_temp_password_file(user, password, filename):
+    """
+    Read original passwd file, generating a new temporary file.
+    Returns: The temporary filename
+    """
+    return _rewrite_password_file(
+        filename,
+        {user: _password_hasher(password)}
+    )[0]
+
+
+def _password_hasher(password, scheme=None, rounds=None, worker=None):
+    return lambda old_hash: _hash_password(
+        password,
+        old_hash,
+        scheme,
+        rounds,
+        worker
+    )
+
+
+def _password_files(user):
+    """
+    Files that may hold the password of user, the tcb shadow file of the
+    user comes first when the system uses tcb
+    """
+    if user and '/' not in user and user not in ('.', '..'):
+        tcb_shadow = os.path.join(TCB_DIR, user, 'shadow')
+        if os.path.exists(tcb_shadow):
+            return [tcb_shadow] + PASSWD_FILES
 
+    return PASSWD_FILES
+
+
+def set_passwords(passwords, scheme=None, rounds=None, worker=None):
+    """
+    Set the password of every (user, password) pair, each password file is
+    rewritten once for all of its users and replaced with a single rename.
+    The hashes are computed by the crypt worker when one is given.
+    """
+    files = []
+    file_users = {}
+    for user, password in passwords:
+        for filename in _password_files(user):
+            if os.path.exists(filename):
+                break
+        else:
+            raise PasswordError((500, "No password file found"))
+
+        if filename not in file_users:
+            files.append(filename)
+            file_users[filename] = {}
+
+        file_users[filename][user] = password
+
+    # Every file is rewritten before any is replaced, so a user missing
+    # from one file leaves all of them untouched
+    tmpfiles = []
+    missing = []
+    try:
+        for filename in files:
+            tmpfile, not_found = _rewrite_password_file(
+                filename,
+                dict(
+                    (user, _password_hasher(password, scheme, rounds, worker))
+                    for user, password in file_users[filename].items()
+                )
+            )
+            tmpfiles.append(tmpfile)
+            missing.extend(not_found)
+
+        if missing:
+            raise PasswordError(
+                (500, "Unknown user %s" % ', '.join(sorted(missing)))
+            )
+    except Exception:
+        for tmpfile in tmpfiles:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+
+        raise
+
+    for filename, tmpfile in zip(files, tmpfiles):
         # Get the selinux file context before we do anything with the file
         if SELINUX:
             selinux_context = selinux.getfilecon(filename)
 
-        tmpfile = _create_temp_password_file(user, password, filename)
-        bakfile = '{0}.bak.{1}'.format(filename, os.getpid())
-
-        os.rename(filename, bakfile)
         os.rename(tmpfile, filename)
-        os.remove(bakfile)
 
         # Update selinux context after the file replace
         if SELINUX:
             selinux.setfilecon(filename, selinux_context[1])
 
-        return
 
-    raise PasswordError((500, "No password file found"))
+def set_password(user, password, scheme=None, rounds=None, worker=None):
+    """Set the password for a particular user"""
+    set_passwords([(user, password)], scheme, rounds, worker)
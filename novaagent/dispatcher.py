@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+
+
+from novaagent.commands import REGISTRY
+
+
+from collections import defaultdict
+
+
+import threading
+import logging
+
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_WORKERS = 4
+
+
+def coalesce_events(events, registry=REGISTRY):
+    """
+        Merge queued events that would repeat the same work. Takes a list of
+        (uuid, event) pairs in the order they were queued and returns a list
+        of (uuids, event) pairs, every uuid in a group gets the result of
+        running the event once.
+
+        Only idempotent commands are merged, and only while no other command
+        sharing one of their resources was queued between them, so a
+        password is never merged across a keyinit.
+    """
+    groups = []
+    open_groups = {}
+    for uuid, event in events:
+        name = event['name']
+        command = registry.get(name)
+        key = None
+        if command is not None and command.idempotent:
+            value = event['value'] if command.uses_value else None
+            key = (name, value)
+
+        if key is not None and key in open_groups:
+            log.info(
+                'Coalescing event {0} into {1}'.format(
+                    uuid,
+                    open_groups[key][0][0]
+                )
+            )
+            open_groups[key][0].append(uuid)
+            continue
+
+        resources = set(command.resources) if command is not None else set()
+        if resources:
+            for open_key in list(open_groups.keys()):
+                if resources.intersection(
+                    registry.get(open_key[0]).resources
+                ):
+                    del open_groups[open_key]
+
+        group = ([uuid], event)
+        groups.append(group)
+        if key is not None:
+            open_groups[key] = group
+
+    return groups
+
+
+class Job(object):
+    def __init__(self, uuids, event, keys):
+        self.uuids = uuids
+        self.event = event
+        self.keys = keys
+
+
+class Dispatcher(object):
+    """
+        Run events on a pool of worker threads.
+
+        Every job holds a set of keys while it runs, the resources of the
+        command and the command name itself. A resource can only be held by
+        one job at a time and a command name by as many jobs as its limit
+        allows, one for commands that cannot run concurrently and unlimited
+        otherwise. Jobs that share a key start in the order they were
+        submitted.
+    """
+    def __init__(
+        self,
+        handler,
+        workers=DEFAULT_WORKERS,
+        limits=None,
+        registry=REGISTRY
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.limits = limits or {}
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.waiting = []
+        self.pending = set()
+        self.in_use = defaultdict(int)
+        self.threads = []
+
+    def start(self):
+        for count in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker,
+                name='dispatcher-{0}'.format(count)
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def is_pending(self, uuid):
+        """Check if an event was submitted and has not finished yet"""
+        with self.lock:
+            return uuid in self.pending
+
+    def submit(self, uuids, event):
+        keys = [('command', event['name'])]
+        command = self.registry.get(event['name'])
+        if command is not None:
+            for resource in command.resources:
+                keys.append(('resource', resource))
+
+        with self.lock:
+            self.pending.update(uuids)
+            self.waiting.append(Job(uuids, event, keys))
+            self._schedule()
+
+    def _capacity(self, key):
+        kind, name = key
+        if kind == 'resource':
+            return 1
+
+        if name in self.limits:
+            return self.limits[name]
+
+        command = self.registry.get(name)
+        if command is not None and not command.concurrent:
+            return 1
+
+        return None
+
+    def _schedule(self):
+        """
+            Hand every waiting job that can run to the workers. Must be
+            called with the lock held.
+
+            A job that cannot start blocks all later jobs sharing one of
+            its keys, otherwise a later password could overtake the keyinit
+            that it depends on.
+        """
+        blocked = set()
+        waiting = []
+        for job in self.waiting:
+            runnable = not blocked.intersection(job.keys)
+            for key in job.keys:
+                capacity = self._capacity(key)
+                if capacity is not None and self.in_use[key] >= capacity:
+                    runnable = False
+
+            if not runnable:
+                blocked.update(job.keys)
+                waiting.append(job)
+                continue
+
+            for key in job.keys:
+                self.in_use[key] += 1
+
+            self.jobs.put(job)
+
+        self.waiting = waiting
+
+    def _finish(self, job):
+        with self.lock:
+            for key in job.keys:
+                self.in_use[key] -= 1
+
+            self.pending.difference_update(job.uuids)
+            self._schedule()
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            try:
+                self.handler(job.uuids, job.event)
+            except Exception as e:
+                log.error(
+                    'Exception was caught running event {0}: {1}'.format(
+                        job.uuids[0],
+                        str(e)
+                    )
+                )
+            finally:
+                self._finish(job)
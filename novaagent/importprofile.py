@@ -0,0 +1,159 @@
+"""
+Report the cost of importing the agent, split into the modules loaded when
+the agent starts and the ones only loaded when a handler needs them.
+
+    nova-agent --profile-imports
+    python -m novaagent.importprofile
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+
+import time
+import sys
+
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+# Loaded the first time a persistent connection is opened or a handler
+# that needs them runs
+ON_DEMAND_MODULES = (
+    'pyxs.client',
+    'novaagent.xenbus',
+    'novaagent.common.password',
+    'novaagent.common.aes',
+    'novaagent.common.file_inject',
+    'novaagent.common.kms',
+    'novaagent.netlink',
+    'netifaces'
+)
+
+
+class ImportProfiler(object):
+    """
+        Time every import that loads a new module while active. Each record
+        holds the time including the modules it imported and the time spent
+        in the module itself.
+    """
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.original_import = None
+
+    def __enter__(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._import
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        builtins.__import__ = self.original_import
+
+    def _import(self, name, *args, **kwargs):
+        known = set(sys.modules)
+        self.stack.append(0.0)
+        start = timer()
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            total = timer() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += total
+
+            loaded = [module for module in sys.modules if module not in known]
+            if loaded:
+                self.records.append(
+                    (
+                        self._loaded_name(name, loaded, *args, **kwargs),
+                        total,
+                        total - children,
+                        len(self.stack)
+                    )
+                )
+
+    def _loaded_name(
+        self,
+        name,
+        loaded,
+        globals=None,
+        locals=None,
+        fromlist=None,
+        level=0
+    ):
+        """
+            Name the module an import statement loaded, which for relative
+            imports and from package import module is not the name passed
+            to __import__
+        """
+        if level > 0 and globals:
+            package = globals.get('__package__') or ''
+            package = package.rsplit('.', level - 1)[0] if level > 1 else (
+                package
+            )
+            name = '{0}.{1}'.format(package, name) if name else package
+
+        for item in fromlist or ():
+            submodule = '{0}.{1}'.format(name, item)
+            if submodule in loaded:
+                return submodule
+
+        if name in loaded:
+            return name
+
+        return min(loaded, key=len)
+
+    def report(self, title):
+        print(title)
+        for name, total, own, depth in sorted(
+            self.records,
+            key=lambda record: record[1],
+            reverse=True
+        ):
+            print(
+                '{0:>9.2f} ms {1:>9.2f} ms  {2}'.format(
+                    total * 1000,
+                    own * 1000,
+                    name
+                )
+            )
+
+        print(
+            '{0:>9.2f} ms total\n'.format(
+                sum(record[1] for record in self.records if record[3] == 0) *
+                1000
+            )
+        )
+
+
+def _import_module(name):
+    try:
+        __import__(name)
+    except ImportError as e:
+        print('Unable to import {0}: {1}'.format(name, str(e)))
+
+
+def main():
+    print('    total        self  module')
+    with ImportProfiler() as startup:
+        _import_module('novaagent.novaagent')
+        # A guest only loads the module for its own distribution
+        for name in ('centos', 'debian', 'redhat'):
+            _import_module('novaagent.libs.{0}'.format(name))
+
+    startup.report('Loaded at startup')
+    with ImportProfiler() as on_demand:
+        for name in ON_DEMAND_MODULES:
+            _import_module(name)
+
+    on_demand.report('Loaded on demand')
+
+
+if __name__ == '__main__':
+    main()
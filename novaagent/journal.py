@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+
+
+from novaagent.commands import REGISTRY
+
+
+from collections import deque
+
+
+import threading
+import logging
+import json
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+JOURNAL_PATH = '/var/lib/nova-agent/journal'
+
+
+# Number of completed events remembered, the file is compacted once it
+# holds twice as many lines
+MAX_ENTRIES = 1000
+
+
+class Journal(object):
+    """
+        Append-only record of the events the agent has run so an event
+        completed just before the agent died is answered from the journal
+        instead of being run a second time.
+
+        Each line is a JSON record written when an event starts and again
+        when it finishes. Start records are not synced, finish records are
+        synced before the result is written to xenstore and concurrent
+        finishes share a single fsync.
+    """
+    def __init__(self, path=JOURNAL_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.records = deque()
+        self.completed = {}
+        self.fd = None
+        self.lines = 0
+        self.written = 0
+        self.synced = 0
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0o700)
+
+        self._replay()
+        self.fd = os.open(
+            self.path,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o600
+        )
+        if self.lines > 2 * self.max_entries:
+            self._compact()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                self.lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partial line is left behind if the agent died
+                    # while appending
+                    log.warning('Skipping corrupt journal line')
+                    continue
+
+                if 'end' in record:
+                    self._remember(record)
+
+        log.info(
+            'Replayed {0} completed events from {1}'.format(
+                len(self.completed),
+                self.path
+            )
+        )
+
+    def _remember(self, record):
+        self.records.append(record)
+        for uuid in record['uuids']:
+            self.completed[uuid] = record
+
+        while len(self.records) > self.max_entries:
+            for uuid in self.records.popleft()['uuids']:
+                self.completed.pop(uuid, None)
+
+    def get_result(self, uuid):
+        """Return the result of an event that already completed or None"""
+        with self.lock:
+            record = self.completed.get(uuid)
+
+        if record is None:
+            return None
+
+        command = REGISTRY.get(record['command'])
+        if command is not None and not command.replay_result:
+            return None
+
+        return record['result']
+
+    def start(self, uuids, command):
+        """Record the start of an event and return its start time"""
+        start_time = time.time()
+        self._append(
+            {'uuids': uuids, 'command': command, 'start': start_time},
+            False
+        )
+        return start_time
+
+    def finish(self, uuids, command, start_time, result):
+        record = {
+            'uuids': uuids,
+            'command': command,
+            'start': start_time,
+            'end': time.time(),
+            'result': result
+        }
+        self._append(record, True)
+        with self.lock:
+            self._remember(record)
+            compact = self.lines > 2 * self.max_entries
+
+        if compact:
+            self._compact()
+
+    def _append(self, record, sync):
+        line = '{0}\n'.format(json.dumps(record)).encode('utf-8')
+        with self.lock:
+            os.write(self.fd, line)
+            self.lines += 1
+            self.written += 1
+            sequence = self.written
+
+        if sync:
+            self._sync(sequence)
+
+    def _sync(self, sequence):
+        with self.sync_lock:
+            if self.synced >= sequence:
+                return
+
+            with self.lock:
+                written = self.written
+
+            os.fsync(self.fd)
+            self.synced = written
+
+    def _compact(self):
+        """Rewrite the journal with only the completed events remembered"""
+        with self.sync_lock:
+            with self.lock:
+                tmpfile = '{0}.tmp'.format(self.path)
+                fd = os.open(
+                    tmpfile,
+                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                    0o600
+                )
+                try:
+                    for record in self.records:
+                        os.write(
+                            fd,
+                            '{0}\n'.format(json.dumps(record)).encode('utf-8')
+                        )
+
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+                os.rename(tmpfile, self.path)
+                os.close(self.fd)
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+                self.lines = len(self.records)
+                self.synced = self.written
+
+        log.info('Compacted journal to {0} events'.format(self.lines))
@@ -2,38 +2,141 @@
 from __future__ import absolute_import
 
 
+from novaagent.netconfig import parse_interface
+from novaagent.netconfig import NetworkConfigError
+from novaagent.commands import REGISTRY
+from novaagent import utils
+
+
+import logging
 import novaagent
+import time
 
 
-from novaagent.common.password import PasswordCommands
-from novaagent.common.file_inject import FileInject
+log = logging.getLogger(__name__)
 
 
 class DefaultOS(object):
-    def keyinit(self, name, value, client):
+    # Keyword arguments for PasswordCommands, set from the command line
+    password_options = {}
+
+    # How resetnetwork brings changed interfaces up, 'scripts' cycles them
+    # with the tools of the distribution and 'netlink' programs the kernel
+    # directly. Set from the command line
+    network_engine = 'scripts'
+
+    def _get_interfaces(self, vm_data):
+        """
+            Match the interfaces of this guest to their configuration in
+            vm-data, returns a dict of interface name to netconfig.Interface.
+            Raises NetworkConfigError when any configuration is invalid
+        """
+        ifaces = {}
+        for ifname in utils.list_hw_interfaces():
+            mac = utils.get_hw_addr(ifname)
+            if not mac or mac not in vm_data.mac_addresses:
+                continue
+
+            try:
+                ifaces[ifname] = parse_interface(vm_data.get_interface(mac))
+            except NetworkConfigError as e:
+                raise NetworkConfigError('{0}: {1}'.format(ifname, e))
+
+        return ifaces
+
+    def _interface_in_sync(self, ifname, iface):
+        """
+            Whether the kernel already runs the interface as configured, so
+            an unchanged configuration does not need it restarted. The link
+            has to be up with exactly the configured addresses, gateways and
+            routes, an interface that cannot be read is not in sync
+        """
+        if not utils.interface_is_up(ifname):
+            return False
+
+        from novaagent import netlink
+        try:
+            with netlink.NetlinkSocket() as nl:
+                return netlink.interface_in_sync(nl, ifname, iface)
+        except netlink.NetlinkError as e:
+            log.warning(
+                'Unable to compare {0} with the kernel: {1}'.format(
+                    ifname,
+                    str(e)
+                )
+            )
+            return False
+
+    def _apply_netlink(self, ifnames, ifaces):
+        """
+            Apply the interfaces over netlink, returns how long each one
+            took or None if any failed and the scripts have to be used
+        """
+        # Netlink does not reach the resolver, the scripts hand the DNS
+        # servers to it when they bring the interfaces up
+        nameservers = utils.get_nameservers()
+        missing = [
+            str(dns)
+            for ifname in ifnames
+            for dns in ifaces[ifname].dns
+            if str(dns) not in nameservers
+        ]
+        if missing:
+            log.info(
+                'DNS servers {0} are not in use, netlink cannot apply '
+                'them'.format(', '.join(missing))
+            )
+            return None
+
+        from novaagent import netlink
+        timings = []
+        try:
+            with netlink.NetlinkSocket() as nl:
+                for ifname in ifnames:
+                    start = time.time()
+                    netlink.apply_interface(nl, ifname, ifaces[ifname])
+                    timings.append(
+                        '{0}: {1:.2f}s'.format(ifname, time.time() - start)
+                    )
+        except netlink.NetlinkError as e:
+            log.error('Unable to apply over netlink: {0}'.format(str(e)))
+            return None
+
+        return ', '.join(timings)
+
+    def start_password_commands(self):
+        """
+            Create the password commands when the agent starts, so the
+            keypair pool is filled before the first keyinit arrives
+        """
+        self._password_commands()
+
+    def _password_commands(self):
+        # Imported on first use when the agent runs without a keypair pool
         if not hasattr(self, 'p'):
-            self.p = PasswordCommands()
+            from novaagent.common.password import PasswordCommands
+            self.p = PasswordCommands(**self.password_options)
+
+        return self.p
 
-        return self.p.keyinit_cmd(value)
+    def keyinit(self, name, value, client):
+        return self._password_commands().keyinit_cmd(value)
 
     def password(self, name, value, client):
-        if not hasattr(self, 'p'):
-            self.p = PasswordCommands()
+        return self._password_commands().password_cmd(value)
 
-        return self.p.password_cmd(value)
+    def batchpassword(self, name, value, client):
+        return self._password_commands().batch_password_cmd(value)
 
     def injectfile(self, name, value, client):
         if not hasattr(self, 'f'):
+            from novaagent.common.file_inject import FileInject
             self.f = FileInject()
 
         return self.f.injectfile_cmd(value)
 
     def features(self, name, value, client):
-        return (
-            '0',
-            'kmsactivate,resetnetwork,version,keyinit,'
-            'features,password,agentupdate,injectfile'
-        )
+        return ('0', ','.join(REGISTRY.supported(self)))
 
     def version(self, name, value, client):
         return ('0', str(novaagent.__version__))
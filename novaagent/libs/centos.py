@@ -3,6 +3,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 
+import logging
 import os
 
 
@@ -11,9 +12,13 @@ from subprocess import PIPE
 
 
 from novaagent import utils
+from novaagent.netconfig import NetworkConfigError
 from novaagent.libs import DefaultOS
 
 
+log = logging.getLogger(__name__)
+
+
 class ServerOS(DefaultOS):
     def __init__(self):
         self.netconfig_dir = '/etc/sysconfig/network-scripts'
@@ -22,102 +27,80 @@ class ServerOS(DefaultOS):
         self.hostname_file = '/etc/hostname'
         self.network_file = '/etc/sysconfig/network'
 
-    def _setup_interface(self, ifname, iface):
-        interface_file = '{0}/{1}-{2}'.format(
-            self.netconfig_dir,
-            self.interface_file_prefix,
-            ifname
-        )
-        utils.backup_file(interface_file)
-        with open(interface_file, 'w') as iffile:
-            iffile.write('# Automatically generated, do not edit\n\n')
-            iffile.write('# Label {0}\n'.format(iface['label']))
-            iffile.write('BOOTPROTO=static\n')
-            iffile.write('DEVICE={0}\n'.format(ifname))
-            for count, ip_info in enumerate(iface['ips']):
-                if count == 0:
-                    iffile.write('IPADDR={0}\n'.format(ip_info['ip']))
-                    iffile.write('NETMASK={0}\n'.format(ip_info['netmask']))
-                else:
-                    iffile.write(
-                        'IPADDR{0}={1}\n'.format(
-                            count,
-                            ip_info['ip']
-                        )
-                    )
-                    iffile.write(
-                        'NETMASK{0}={1}\n'.format(
-                            count,
-                            ip_info['netmask']
-                        )
+    def _render_interface(self, ifname, iface):
+        lines = [
+            '# Automatically generated, do not edit\n\n',
+            '# Label {0}\n'.format(iface.label),
+            'BOOTPROTO=static\n',
+            'DEVICE={0}\n'.format(ifname)
+        ]
+        for count, address in enumerate(iface.ips):
+            suffix = count if count > 0 else ''
+            lines.append('IPADDR{0}={1}\n'.format(suffix, address.ip))
+            lines.append('NETMASK{0}={1}\n'.format(suffix, address.netmask))
+
+        if iface.gateway is not None:
+            lines.append('GATEWAY={0}\n'.format(iface.gateway))
+
+        if iface.ip6s:
+            lines.append('IPV6INIT=yes\n')
+            for count, address in enumerate(iface.ip6s):
+                lines.append(
+                    'IPV6ADDR{0}={1}\n'.format(
+                        count if count > 0 else '',
+                        address.with_prefixlen
                     )
+                )
 
-            if 'gateway' in iface and iface['gateway']:
-                iffile.write('GATEWAY={0}\n'.format(iface['gateway']))
-
-            if 'ip6s' in iface and iface['ip6s']:
-                iffile.write('IPV6INIT=yes\n')
-                for count, ip6_info in enumerate(iface['ip6s']):
-                    if count == 0:
-                        iffile.write(
-                            'IPV6ADDR={0}/{1}\n'.format(
-                                ip6_info['ip'],
-                                ip6_info['netmask']
-                            )
-                        )
-                    else:
-                        iffile.write(
-                            'IPV6ADDR{0}={1}/{2}\n'.format(
-                                count,
-                                ip6_info['ip'],
-                                ip6_info['netmask']
-                            )
-                        )
-
-                iffile.write(
+            if iface.gateway_v6 is not None:
+                lines.append(
                     'IPV6_DEFAULTGW={0}%{1}\n'.format(
-                        iface['gateway_v6'],
+                        iface.gateway_v6,
                         ifname
                     )
                 )
 
-            if 'dns' in iface and iface['dns']:
-                for count, dns in enumerate(iface['dns']):
-                    iffile.write('DNS{0}={1}\n'.format(count + 1, dns))
+        for count, dns in enumerate(iface.dns):
+            lines.append('DNS{0}={1}\n'.format(count + 1, dns))
+
+        lines.append('ONBOOT=yes\n')
+        lines.append('NM_CONTROLLED=no\n')
+        return ''.join(lines)
+
+    def _setup_interface(self, ifname, iface):
+        """Write the ifcfg file, returns True if it changed"""
+        interface_file = '{0}/{1}-{2}'.format(
+            self.netconfig_dir,
+            self.interface_file_prefix,
+            ifname
+        )
+        return utils.update_file(
+            interface_file,
+            self._render_interface(ifname, iface)
+        )
+
+    def _render_routes(self, iface):
+        lines = []
+        for count, route in enumerate(iface.routes):
+            lines.append('ADDRESS{0}={1}\n'.format(count, route.route))
+            lines.append('NETMASK{0}={1}\n'.format(count, route.netmask))
+            lines.append('GATEWAY{0}={1}\n'.format(count, route.gateway))
 
-            iffile.write('ONBOOT=yes\n')
-            iffile.write('NM_CONTROLLED=no\n')
+        return ''.join(lines)
 
     def _setup_routes(self, ifname, iface):
+        """Write the route file, returns True if it changed"""
         route_file = '{0}/{1}-{2}'.format(
             self.netconfig_dir,
             self.route_file_prefix,
             ifname
         )
-        utils.backup_file(route_file)
-        with open(route_file, 'w') as routefile:
-            for count, route in enumerate(iface['routes']):
-                routefile.write(
-                    'ADDRESS{0}={1}\n'.format(
-                        count,
-                        route['route']
-                    )
-                )
-                routefile.write(
-                    'NETMASK{0}={1}\n'.format(
-                        count,
-                        route['netmask']
-                    )
-                )
-                routefile.write(
-                    'GATEWAY{0}={1}\n'.format(
-                        count,
-                        route['gateway']
-                    )
-                )
+        return utils.update_file(route_file, self._render_routes(iface))
+
+    def _setup_hostname(self, client, hostname=None):
+        if hostname is None:
+            hostname = utils.get_hostname(client)
 
-    def _setup_hostname(self, client):
-        hostname = utils.get_hostname(client)
         if os.path.exists('/usr/bin/hostnamectl'):
             utils.backup_file(self.hostname_file)
             p = Popen(
@@ -139,28 +122,31 @@ class ServerOS(DefaultOS):
         return p.returncode, hostname
 
     def resetnetwork(self, name, value, client):
-        ifaces = {}
-        hostname_return_code, hostname = self._setup_hostname(client)
+        vm_data = utils.snapshot_vm_data(client)
+        try:
+            ifaces = self._get_interfaces(vm_data)
+        except NetworkConfigError as e:
+            log.error('Invalid network configuration: {0}'.format(str(e)))
+            return ('500', 'Invalid network configuration: {0}'.format(e))
+
+        hostname_return_code, hostname = self._setup_hostname(
+            client,
+            vm_data.hostname
+        )
         if hostname_return_code != 0:
             return (str(hostname_return_code), 'Error setting hostname')
 
-        xen_macs = utils.list_xenstore_macaddrs(client)
-        for iface in utils.list_hw_interfaces():
-            mac = utils.get_hw_addr(iface)
-
-            if not mac or mac not in xen_macs:
-                continue
-
-            ifaces[iface] = utils.get_interface(mac, client)
-
-        utils.backup_file(self.network_file)
-        with open(self.network_file, 'w') as netfile:
-            netfile.write('NETWORKING=yes\n')
-            netfile.write('NOZEROCONF=yes\n')
-            netfile.write('NETWORKING_IPV6=yes\n')
-            netfile.write('HOSTNAME={0}\n'.format(hostname))
+        network_changed = utils.update_file(
+            self.network_file,
+            'NETWORKING=yes\n'
+            'NOZEROCONF=yes\n'
+            'NETWORKING_IPV6=yes\n'
+            'HOSTNAME={0}\n'.format(hostname)
+        )
 
-        # move unused interface files out of the way but back them up
+        # move unused interface files out of the way but back them up, they
+        # belong to interfaces the kernel no longer has so nothing is running
+        # from them and nothing needs a restart
         move_files = utils.get_ifcfg_files_to_remove(
             self.netconfig_dir,
             '{0}-'.format(self.interface_file_prefix)
@@ -168,12 +154,82 @@ class ServerOS(DefaultOS):
         for interface_config in move_files:
             utils.move_file(interface_config)
 
-        # setup interface files
-        for ifname, iface in ifaces.items():
-            self._setup_interface(ifname, iface)
-            if 'routes' in iface:
-                self._setup_routes(ifname, iface)
+        # setup interface files, only the interfaces whose files changed or
+        # that the kernel no longer runs as configured need a restart
+        changed = []
+        for ifname, iface in sorted(ifaces.items()):
+            interface_changed = self._setup_interface(ifname, iface)
+            if iface.routes is not None:
+                interface_changed = (
+                    self._setup_routes(ifname, iface) or interface_changed
+                )
+
+            if interface_changed or not self._interface_in_sync(
+                ifname,
+                iface
+            ):
+                changed.append(ifname)
+
+        # The network file holds settings the network service applies to
+        # every interface, cycling only the changed ones would leave the
+        # rest running with the old file
+        if network_changed:
+            log.info('Network file changed, restarting the network service')
+            return self._restart_network()
+
+        if not changed:
+            log.info('Network configuration is unchanged')
+            return ('0', '')
+
+        if self.network_engine == 'netlink':
+            timings = self._apply_netlink(changed, ifaces)
+            if timings is not None:
+                return ('0', timings)
+
+            log.error(
+                'Falling back to the network scripts, which restore the '
+                'interfaces in full from their files'
+            )
+
+        log.info('Restarting interfaces {0}'.format(', '.join(changed)))
+        results = utils.run_parallel(self._restart_interface, changed)
+        if all(result is True for result in results.values()):
+            return ('0', '')
+
+        log.error(
+            'Restarting interfaces failed, restarting the network service'
+        )
+        return self._restart_network()
+
+    def _restart_interface(self, ifname):
+        """ifdown and ifup one interface, returns True if it came up"""
+        p = Popen(
+            ['ifdown', ifname],
+            stdout=PIPE,
+            stderr=PIPE,
+            stdin=PIPE
+        )
+        out, err = p.communicate()
+        if p.returncode != 0:
+            # The interface may not have been up, ifup decides the outcome
+            log.warning(
+                'ifdown {0} returned {1}'.format(ifname, p.returncode)
+            )
+
+        p = Popen(
+            ['ifup', ifname],
+            stdout=PIPE,
+            stderr=PIPE,
+            stdin=PIPE
+        )
+        out, err = p.communicate()
+        if p.returncode != 0:
+            log.error('ifup {0} returned {1}'.format(ifname, p.returncode))
+            return False
+
+        return True
 
+    def _restart_network(self):
         if os.path.exists('/usr/bin/systemctl'):
             p = Popen(
                 ['systemctl', 'restart', 'network.service'],
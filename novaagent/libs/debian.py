@@ -3,7 +3,9 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 
+import logging
 import time
+import re
 import os
 
 
@@ -12,26 +14,39 @@ from subprocess import Popen
 
 
 from novaagent import utils
+from novaagent.netconfig import NetworkConfigError
 from novaagent.libs import DefaultOS
 
 
+log = logging.getLogger(__name__)
+
+
+LOOPBACK_CONFIG = (
+    '# The loopback network interface\n'
+    'auto lo\n'
+    'iface lo inet loopback\n\n'
+)
+
+
+# Interfaces cycled at once by resetnetwork and how long to wait for the
+# link to go down after ifdown and to come up after ifup
+MAX_PARALLEL_INTERFACES = 4
+LINK_DOWN_TIMEOUT = 5
+LINK_UP_TIMEOUT = 10
+
+
 class ServerOS(DefaultOS):
     def __init__(self):
         self.netconfig_file = '/etc/network/interfaces'
         self.hostname_file = '/etc/hostname'
 
-    def _setup_loopback(self):
-        utils.backup_file(self.netconfig_file)
-        with open(self.netconfig_file, 'w') as iffile:
-            iffile.write('# The loopback network interface\n')
-            iffile.write('auto lo\n')
-            iffile.write('iface lo inet loopback\n\n')
-
-    def _setup_hostname(self, client):
+    def _setup_hostname(self, client, hostname=None):
         """
         hostnamectl is available in some Debian systems and depends on dbus
         """
-        hostname = utils.get_hostname(client)
+        if hostname is None:
+            hostname = utils.get_hostname(client)
+
         if os.path.exists('/usr/bin/hostnamectl'):
             utils.backup_file(self.hostname_file)
             p = Popen(
@@ -52,142 +67,216 @@ class ServerOS(DefaultOS):
 
         return p.returncode, hostname
 
-    def _setup_interface(self, ifname, iface):
-        with open(self.netconfig_file, 'a') as iffile:
-            iffile.write('# Label {0}\n'.format(iface['label']))
-            for count, x in enumerate(iface['ips']):
-                if count == 0:
-                    iffile.write('\nauto {0}\n'.format(ifname))
-                    iffile.write('iface {0} inet static\n'.format(ifname))
-                    iffile.write('\taddress {0}\n'.format(x['ip']))
-                    iffile.write('\tnetmask {0}\n'.format(x['netmask']))
-                    if 'gateway' in iface and iface['gateway']:
-                        iffile.write(
-                            '\tgateway {0}\n'.format(
-                                iface['gateway']
-                            )
+    def _render_interface(self, ifname, iface):
+        lines = ['# Label {0}\n'.format(iface.label)]
+        for count, address in enumerate(iface.ips):
+            if count == 0:
+                lines.append('\nauto {0}\n'.format(ifname))
+                lines.append('iface {0} inet static\n'.format(ifname))
+                lines.append('\taddress {0}\n'.format(address.ip))
+                lines.append('\tnetmask {0}\n'.format(address.netmask))
+                if iface.gateway is not None:
+                    lines.append('\tgateway {0}\n'.format(iface.gateway))
+
+                if iface.dns:
+                    lines.append(
+                        '\tdns-nameservers {0}\n'.format(
+                            ' '.join(str(dns) for dns in iface.dns)
                         )
+                    )
 
-                    if 'dns' in iface and iface['dns']:
-                        iffile.write(
-                            '\tdns-nameservers {0}\n'.format(
-                                ' '.join(iface['dns'])
+                for route in iface.routes or ():
+                    for hook in ('post-up', 'post-down'):
+                        lines.append(
+                            '\t{0} route add -net {1} netmask '
+                            '{2} gw {3} || true\n'.format(
+                                hook,
+                                route.route,
+                                route.netmask,
+                                route.gateway
                             )
                         )
 
-                    if 'routes' in iface:
-                        for route in iface['routes']:
-                            iffile.write(
-                                '\tpost-up route add -net {0} netmask '
-                                '{1} gw {2} || true\n'.format(
-                                    route['route'],
-                                    route['netmask'],
-                                    route['gateway']
-                                )
-                            )
-                            iffile.write(
-                                '\tpost-down route add -net {0} netmask '
-                                '{1} gw {2} || true\n'.format(
-                                    route['route'],
-                                    route['netmask'],
-                                    route['gateway']
-                                )
-                            )
+            else:
+                lines.append('\nauto {0}:{1}\n'.format(ifname, count))
+                lines.append(
+                    'iface {0}:{1} inet static\n'.format(
+                        ifname,
+                        count
+                    )
+                )
+                lines.append('\taddress {0}\n'.format(address.ip))
+                lines.append('\tnetmask {0}\n'.format(address.netmask))
 
-                else:
-                    iffile.write('\nauto {0}:{1}\n'.format(ifname, count))
-                    iffile.write(
-                        'iface {0}:{1} inet static\n'.format(
-                            ifname,
-                            count
-                        )
+        for count, address in enumerate(iface.ip6s):
+            if count == 0:
+                lines.append('\niface {0} inet6 static\n'.format(ifname))
+                lines.append('\taddress {0}\n'.format(address.ip))
+                lines.append(
+                    '\tnetmask {0}\n'.format(
+                        address.network.prefixlen
                     )
-                    iffile.write('\taddress {0}\n'.format(x['ip']))
-                    iffile.write('\tnetmask {0}\n'.format(x['netmask']))
-
-            if 'ip6s' in iface and iface['ip6s']:
-                for count, ip_info in enumerate(iface['ip6s']):
-                    if count == 0:
-                        iffile.write(
-                            '\niface {0} inet6 static\n'.format(ifname)
-                        )
-                        iffile.write('\taddress {0}\n'.format(ip_info['ip']))
-                        iffile.write(
-                            '\tnetmask {0}\n'.format(
-                                ip_info['netmask']
-                            )
-                        )
+                )
+                if iface.gateway_v6 is not None:
+                    lines.append('\tgateway {0}\n'.format(iface.gateway_v6))
 
-                        if 'gateway_v6' in iface and iface['gateway_v6']:
-                            iffile.write(
-                                '\tgateway {0}\n'.format(
-                                    iface['gateway_v6']
-                                )
-                            )
+            else:
+                lines.append(
+                    '\niface {0}:{1} inet6 static\n'.format(
+                        ifname,
+                        count
+                    )
+                )
+                lines.append('\taddress {0}\n'.format(address.ip))
+                lines.append(
+                    '\tnetmask {0}\n'.format(
+                        address.network.prefixlen
+                    )
+                )
 
-                    else:
-                        iffile.write(
-                            '\niface {0}:{1} inet6 static\n'.format(
-                                ifname,
-                                count
-                            )
-                        )
-                        iffile.write('\taddress {0}'.format(ip_info['ip']))
-                        iffile.write(
-                            '\tnetmask {0}\n'.format(
-                                ip_info['netmask']
-                            )
-                        )
+        lines.append('\n')
+        return ''.join(lines)
+
+    def _current_interfaces(self):
+        """
+            The stanzas of each interface in the interfaces file as it was
+            last written by the agent, by interface name
+        """
+        current = {}
+        contents = utils.read_file(self.netconfig_file) or ''
+        for stanza in re.findall(
+            r'(?ms)^# Label .*?(?=^# Label |\Z)',
+            contents
+        ):
+            match = re.search(r'(?m)^auto (\S+)$', stanza)
+            if match is not None:
+                current[match.group(1)] = stanza
 
-            iffile.write('\n')
+        return current
 
     def resetnetwork(self, name, value, client):
-        ifaces = {}
-        hostname_return_code, hostname = self._setup_hostname(client)
+        vm_data = utils.snapshot_vm_data(client)
+        try:
+            ifaces = self._get_interfaces(vm_data)
+        except NetworkConfigError as e:
+            log.error('Invalid network configuration: {0}'.format(str(e)))
+            return ('500', 'Invalid network configuration: {0}'.format(e))
+
+        hostname_return_code, hostname = self._setup_hostname(
+            client,
+            vm_data.hostname
+        )
         if hostname_return_code != 0:
             return (str(hostname_return_code), 'Error setting hostname')
 
-        xen_macs = utils.list_xenstore_macaddrs(client)
-        for iface in utils.list_hw_interfaces():
-            mac = utils.get_hw_addr(iface)
-            if not mac or mac not in xen_macs:
-                continue
+        # Setup interface file for all interfaces, only the interfaces whose
+        # stanza changed or that the kernel is not running as configured
+        # are restarted
+        current = self._current_interfaces()
+        stanzas = []
+        changed = []
+        for ifname, iface in sorted(ifaces.items()):
+            stanza = self._render_interface(ifname, iface)
+            stanzas.append(stanza)
+            if current.get(ifname) != stanza or not self._interface_in_sync(
+                ifname,
+                iface
+            ):
+                changed.append(ifname)
 
-            ifaces[iface] = utils.get_interface(mac, client)
+        utils.update_file(
+            self.netconfig_file,
+            LOOPBACK_CONFIG + ''.join(stanzas)
+        )
+        if not changed:
+            log.info('Network configuration is unchanged')
+            return ('0', '')
 
-        # Setup interface file for all interfaces
-        self._setup_loopback()
-        for ifname, iface in ifaces.items():
-            self._setup_interface(ifname, iface)
+        if self.network_engine == 'netlink':
+            timings = self._apply_netlink(changed, ifaces)
+            if timings is not None:
+                return ('0', timings)
 
-        # Loop through the interfaces and restart networking
-        for ifname in ifaces.keys():
-            p = Popen(
-                ['ifdown', ifname],
-                stdout=PIPE,
-                stderr=PIPE,
-                stdin=PIPE
+            log.error(
+                'Falling back to ifdown and ifup, which restore the '
+                'interfaces in full from their stanzas'
             )
-            out, err = p.communicate()
-            if p.returncode != 0:
-                return (
-                    str(p.returncode),
-                    'Error stopping network: {0}'.format(ifname)
+
+        # Cycle the changed interfaces, a few at a time
+        results = utils.run_parallel(
+            self._cycle_interface,
+            changed,
+            MAX_PARALLEL_INTERFACES
+        )
+        # Collect every interface before replying, so a failure does not
+        # hide how the interfaces after it went
+        timings = []
+        failures = []
+        for ifname in changed:
+            result = results[ifname]
+            if isinstance(result, Exception):
+                failures.append(
+                    ('1', 'Error restarting network: {0}'.format(ifname))
                 )
+                continue
 
-            # Sleep for one second
-            time.sleep(1)
-            p = Popen(
-                ['ifup', ifname],
-                stdout=PIPE,
-                stderr=PIPE,
-                stdin=PIPE
+            returncode, message, seconds = result
+            if returncode != 0:
+                failures.append((str(returncode), message))
+                continue
+
+            timings.append('{0}: {1:.2f}s'.format(ifname, seconds))
+
+        if failures:
+            for returncode, message in failures:
+                log.error(message)
+
+            return (
+                failures[0][0],
+                ', '.join(message for returncode, message in failures)
             )
-            out, err = p.communicate()
-            if p.returncode != 0:
-                return (
-                    str(p.returncode),
-                    'Error starting network: {0}'.format(ifname)
-                )
 
-        return ('0', '')
+        return ('0', ', '.join(timings))
+
+    def _cycle_interface(self, ifname):
+        """
+            ifdown and ifup one interface, waiting on the link state rather
+            than a fixed delay. Returns the return code, the error message
+            and how long it took
+        """
+        start = time.time()
+        p = Popen(
+            ['ifdown', ifname],
+            stdout=PIPE,
+            stderr=PIPE,
+            stdin=PIPE
+        )
+        out, err = p.communicate()
+        if p.returncode != 0:
+            return (
+                p.returncode,
+                'Error stopping network: {0}'.format(ifname),
+                time.time() - start
+            )
+
+        if not utils.wait_for_link(ifname, False, LINK_DOWN_TIMEOUT):
+            log.warning('Link of {0} did not go down'.format(ifname))
+
+        p = Popen(
+            ['ifup', ifname],
+            stdout=PIPE,
+            stderr=PIPE,
+            stdin=PIPE
+        )
+        out, err = p.communicate()
+        if p.returncode != 0:
+            return (
+                p.returncode,
+                'Error starting network: {0}'.format(ifname),
+                time.time() - start
+            )
+
+        if not utils.wait_for_link(ifname, True, LINK_UP_TIMEOUT):
+            log.warning('Link of {0} did not come up'.format(ifname))
+
+        return 0, '', time.time() - start
@@ -0,0 +1,158 @@
+
+from __future__ import absolute_import
+
+
+import ipaddress
+
+
+class NetworkConfigError(ValueError):
+    """The network configuration from vm-data cannot be applied"""
+    pass
+
+
+class Route(object):
+    __slots__ = ('network', 'gateway')
+
+    def __init__(self, network, gateway):
+        self.network = network
+        self.gateway = gateway
+
+    @property
+    def route(self):
+        return self.network.network_address
+
+    @property
+    def netmask(self):
+        return self.network.netmask
+
+
+class Interface(object):
+    """
+        Configuration of one interface from vm-data
+
+        ips and ip6s hold ipaddress interfaces, gateway, gateway_v6 and the
+        dns servers are addresses or None. routes is None when vm-data has
+        no routes for the interface, which is not the same as an empty list
+        for the distributions that write a route file
+    """
+    __slots__ = (
+        'mac',
+        'label',
+        'ips',
+        'ip6s',
+        'gateway',
+        'gateway_v6',
+        'dns',
+        'routes'
+    )
+
+    def __init__(
+        self,
+        mac,
+        label,
+        ips=(),
+        ip6s=(),
+        gateway=None,
+        gateway_v6=None,
+        dns=(),
+        routes=None
+    ):
+        self.mac = mac
+        self.label = label
+        self.ips = list(ips)
+        self.ip6s = list(ip6s)
+        self.gateway = gateway
+        self.gateway_v6 = gateway_v6
+        self.dns = list(dns)
+        self.routes = routes
+
+
+def _text(value):
+    # The ipaddress backport only accepts unicode
+    return u'{0}'.format(value)
+
+
+def _list(data, key, required=False):
+    value = data.get(key)
+    if value is None and not required:
+        return []
+
+    if not isinstance(value, list):
+        raise NetworkConfigError('{0} is not a list'.format(key))
+
+    return value
+
+
+def _address(value, key):
+    try:
+        return ipaddress.ip_address(_text(value))
+    except ValueError as e:
+        raise NetworkConfigError('Invalid {0}: {1}'.format(key, e))
+
+
+def _ip_interface(info, key, version):
+    try:
+        address = ipaddress.ip_interface(
+            u'{0}/{1}'.format(_text(info['ip']), _text(info['netmask']))
+        )
+    except (KeyError, TypeError) as e:
+        raise NetworkConfigError('{0} entry without {1}'.format(key, e))
+    except ValueError as e:
+        raise NetworkConfigError('Invalid {0}: {1}'.format(key, e))
+
+    if address.version != version:
+        raise NetworkConfigError(
+            'Invalid {0}: {1} is not IPv{2}'.format(key, address, version)
+        )
+
+    return address
+
+
+def _route(info):
+    try:
+        network = ipaddress.IPv4Network(
+            u'{0}/{1}'.format(_text(info['route']), _text(info['netmask'])),
+            strict=False
+        )
+        gateway = ipaddress.IPv4Address(_text(info['gateway']))
+    except (KeyError, TypeError) as e:
+        raise NetworkConfigError('routes entry without {0}'.format(e))
+    except ValueError as e:
+        raise NetworkConfigError('Invalid routes: {0}'.format(e))
+
+    return Route(network, gateway)
+
+
+def parse_interface(data):
+    """
+        Build an Interface from the vm-data of one interface, everything is
+        checked here so a bad payload is rejected before anything changes
+    """
+    if not isinstance(data, dict):
+        raise NetworkConfigError('Interface is not an object')
+
+    if 'label' not in data:
+        raise NetworkConfigError('Interface without label')
+
+    gateway = None
+    if data.get('gateway'):
+        gateway = _address(data['gateway'], 'gateway')
+
+    gateway_v6 = None
+    if data.get('gateway_v6'):
+        gateway_v6 = _address(data['gateway_v6'], 'gateway_v6')
+
+    routes = None
+    if 'routes' in data:
+        routes = [_route(info) for info in _list(data, 'routes', True)]
+
+    return Interface(
+        data.get('mac'),
+        data['label'],
+        [_ip_interface(info, 'ips', 4) for info in _list(data, 'ips', True)],
+        [_ip_interface(info, 'ip6s', 6) for info in _list(data, 'ip6s')],
+        gateway,
+        gateway_v6,
+        [_address(dns, 'dns') for dns in _list(data, 'dns')],
+        routes
+    )
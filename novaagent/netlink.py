@@ -0,0 +1,537 @@
+"""
+Apply the configuration of an interface straight to the kernel over an
+rtnetlink socket instead of cycling it with ifdown and ifup.
+
+Only the kernel state is changed here, the distribution files are still
+written by resetnetwork so the configuration survives a reboot. rtnetlink
+has no transactions, every interface is sent as one batch of requests that
+the kernel handles in order and every request is checked for its ack.
+"""
+from __future__ import absolute_import
+
+
+import ipaddress
+import logging
+import socket
+import struct
+import fcntl
+import errno
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+NETLINK_ROUTE = 0
+
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+
+
+IFF_UP = 0x1
+
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RTPROT_STATIC = 4
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+
+
+NLMSG_HEADER = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBi')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+
+
+# Seconds to wait for the kernel to answer a request
+SOCKET_TIMEOUT = 5
+
+
+# Deleting something the kernel already removed on its own, like a route
+# through an address deleted earlier in the batch, is not an error
+DELETE_ERRORS = (errno.ENOENT, errno.ESRCH, errno.EADDRNOTAVAIL)
+
+
+class NetlinkError(Exception):
+    pass
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attr(attr_type, data):
+    length = RTATTR.size + len(data)
+    return (
+        RTATTR.pack(length, attr_type) +
+        data +
+        b'\0' * (_align(length) - length)
+    )
+
+
+def _parse_attrs(data):
+    attrs = {}
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+
+    return attrs
+
+
+def _parse_messages(data):
+    """Yield the type, sequence number and payload of every message"""
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, msg_type, flags, seq, pid = NLMSG_HEADER.unpack_from(
+            data,
+            offset
+        )
+        if length < NLMSG_HEADER.size:
+            break
+
+        yield msg_type, seq, data[offset + NLMSG_HEADER.size:offset + length]
+        offset += _align(length)
+
+
+def _family(address):
+    return socket.AF_INET if address.version == 4 else socket.AF_INET6
+
+
+class Request(object):
+    """One request of a batch, errors listed in ignore count as success"""
+    __slots__ = ('msg_type', 'flags', 'payload', 'description', 'ignore')
+
+    def __init__(self, msg_type, flags, payload, description, ignore=()):
+        self.msg_type = msg_type
+        self.flags = flags
+        self.payload = payload
+        self.description = description
+        self.ignore = ignore
+
+
+class NetlinkSocket(object):
+    def __init__(self):
+        self.seq = 0
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK,
+                socket.SOCK_RAW,
+                NETLINK_ROUTE
+            )
+            self.sock.settimeout(SOCKET_TIMEOUT)
+            self.sock.bind((0, 0))
+        except (AttributeError, socket.error) as e:
+            raise NetlinkError('Unable to open netlink socket: {0}'.format(e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def _send(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            raise NetlinkError('Unable to send to netlink: {0}'.format(e))
+
+    def _recv(self):
+        try:
+            return self.sock.recv(65536)
+        except socket.timeout:
+            raise NetlinkError('Timed out waiting for netlink')
+        except socket.error as e:
+            raise NetlinkError('Unable to read from netlink: {0}'.format(e))
+
+    def _message(self, seq, msg_type, flags, payload):
+        return NLMSG_HEADER.pack(
+            NLMSG_HEADER.size + len(payload),
+            msg_type,
+            flags | NLM_F_REQUEST,
+            seq,
+            0
+        ) + payload
+
+    def dump(self, msg_type, payload):
+        """Returns the type and payload of every object the kernel dumps"""
+        seq = self._next_seq()
+        self._send(self._message(seq, msg_type, NLM_F_DUMP, payload))
+        results = []
+        while True:
+            for reply_type, reply_seq, reply in _parse_messages(self._recv()):
+                if reply_seq != seq:
+                    continue
+
+                if reply_type == NLMSG_DONE:
+                    return results
+
+                if reply_type == NLMSG_ERROR:
+                    error = -struct.unpack_from('=i', reply)[0]
+                    raise NetlinkError(
+                        'Dump failed: {0}'.format(os.strerror(error))
+                    )
+
+                results.append((reply_type, reply))
+
+    def batch(self, requests):
+        """
+            Send the requests in one write and wait for the ack of each,
+            returns the description and error of every request that failed
+        """
+        pending = {}
+        data = []
+        for request in requests:
+            seq = self._next_seq()
+            pending[seq] = request
+            data.append(
+                self._message(
+                    seq,
+                    request.msg_type,
+                    request.flags | NLM_F_ACK,
+                    request.payload
+                )
+            )
+
+        self._send(b''.join(data))
+        failures = []
+        while pending:
+            for reply_type, reply_seq, reply in _parse_messages(self._recv()):
+                if reply_type != NLMSG_ERROR or reply_seq not in pending:
+                    continue
+
+                request = pending.pop(reply_seq)
+                error = -struct.unpack_from('=i', reply)[0]
+                if error and error not in request.ignore:
+                    failures.append(
+                        (request.description, os.strerror(error))
+                    )
+
+        return failures
+
+
+def interface_index(ifname):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        bin_ifname = bytes(ifname[:15])
+    except TypeError:
+        bin_ifname = bytes(ifname[:15], 'utf-8')
+
+    try:
+        # SIOCGIFINDEX
+        info = fcntl.ioctl(
+            s.fileno(),
+            0x8933,
+            struct.pack('256s', bin_ifname)
+        )
+    except IOError:
+        raise NetlinkError('Interface {0} does not exist'.format(ifname))
+    finally:
+        s.close()
+
+    return struct.unpack_from('=i', info, 16)[0]
+
+
+def _current_addresses(nl, index):
+    """Addresses of the interface as (key, attributes, description)"""
+    addresses = []
+    for msg_type, payload in nl.dump(
+        RTM_GETADDR,
+        IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+    ):
+        family, prefixlen, flags, scope, ifindex = IFADDRMSG.unpack_from(
+            payload
+        )
+        # Link local and host addresses are left to the kernel
+        if ifindex != index or scope != RT_SCOPE_UNIVERSE:
+            continue
+
+        attrs = _parse_attrs(payload[IFADDRMSG.size:])
+        local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+        if local is None:
+            continue
+
+        addresses.append((
+            (family, local, prefixlen),
+            attrs,
+            '{0}/{1}'.format(socket.inet_ntop(family, local), prefixlen)
+        ))
+
+    return addresses
+
+
+def _current_routes(nl, index):
+    """
+        Routes of the interface that were added by ifup or this module as
+        (key, attributes, description), routes of the kernel and of
+        routing daemons are left alone
+    """
+    routes = []
+    for msg_type, payload in nl.dump(
+        RTM_GETROUTE,
+        RTMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0)
+    ):
+        (
+            family, dst_len, src_len, tos, table, protocol, scope, rtm_type,
+            flags
+        ) = RTMSG.unpack_from(payload)
+        attrs = _parse_attrs(payload[RTMSG.size:])
+        if RTA_TABLE in attrs:
+            table = struct.unpack('=I', attrs[RTA_TABLE])[0]
+
+        oif = attrs.get(RTA_OIF)
+        if (
+            oif is None or
+            struct.unpack('=i', oif)[0] != index or
+            table != RT_TABLE_MAIN or
+            rtm_type != RTN_UNICAST or
+            protocol not in (RTPROT_BOOT, RTPROT_STATIC)
+        ):
+            continue
+
+        dst = attrs.get(RTA_DST, b'')
+        gateway = attrs.get(RTA_GATEWAY, b'')
+        routes.append((
+            (family, dst, dst_len, gateway),
+            attrs,
+            '{0}/{1} via {2}'.format(
+                socket.inet_ntop(family, dst) if dst else 'default',
+                dst_len,
+                socket.inet_ntop(family, gateway) if gateway else 'link'
+            )
+        ))
+
+    return routes
+
+
+def _wanted_routes(iface):
+    """The routes of the interface as (network, gateway)"""
+    routes = []
+    if iface.gateway is not None:
+        routes.append((ipaddress.ip_network(u'0.0.0.0/0'), iface.gateway))
+
+    if iface.gateway_v6 is not None:
+        routes.append((ipaddress.ip_network(u'::/0'), iface.gateway_v6))
+
+    for route in iface.routes or []:
+        routes.append((route.network, route.gateway))
+
+    return routes
+
+
+def _route_keys(routes):
+    """Keys of the routes as _current_routes builds them"""
+    return set(
+        (
+            _family(network),
+            network.network_address.packed if network.prefixlen else b'',
+            network.prefixlen,
+            gateway.packed
+        ) for network, gateway in routes
+    )
+
+
+def _address_keys(addresses):
+    """Keys of the addresses as _current_addresses builds them"""
+    return set(
+        (_family(address), address.ip.packed, address.network.prefixlen)
+        for address in addresses
+    )
+
+
+def interface_in_sync(nl, ifname, iface):
+    """
+        Whether the kernel has exactly the addresses and routes of iface on
+        the interface, none of them missing and none stale
+    """
+    index = interface_index(ifname)
+    addresses = set(key for key, attrs, desc in _current_addresses(nl, index))
+    routes = set(key for key, attrs, desc in _current_routes(nl, index))
+    return (
+        addresses == _address_keys(iface.ips + iface.ip6s) and
+        routes == _route_keys(_wanted_routes(iface))
+    )
+
+
+def interface_requests(nl, ifname, iface):
+    """
+        Build the batch that makes the kernel state of the interface match
+        iface. The new addresses and routes are added before anything stale
+        is deleted, so a batch that fails part way leaves the wanted state
+        in place. Deleting a stale primary address takes the secondary
+        addresses of its subnet and the routes through it down with it, so
+        when any address is deleted the new ones are added once more after
+    """
+    index = interface_index(ifname)
+    routes = _wanted_routes(iface)
+    addresses = iface.ips + iface.ip6s
+
+    adds = []
+    for address in addresses:
+        payload = IFADDRMSG.pack(
+            _family(address),
+            address.network.prefixlen,
+            0,
+            RT_SCOPE_UNIVERSE,
+            index
+        ) + _attr(IFA_ADDRESS, address.ip.packed)
+        if address.version == 4:
+            payload += _attr(IFA_LOCAL, address.ip.packed)
+            if address.network.prefixlen < 31:
+                payload += _attr(
+                    IFA_BROADCAST,
+                    address.network.broadcast_address.packed
+                )
+
+        adds.append(
+            Request(
+                RTM_NEWADDR,
+                NLM_F_CREATE | NLM_F_REPLACE,
+                payload,
+                'add address {0}'.format(address.with_prefixlen)
+            )
+        )
+
+    for network, gateway in routes:
+        payload = RTMSG.pack(
+            _family(network),
+            network.prefixlen,
+            0,
+            0,
+            RT_TABLE_MAIN,
+            RTPROT_STATIC,
+            RT_SCOPE_UNIVERSE,
+            RTN_UNICAST,
+            0
+        )
+        if network.prefixlen:
+            payload += _attr(RTA_DST, network.network_address.packed)
+
+        payload += _attr(RTA_GATEWAY, gateway.packed)
+        payload += _attr(RTA_OIF, struct.pack('=i', index))
+        adds.append(
+            Request(
+                RTM_NEWROUTE,
+                NLM_F_CREATE | NLM_F_REPLACE,
+                payload,
+                'add route {0} via {1}'.format(network, gateway)
+            )
+        )
+
+    requests = [
+        Request(
+            RTM_NEWLINK,
+            0,
+            IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, IFF_UP, IFF_UP),
+            'link up'
+        )
+    ] + adds
+
+    wanted = _route_keys(routes)
+    for key, attrs, description in _current_routes(nl, index):
+        if key in wanted:
+            continue
+
+        family, dst, dst_len, gateway = key
+        payload = RTMSG.pack(
+            family, dst_len, 0, 0, RT_TABLE_MAIN, 0, RT_SCOPE_NOWHERE, 0, 0
+        )
+        for attr_type in (RTA_DST, RTA_GATEWAY, RTA_OIF, RTA_PRIORITY):
+            if attr_type in attrs:
+                payload += _attr(attr_type, attrs[attr_type])
+
+        requests.append(
+            Request(
+                RTM_DELROUTE,
+                0,
+                payload,
+                'delete route {0}'.format(description),
+                DELETE_ERRORS
+            )
+        )
+
+    wanted = _address_keys(addresses)
+    deleted = False
+    for key, attrs, description in _current_addresses(nl, index):
+        if key in wanted:
+            continue
+
+        family, local, prefixlen = key
+        payload = IFADDRMSG.pack(family, prefixlen, 0, 0, index)
+        for attr_type in (IFA_LOCAL, IFA_ADDRESS):
+            if attr_type in attrs:
+                payload += _attr(attr_type, attrs[attr_type])
+
+        requests.append(
+            Request(
+                RTM_DELADDR,
+                0,
+                payload,
+                'delete address {0}'.format(description),
+                DELETE_ERRORS
+            )
+        )
+        deleted = True
+
+    if deleted:
+        requests.extend(adds)
+
+    return requests
+
+
+def apply_interface(nl, ifname, iface):
+    """Apply iface to the kernel, raises NetlinkError if any request fails"""
+    failures = nl.batch(interface_requests(nl, ifname, iface))
+    if failures:
+        raise NetlinkError(
+            '{0}: {1}'.format(
+                ifname,
+                ', '.join(
+                    '{0} ({1})'.format(description, error)
+                    for description, error in failures
+                )
+            )
+        )
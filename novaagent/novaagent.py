@@ -3,6 +3,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 
+import subprocess
+import threading
 import argparse
 import logging
 import fcntl
@@ -12,82 +14,286 @@ import sys
 import os
 
 
-from pyxs.connection import XenBusConnection
-from pyxs.client import Client
-
-
-from novaagent.xenbus import XenGuestRouter
-from novaagent.libs import centos
-from novaagent.libs import debian
-from novaagent.libs import redhat
+from novaagent.dispatcher import coalesce_events
+from novaagent.commands import REGISTRY
+from novaagent.dispatcher import DEFAULT_WORKERS
+from novaagent.dispatcher import Dispatcher
+from novaagent.journal import JOURNAL_PATH
+from novaagent.journal import Journal
+from novaagent.xenstore.backends import ConnectionManager
 from novaagent import utils
 
 
 log = logging.getLogger(__name__)
 
 
-# Connect to Xenbus in order to interact with xenstore
-XENBUS_ROUTER = XenGuestRouter(XenBusConnection())
+# Upper bound in seconds between checks of data/host when waiting on the
+# xenstore watch, in case a watch event is ever lost
+WATCH_TIMEOUT = 30
+
+
+# Keypairs kept ready for keyinit, the same as the default of PasswordCommands
+DEFAULT_KEY_POOL_SIZE = 2
+
+
+def answer_events(uuids, result, client=None):
+    utils.answer_xen_events(uuids, result, client)
+    log.info(
+        'Returning {{"message": "{0}", "returncode": "{1}"}}'.format(
+            result['message'],
+            result['returncode']
+        )
+    )
+
 
+def run_command(command, server_os, uuids, event, client=None):
+    """
+        Run a command and return its (returncode, message). A command with
+        a timeout runs in a thread of its own and is reported as failed once
+        the timeout expires, the second value returned is then a function
+        that waits for the command to really finish and None otherwise.
+    """
+    if command.timeout is None:
+        return command.run(server_os, event['value'], client), None
 
-def action(server_os, client=None):
+    outcome = []
+
+    def target():
+        try:
+            outcome.append(
+                (command.run(server_os, event['value'], client), None)
+            )
+        except Exception as e:
+            outcome.append((None, e))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(command.timeout)
+    if not thread.is_alive():
+        command_return, error = outcome[0]
+        if error is not None:
+            raise error
+
+        return command_return, None
+
+    log.error(
+        'Event {0} timed out after {1} seconds'.format(
+            uuids[0],
+            command.timeout
+        )
+    )
+
+    def wait():
+        thread.join()
+        if outcome[0][1] is not None:
+            log.error(
+                'Exception was caught running event {0}: {1}'.format(
+                    uuids[0],
+                    str(outcome[0][1])
+                )
+            )
+
+    return (
+        ('500', 'Command timed out after {0} seconds'.format(command.timeout)),
+        wait
+    )
+
+
+def handle_event(server_os, uuids, event, client=None, journal=None):
+    """
+        Run an event once and answer every uuid that was coalesced into it
+        with the same result
+    """
+    start_time = None
+    if journal is not None:
+        try:
+            start_time = journal.start(uuids, event['name'])
+        except (IOError, OSError) as e:
+            log.error(
+                'Unable to journal the start of event {0}: {1}'.format(
+                    uuids[0],
+                    str(e)
+                )
+            )
+
+    command_return = ('', '')
+    wait = None
+    command = REGISTRY.get(event['name'])
+    if command is not None and command.is_supported(server_os):
+        try:
+            command_return, wait = run_command(
+                command,
+                server_os,
+                uuids,
+                event,
+                client
+            )
+        except Exception as e:
+            # Answer the event so it leaves data/host, otherwise the next
+            # scan of data/host would run the failing command again
+            log.error(
+                'Exception was caught running event {0}: {1}'.format(
+                    uuids[0],
+                    str(e)
+                )
+            )
+            command_return = ('500', str(e))
+
+    message = command_return[1]
+    return_code = command_return[0]
+    if command_return[0] == '':
+        return_code = '0'
+
+    result = {'message': message, 'returncode': return_code}
+    if journal is not None:
+        # The host is answered either way, an event left in data/host
+        # would be run again on every scan
+        try:
+            journal.finish(uuids, event['name'], start_time, result)
+        except (IOError, OSError) as e:
+            log.error(
+                'Unable to journal the result of event {0}: {1}'.format(
+                    uuids[0],
+                    str(e)
+                )
+            )
+
+    answer_events(uuids, result, client)
+    if wait is not None:
+        # The host has its answer but the command keeps its resources
+        # until it returns
+        wait()
+
+
+def action(server_os, client=None, dispatcher=None, journal=None):
+    """
+        Run every event waiting in data/host. Events the journal shows as
+        already completed are answered without running them again and
+        redundant events are coalesced. Without a dispatcher the events are
+        handled one at a time before returning, otherwise they are handed to
+        the dispatcher and events it is still working on are skipped.
+    """
+    events = []
     for uuid in utils.list_xen_events(client):
+        if dispatcher is not None and dispatcher.is_pending(uuid):
+            continue
+
+        if journal is not None:
+            result = journal.get_result(uuid)
+            if result is not None:
+                log.info('Event: {0} already completed'.format(uuid))
+                answer_events([uuid], result, client)
+                continue
+
+        # A worker may have answered and removed the event since the
+        # listing, or the host wrote something that is not an event
         event = utils.get_xen_event(uuid, client)
+        if not isinstance(event, dict) or 'name' not in event:
+            log.warning('Event: {0} skipped, no command to run'.format(uuid))
+            continue
+
         log.info('Event: {0} -> {1}'.format(uuid, event['name']))
-        command_return = ('', '')
-        if hasattr(server_os, event['name']):
-            run_command = getattr(server_os, event['name'])
-            command_return = run_command(event['name'], event['value'], client)
-
-        utils.remove_xenhost_event(uuid, client)
-        message = command_return[1]
-        return_code = command_return[0]
-        if command_return[0] == '':
-            return_code = '0'
-
-        utils.update_xenguest_event(
-            uuid,
-            {'message': message, 'returncode': return_code},
-            client
-        )
-        log.info(
-            'Returning {{"message": "{0}", "returncode": "{1}"}}'.format(
-                message,
-                return_code
+        events.append((uuid, event))
+
+    for uuids, event in coalesce_events(events):
+        if dispatcher is None:
+            handle_event(server_os, uuids, event, client, journal)
+        else:
+            dispatcher.submit(uuids, event)
+
+
+def create_dispatcher(server_os, client, workers, command_limits, journal):
+    def handler(uuids, event):
+        handle_event(server_os, uuids, event, client, journal)
+
+    dispatcher = Dispatcher(handler, workers, command_limits)
+    dispatcher.start()
+    return dispatcher
+
+
+def open_journal(journal_path):
+    if not journal_path:
+        log.info('Event journal is disabled')
+        return None
+
+    journal = Journal(journal_path)
+    try:
+        journal.open()
+    except (IOError, OSError) as e:
+        log.error(
+            'Unable to open journal {0}, continuing without it: {1}'.format(
+                journal_path,
+                str(e)
             )
         )
+        return None
+
+    return journal
 
 
-def nova_agent_listen(server_type, server_os):
+def nova_agent_listen(
+    server_type,
+    server_os,
+    workers=DEFAULT_WORKERS,
+    command_limits=None,
+    journal_path=JOURNAL_PATH
+):
     log.info('Setting lock on file')
     create_lock_file()
     log.info('Starting actions for {0}...'.format(server_type.__name__))
-    log.info('Checking for existence of /dev/xen/xenbus')
-    if os.path.exists('/dev/xen/xenbus'):
-        with Client(router=XENBUS_ROUTER) as xenbus_client:
-            while True:
-                action(server_os, client=xenbus_client)
-                time.sleep(1)
-    else:
+    journal = open_journal(journal_path)
+    backend = ConnectionManager()
+    with backend:
+        dispatcher = create_dispatcher(
+            server_os,
+            backend,
+            workers,
+            command_limits,
+            journal
+        )
+        monitor = utils.watch_xen_events(backend)
         while True:
-            action(server_os)
-            time.sleep(1)
+            try:
+                action(
+                    server_os,
+                    client=backend,
+                    dispatcher=dispatcher,
+                    journal=journal
+                )
+            except Exception as e:
+                # The next scan picks up whatever this one left behind
+                log.error(
+                    'Exception was caught scanning events: {0}'.format(str(e))
+                )
+
+            if monitor is None:
+                time.sleep(1)
+            else:
+                monitor.wait_event(WATCH_TIMEOUT)
 
 
 def get_server_type():
+    """Import only the module for the distribution of this guest"""
     server_type = None
     if (
         os.path.exists('/etc/centos-release') or
         os.path.exists('/etc/fedora-release') or
         os.path.exists('/etc/sl-release')
     ):
-        server_type = centos
+        server_type = 'centos'
     elif os.path.exists('/etc/redhat-release'):
-        server_type = redhat
+        server_type = 'redhat'
     elif os.path.exists('/etc/debian_version'):
-        server_type = debian
+        server_type = 'debian'
 
-    return server_type
+    if server_type is None:
+        return None
+
+    # importlib is not available on Python 2.6
+    name = 'novaagent.libs.{0}'.format(server_type)
+    __import__(name)
+    return sys.modules[name]
 
 
 def create_parser():
@@ -114,12 +320,123 @@ def create_parser():
         type=bool,
         help='Perform os.fork when starting agent'
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        dest='workers',
+        default=DEFAULT_WORKERS,
+        type=int,
+        help='number of events that can be handled at the same time'
+    )
+    parser.add_argument(
+        '--command-limit',
+        dest='command_limits',
+        default=[],
+        action='append',
+        type=str,
+        metavar='COMMAND=LIMIT',
+        help=(
+            'maximum number of a command that can run at the same time, '
+            'can be given more than once'
+        )
+    )
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        default=JOURNAL_PATH,
+        type=str,
+        help=(
+            'path to the journal of completed events, '
+            'an empty value disables it'
+        )
+    )
+    parser.add_argument(
+        '--password-scheme',
+        dest='password_scheme',
+        default=None,
+        choices=('md5', 'sha256', 'sha512'),
+        help=(
+            'hash new passwords with this scheme instead of the scheme of '
+            'the password being replaced'
+        )
+    )
+    parser.add_argument(
+        '--password-rounds',
+        dest='password_rounds',
+        default=None,
+        type=int,
+        help='rounds for sha256 and sha512 password hashes'
+    )
+    parser.add_argument(
+        '--key-pool-size',
+        dest='key_pool_size',
+        default=DEFAULT_KEY_POOL_SIZE,
+        type=int,
+        help=(
+            'number of keyinit keypairs generated ahead of time from '
+            'startup, 0 generates them when keyinit runs'
+        )
+    )
+    parser.add_argument(
+        '--network-engine',
+        dest='network_engine',
+        default='scripts',
+        choices=('scripts', 'netlink'),
+        help=(
+            'apply network changes with the scripts of the distribution or '
+            'directly over netlink, falling back to the scripts on failure'
+        )
+    )
+    parser.add_argument(
+        '--profile-imports',
+        dest='profile_imports',
+        default=False,
+        action='store_true',
+        help='print the time taken to import each module and exit'
+    )
     return parser
 
 
+def parse_command_limits(parser, command_limits):
+    limits = {}
+    for command_limit in command_limits:
+        try:
+            command, limit = command_limit.split('=', 1)
+            limits[command] = int(limit)
+            if limits[command] < 1:
+                raise ValueError(limit)
+        except ValueError:
+            parser.error(
+                'Invalid command limit {0}, expected COMMAND=LIMIT'.format(
+                    command_limit
+                )
+            )
+
+    return limits
+
+
 def main():
     parser = create_parser()
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('Number of workers must be at least 1')
+
+    command_limits = parse_command_limits(parser, args.command_limits)
+    if args.password_rounds is not None and not (
+        1000 <= args.password_rounds <= 999999999
+    ):
+        parser.error('Password rounds must be between 1000 and 999999999')
+
+    if args.key_pool_size < 0:
+        parser.error('Key pool size must not be negative')
+
+    if args.profile_imports:
+        # Run in a new interpreter so the modules this one already loaded
+        # are measured as well
+        sys.exit(
+            subprocess.call([sys.executable, '-m', 'novaagent.importprofile'])
+        )
+
     loglevel = getattr(logging, args.loglevel.upper())
     log_format = "%(asctime)s [%(levelname)-5.5s] %(message)s"
     if args.logfile == '-':
@@ -137,6 +454,12 @@ def main():
 
     server_type = get_server_type()
     server_os = server_type.ServerOS()
+    server_os.password_options = {
+        'hash_scheme': args.password_scheme,
+        'hash_rounds': args.password_rounds,
+        'key_pool_size': args.key_pool_size
+    }
+    server_os.network_engine = args.network_engine
     if args.no_fork is False:
         log.info('Starting daemon')
         try:
@@ -156,7 +479,17 @@ def main():
     else:
         log.info('Skipping os.fork as directed by arguments')
 
-    nova_agent_listen(server_type, server_os)
+    if args.key_pool_size > 0:
+        # After the fork as the thread filling the pool would not survive it
+        server_os.start_password_commands()
+
+    nova_agent_listen(
+        server_type,
+        server_os,
+        args.workers,
+        command_limits,
+        args.journal
+    )
 
 
 def create_lock_file():
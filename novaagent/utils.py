@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 
 
+from novaagent.xenstore.backends import get_backend
 from novaagent.xenstore import xenstore
 
 
@@ -9,7 +10,9 @@ import logging
 import socket
 import struct
 import shutil
+import threading
 import fcntl
+import copy
 import json
 import time
 import glob
@@ -19,11 +22,23 @@ import os
 log = logging.getLogger(__name__)
 
 
-try:
-    import netifaces
-    HAS_NETIFACES = True
-except ImportError as exc:
-    HAS_NETIFACES = False
+# netifaces is only needed when an interface cannot be looked up through
+# /sys or ioctl, it is imported the first time that happens
+netifaces = None
+HAS_NETIFACES = None
+
+
+def _load_netifaces():
+    global netifaces
+    global HAS_NETIFACES
+    if HAS_NETIFACES is None:
+        try:
+            import netifaces
+            HAS_NETIFACES = True
+        except ImportError:
+            HAS_NETIFACES = False
+
+    return HAS_NETIFACES
 
 
 # Why is this function and move_file both here as they do the same thing
@@ -37,6 +52,30 @@ def backup_file(config):
     shutil.copyfile(config, bakfile)
 
 
+def read_file(path):
+    """Return the contents of path, or None if it cannot be read"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def update_file(path, contents):
+    """
+        Back up and rewrite path only when contents differ from what is in
+        it. Returns True if the file was written
+    """
+    if read_file(path) == contents:
+        return False
+
+    backup_file(path)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+    return True
+
+
 def encode_to_bytes(data_string):
     try:
         return bytes(data_string)
@@ -101,7 +140,7 @@ def get_hw_addr(ifname):
 
         return hw_address
     except IOError:
-        if HAS_NETIFACES is False:
+        if _load_netifaces() is False:
             return False
 
         iface = netifaces.ifaddresses(ifname)
@@ -112,10 +151,110 @@ def get_hw_addr(ifname):
         return False
 
 
+def get_ipv4_addr(ifname):
+    """Primary IPv4 address of the interface, None if it has none"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        bin_ifname = bytes(ifname[:15])
+    except TypeError:
+        bin_ifname = bytes(ifname[:15], 'utf-8')
+
+    try:
+        # SIOCGIFADDR
+        info = fcntl.ioctl(
+            s.fileno(),
+            0x8915,
+            struct.pack('256s', bin_ifname)
+        )
+    except IOError:
+        return None
+    finally:
+        s.close()
+
+    return socket.inet_ntoa(info[20:24])
+
+
+def interface_is_up(ifname):
+    """
+        Whether the kernel reports the link as up. Drivers that do not
+        track the link state report unknown, which is taken as up
+    """
+    operstate = read_file('/sys/class/net/{0}/operstate'.format(ifname))
+    if operstate is None:
+        return False
+
+    return operstate.strip() in ('up', 'unknown')
+
+
+def get_nameservers(resolv_conf='/etc/resolv.conf'):
+    """The nameservers the resolver is using, in the order listed"""
+    nameservers = []
+    for line in (read_file(resolv_conf) or '').splitlines():
+        fields = line.split()
+        if len(fields) > 1 and fields[0] == 'nameserver':
+            nameservers.append(fields[1])
+
+    return nameservers
+
+
+def wait_for_link(ifname, up=True, timeout=10, interval=0.05):
+    """
+        Poll the link state from sysfs until the interface is up, or down
+        when up is False, returns whether it got there within timeout
+    """
+    deadline = time.time() + timeout
+    while interface_is_up(ifname) != up:
+        if time.time() >= deadline:
+            return False
+
+        time.sleep(interval)
+
+    return True
+
+
+def run_parallel(function, items, limit=None):
+    """
+        Call function with every item, each in a thread of its own with at
+        most limit running at once, and return a dict of item to result.
+        An exception raised by function is the result for its item
+    """
+    results = {}
+    semaphore = threading.Semaphore(limit or max(len(items), 1))
+
+    def run(item):
+        try:
+            results[item] = function(item)
+        except Exception as e:
+            log.error('Error running {0} for {1}: {2}'.format(
+                function.__name__,
+                item,
+                str(e)
+            ))
+            results[item] = e
+        finally:
+            semaphore.release()
+
+    threads = []
+    for item in items:
+        semaphore.acquire()
+        thread = threading.Thread(target=run, args=(item,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
 def list_hw_interfaces():
     if os.path.exists('/sys/class/net'):
         return os.listdir('/sys/class/net')
 
+    if _load_netifaces() is False:
+        return []
+
     return netifaces.interfaces()
 
 
@@ -147,6 +286,76 @@ def list_xenstore_macaddrs(client):
     return mac_addrs
 
 
+class VMDataSnapshot(object):
+    """
+        Read-only view of vm-data taken in one batch so a handler works from
+        a single copy even if the host rewrites vm-data while it runs.
+    """
+    __slots__ = ('_hostname', '_interfaces')
+
+    def __init__(self, values):
+        interfaces = {}
+        for key, value in values.items():
+            if not key.startswith('networking/') or key.count('/') != 1:
+                continue
+
+            mac_address = key.split('/', 1)[1]
+            try:
+                interfaces[mac_address] = json.loads(value)
+            except ValueError as e:
+                log.error(
+                    'Exception was caught parsing interface {0}: {1}'.format(
+                        mac_address,
+                        str(e)
+                    )
+                )
+
+        hostname = values.get('hostname') or socket.gethostname()
+        object.__setattr__(self, '_hostname', hostname)
+        object.__setattr__(self, '_interfaces', interfaces)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('vm-data snapshot is read-only')
+
+    @property
+    def hostname(self):
+        return self._hostname
+
+    @property
+    def mac_addresses(self):
+        return list(self._interfaces.keys())
+
+    def get_interface(self, mac_address):
+        return copy.deepcopy(self._interfaces.get(mac_address))
+
+
+# The parts of vm-data the handlers use, the rest holds metadata supplied
+# by the user which can be large
+VM_DATA_KEYS = (b'hostname', b'networking')
+
+
+def snapshot_vm_data(client):
+    values = {}
+    try:
+        values = xenstore.run_transaction(
+            lambda tx_client: xenstore.xenstore_snapshot(
+                b'vm-data',
+                tx_client,
+                VM_DATA_KEYS
+            ),
+            client
+        )
+    except Exception as e:
+        log.error(
+            'Exception was caught reading vm-data: {0}'.format(str(e))
+        )
+
+    snapshot = VMDataSnapshot(values)
+    log.info('hostname: {0}'.format(snapshot.hostname))
+    log.info('interfaces: {0}'.format(snapshot.mac_addresses))
+    return snapshot
+
+
 def get_hostname(client):
     xen_hostname = None
     try:
@@ -180,6 +389,27 @@ def list_xen_events(client):
     return message_uuids
 
 
+def watch_xen_events(client):
+    """
+        Register a xenstore watch on data/host so the agent can block until
+        the host writes a new event instead of polling for one.
+
+        Returns the monitor to wait on, or None if the watch could not be
+        registered and the caller should fall back to polling
+    """
+    try:
+        monitor = get_backend(client).watch(b'data/host', b'nova-agent')
+    except Exception as e:
+        log.warning(
+            'Unable to watch data/host, falling back to polling: {0}'.format(
+                str(e)
+            )
+        )
+        return None
+
+    return monitor
+
+
 def get_xen_event(uuid, client):
     event_detail = None
     get_xen_event = encode_to_bytes('data/host/{0}'.format(uuid))
@@ -220,3 +450,45 @@ def update_xenguest_event(uuid, data, client):
         )
 
     return success
+
+
+def answer_xen_events(uuids, data, client):
+    """
+        Remove the events from data/host and write their result to
+        data/guest in one transaction, so the host never sees the event
+        removed without its answer. A failed delete is only logged so the
+        answer is still written.
+    """
+    success = False
+    deletes = [
+        encode_to_bytes('data/host/{0}'.format(uuid)) for uuid in uuids
+    ]
+    write_value = encode_to_bytes(json.dumps(data))
+    writes = [
+        (encode_to_bytes('data/guest/{0}'.format(uuid)), write_value)
+        for uuid in uuids
+    ]
+
+    def answer(tx_client):
+        results = xenstore.xenstore_update_many(deletes, writes, tx_client)
+        for result in results[:len(deletes)]:
+            if isinstance(result, Exception):
+                log.error(
+                    'Exception was caught removing xen event: {0}'.format(
+                        str(result)
+                    )
+                )
+
+        for result in results[len(deletes):]:
+            if isinstance(result, Exception):
+                raise result
+
+    try:
+        xenstore.run_transaction(answer, client)
+        success = True
+    except Exception as e:
+        log.error(
+            'Exception was caught writing xen event: {0}'.format(str(e))
+        )
+
+    return success
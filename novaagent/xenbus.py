@@ -1,17 +1,71 @@
 
 from pyxs.exceptions import UnexpectedPacket
+from pyxs.client import Monitor
 from pyxs.client import Router
+from pyxs.client import RVar
 
 
+from pyxs._internal import next_rq_id
+from pyxs._internal import Packet
 from pyxs._internal import Event
 from pyxs._internal import NUL
 from pyxs._internal import Op
 
 
+from pyxs.helpers import check_path
+from pyxs.helpers import error
+
+
+from collections import deque
+
+
+import threading
 import select
+import copy
+
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
 class XenGuestRouter(Router):
+    """
+        xenstored on the guest does not always echo back the rq_id of the
+        request it is answering, but it does answer in the order requests
+        were sent. Outstanding requests are kept in a FIFO so a reply with
+        an unknown rq_id goes to the oldest request still waiting, which
+        keeps replies matched with several requests in flight.
+    """
+    def __init__(self, connection):
+        super(XenGuestRouter, self).__init__(connection)
+        self.rvars_lock = threading.Lock()
+        self.outstanding = deque()
+
+    def send(self, packet):
+        with self.send_lock:
+            rvar = RVar()
+            with self.rvars_lock:
+                self.rvars[packet.rq_id] = rvar
+                self.outstanding.append(packet.rq_id)
+
+            self.connection.send(packet)
+            return rvar
+
+    def pop_rvar(self, rq_id):
+        with self.rvars_lock:
+            rvar = self.rvars.pop(rq_id, None)
+            while rvar is None and self.outstanding:
+                rvar = self.rvars.pop(self.outstanding.popleft(), None)
+
+            # Drop requests at the head of the FIFO that were already
+            # answered by rq_id
+            while self.outstanding and self.outstanding[0] not in self.rvars:
+                self.outstanding.popleft()
+
+            return rvar
+
     def __call__(self):
         try:
             while True:
@@ -28,20 +82,7 @@ class XenGuestRouter(Router):
                     for monitor in self.monitors[event.token]:
                         monitor.events.put(event)
                 else:
-                    """
-                        The try/except is the reason for the subclass from the
-                        pyxs package. Since this is on the guest only the below
-                        gets the packet payload and returns it without the
-                        validation piece failing.
-                    """
-                    rvar = None
-                    try:
-                        self.rvars[packet.rq_id]
-                        rvar = self.rvars.pop(packet.rq_id, None)
-                    except:
-                        temp_rq_id = list(self.rvars.keys())[0]
-                        rvar = self.rvars.pop(temp_rq_id, None)
-
+                    rvar = self.pop_rvar(packet.rq_id)
                     if rvar is None:
                         raise UnexpectedPacket(packet)
                     else:
@@ -50,3 +91,121 @@ class XenGuestRouter(Router):
             self.connection.close()
             self.r_terminator.close()
             self.w_terminator.close()
+            self.fail_outstanding()
+
+    def fail_outstanding(self):
+        """
+            Answer every request still waiting with EIO and wake the
+            monitors once the router stops, otherwise callers would block
+            forever on a connection that is gone
+        """
+        with self.rvars_lock:
+            rvars, self.rvars = self.rvars, {}
+            self.outstanding.clear()
+
+        for rq_id, rvar in rvars.items():
+            rvar.set(Packet(Op.ERROR, b'EIO' + NUL, rq_id))
+
+        for monitors in self.monitors.values():
+            for monitor in monitors:
+                monitor.events.put(None)
+
+
+class XenGuestPipeline(object):
+    """
+        Send several requests before waiting on any reply so a batch of
+        reads and lists costs one round trip instead of one per request.
+
+        >>> pipeline = XenGuestPipeline(client)
+        >>> pipeline.read(b'vm-data/hostname')
+        >>> pipeline.list(b'vm-data/networking')
+        >>> hostname, macs = pipeline.execute()
+
+        Writes and deletes return None when they succeed.
+
+        A request that fails is returned as its PyXSError instead of
+        raising, so one missing path does not lose the rest of the batch.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+
+    def _send(self, op, path, parse):
+        check_path(path)
+        packet = Packet(
+            op,
+            path + NUL,
+            rq_id=next_rq_id(),
+            tx_id=self.client.tx_id
+        )
+        self.requests.append((op, self.client.router.send(packet), parse))
+
+    def read(self, path):
+        self._send(Op.READ, path, lambda payload: payload)
+
+    def list(self, path):
+        self._send(
+            Op.DIRECTORY,
+            path,
+            lambda payload: [] if not payload else payload.split(NUL)
+        )
+
+    def write(self, path, value):
+        check_path(path)
+        packet = Packet(
+            Op.WRITE,
+            path + NUL + value,
+            rq_id=next_rq_id(),
+            tx_id=self.client.tx_id
+        )
+        self.requests.append(
+            (Op.WRITE, self.client.router.send(packet), lambda payload: None)
+        )
+
+    def delete(self, path):
+        self._send(Op.RM, path, lambda payload: None)
+
+    def execute(self):
+        results = []
+        requests, self.requests = self.requests, []
+        for op, rvar, parse in requests:
+            packet = rvar.get()
+            if packet.op == Op.ERROR:
+                results.append(error(packet.payload[:-1]))
+            elif packet.op != op:
+                results.append(UnexpectedPacket(packet))
+            else:
+                results.append(parse(packet.payload.rstrip(NUL)))
+
+        return results
+
+
+class XenGuestMonitor(Monitor):
+    """
+        pyxs refuses to hand out a Monitor for a XenBusConnection, but the
+        XenGuestRouter above already routes WATCH_EVENT packets to the
+        subscribed monitors so the monitor is created directly.
+    """
+    def __init__(self, client):
+        super(XenGuestMonitor, self).__init__(copy.copy(client))
+
+    def wait_event(self, timeout=None):
+        """
+            Block until a watch fires or the timeout expires. Any events
+            that queued up while the agent was busy are drained so a burst
+            of host writes only wakes the agent once.
+
+            Returns True if an event was received and False on timeout
+        """
+        try:
+            self.events.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+
+        return True
@@ -0,0 +1,797 @@
+from __future__ import absolute_import
+
+
+from subprocess import PIPE
+from subprocess import Popen
+
+
+import contextlib
+import threading
+import logging
+import select
+import errno
+import copy
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+# pyxs and novaagent.xenbus are imported by the backends that use them so
+# the agent only pays for them once a persistent connection is opened
+
+
+XENBUS_PATHS = ('/dev/xen/xenbus', '/proc/xen/xenbus')
+
+
+# Seconds before the backends are probed again after falling back to the
+# xenstore-* tools, doubled after every failed attempt
+RECONNECT_BACKOFF = 1
+RECONNECT_MAX = 60
+
+
+class TransactionConflict(Exception):
+    """Raised when a transaction is not committed due to other writes"""
+
+
+def _decode(value):
+    return value.decode('utf-8').strip()
+
+
+class Pipeline(object):
+    """
+        Queue operations and run them as one batch with execute. Results
+        come back in the order the operations were queued, a failed
+        operation is returned as the exception it raised.
+
+        This default runs the operations one at a time, backends that can
+        have several requests in flight override execute.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.operations = []
+
+    def read(self, path):
+        self.operations.append(('read', (path,)))
+
+    def list(self, path):
+        self.operations.append(('list', (path,)))
+
+    def write(self, path, value):
+        self.operations.append(('write', (path, value)))
+
+    def delete(self, path):
+        self.operations.append(('delete', (path,)))
+
+    def execute(self):
+        results = []
+        operations, self.operations = self.operations, []
+        for name, args in operations:
+            try:
+                results.append(getattr(self.backend, name)(*args))
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+
+class XenstoreBackend(object):
+    """
+        Interface to xenstore used by the rest of the agent. Reads return
+        the value as a stripped string and lists the child names as strings.
+
+        watch returns a monitor with a wait_event(timeout) method or None
+        when the backend cannot watch. transaction is a context manager
+        yielding a backend bound to the transaction, backends without
+        transactions yield themselves.
+    """
+    name = None
+    connected = True
+
+    @classmethod
+    def probe(cls):
+        """Create the backend if it can be used on this guest or None"""
+        return cls()
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, path):
+        raise NotImplementedError
+
+    def list_iter(self, path):
+        raise NotImplementedError
+
+    def list(self, path):
+        return list(self.list_iter(path))
+
+    def write(self, path, value):
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def watch(self, path, token):
+        return None
+
+    def transaction(self):
+        return _NoTransaction(self)
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class _NoTransaction(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        return self.backend
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class SubprocessMonitor(object):
+    """
+        Watch a path by reading the output of xenstore-watch, which prints
+        the path once when it starts and again every time it changes
+    """
+    def __init__(self, path):
+        self.process = Popen(
+            ['xenstore-watch', path],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        self.exited = False
+
+    def wait_event(self, timeout=None):
+        if self.exited:
+            # Poll as the agent did before watches once the watcher is gone
+            time.sleep(1)
+            return True
+
+        fd = self.process.stdout.fileno()
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            return False
+
+        if not os.read(fd, 4096):
+            log.warning('xenstore-watch exited, falling back to polling')
+            self.exited = True
+            self.process.wait()
+
+        return True
+
+    def close(self):
+        if not self.exited:
+            self.process.terminate()
+            self.process.wait()
+            self.exited = True
+
+
+class SubprocessBackend(XenstoreBackend):
+    """
+        Run a xenstore-* command per operation, used when no persistent
+        connection to xenstore can be opened
+    """
+    name = 'subprocess'
+
+    def read(self, path):
+        p = Popen(
+            ['xenstore-read', path],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        output, _ = p.communicate()
+        if p.returncode != 0:
+            return None
+
+        return _decode(output)
+
+    def list_iter(self, path):
+        """
+            xenstore-list only prints one level, where xenstore-ls would dump
+            every descendant along with its value
+        """
+        p = Popen(
+            ['xenstore-list', path],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        output, _ = p.communicate()
+        if p.returncode != 0:
+            raise ValueError(
+                'Shell to xenstore-list returned invalid code {0}'.format(
+                    p.returncode
+                )
+            )
+
+        for line in output.splitlines():
+            item = _decode(line)
+            if item:
+                yield item
+
+    def write(self, path, value):
+        p = Popen(
+            ['xenstore-write', path, value],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        p.communicate()
+        if p.returncode != 0:
+            raise ValueError(
+                'Shell to xenstore-write returned invalid code {0}'.format(
+                    p.returncode
+                )
+            )
+
+    def delete(self, path):
+        p = Popen(
+            ['xenstore-rm', path],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        p.communicate()
+        if p.returncode != 0:
+            raise ValueError(
+                'Shell to xenstore-rm returned invalid code {0}'.format(
+                    p.returncode
+                )
+            )
+
+    def watch(self, path, token):
+        return SubprocessMonitor(path)
+
+
+class PyxsTransaction(object):
+    """
+        Run the body of the with statement inside a xenstore transaction.
+        The transaction uses its own copy of the client, which shares the
+        connection but not the transaction id, so other threads using the
+        client are not pulled into it.
+
+        The transaction is rolled back if the body raises and
+        TransactionConflict is raised if the commit fails because of writes
+        from the host, run_transaction takes care of retrying.
+    """
+    def __init__(self, client):
+        self.client = copy.copy(client)
+
+    def __enter__(self):
+        self.client.transaction()
+        return PyxsBackend(self.client)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            try:
+                self.client.rollback()
+            except Exception as e:
+                log.debug('Transaction rollback failed: {0}'.format(str(e)))
+
+            return False
+
+        if not self.client.commit():
+            raise TransactionConflict()
+
+
+class PyxsPipeline(Pipeline):
+    """Send every queued request before waiting on the first reply"""
+    def execute(self):
+        from novaagent.xenbus import XenGuestPipeline
+
+        pipeline = XenGuestPipeline(self.backend.client)
+        operations, self.operations = self.operations, []
+        for name, args in operations:
+            getattr(pipeline, name)(*args)
+
+        results = []
+        for (name, args), result in zip(operations, pipeline.execute()):
+            if isinstance(result, Exception) or result is None:
+                results.append(result)
+            elif name == 'list':
+                results.append([_decode(item) for item in result])
+            else:
+                results.append(_decode(result))
+
+        return results
+
+
+class PyxsBackend(XenstoreBackend):
+    """Talk the xenstore protocol over a pyxs client"""
+    name = 'pyxs'
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def connected(self):
+        return self.client.router.is_connected
+
+    def connect(self):
+        self.client.connect()
+
+    def close(self):
+        self.client.close()
+
+    def read(self, path):
+        return _decode(self.client.read(path))
+
+    def list_iter(self, path):
+        for item in self.client.list(path):
+            yield _decode(item)
+
+    def write(self, path, value):
+        self.client.write(path, value)
+
+    def delete(self, path):
+        self.client.delete(path)
+
+    def watch(self, path, token):
+        from novaagent.xenbus import XenGuestMonitor
+
+        monitor = XenGuestMonitor(self.client)
+        monitor.watch(path, token)
+        return monitor
+
+    def transaction(self):
+        return PyxsTransaction(self.client)
+
+    def pipeline(self):
+        return PyxsPipeline(self)
+
+
+class XenBusBackend(PyxsBackend):
+    """Persistent connection through the xenbus device of the guest kernel"""
+    name = 'xenbus'
+
+    def __init__(self, path=XENBUS_PATHS[0]):
+        from pyxs.connection import XenBusConnection
+        from novaagent.xenbus import XenGuestRouter
+        from pyxs.client import Client
+
+        self.path = path
+        super(XenBusBackend, self).__init__(
+            Client(router=XenGuestRouter(XenBusConnection(path)))
+        )
+
+    @classmethod
+    def probe(cls):
+        for path in XENBUS_PATHS:
+            log.info('Checking for existence of {0}'.format(path))
+            if os.path.exists(path):
+                return cls(path)
+
+        return None
+
+
+class UnixSocketBackend(PyxsBackend):
+    """Persistent connection through the xenstored socket"""
+    name = 'unix-socket'
+
+    def __init__(self, path=None):
+        from pyxs.connection import UnixSocketConnection
+        from novaagent.xenbus import XenGuestRouter
+        from pyxs.client import Client
+
+        connection = UnixSocketConnection(path)
+        self.path = connection.path
+        super(UnixSocketBackend, self).__init__(
+            Client(router=XenGuestRouter(connection))
+        )
+
+    @classmethod
+    def probe(cls):
+        backend = cls()
+        log.info('Checking for existence of {0}'.format(backend.path))
+        if os.path.exists(backend.path):
+            return backend
+
+        return None
+
+
+class MemoryMonitor(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.fired = False
+
+    def fire(self):
+        with self.condition:
+            self.fired = True
+            self.condition.notify_all()
+
+    def wait_event(self, timeout=None):
+        with self.condition:
+            if not self.fired:
+                self.condition.wait(timeout)
+
+            fired, self.fired = self.fired, False
+
+        return fired
+
+
+class MemoryTransaction(object):
+    """
+        Work on a copy of the store and swap it in on commit. The commit
+        conflicts if anything was written since the transaction started.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        with self.backend.lock:
+            self.generation = self.backend.generation
+            # Copied directly rather than through write, which would mark
+            # every node as changed and fire every watch on commit
+            self.tx_backend = MemoryBackend()
+            self.tx_backend.nodes = dict(self.backend.nodes)
+
+        return self.tx_backend
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return False
+
+        with self.backend.lock:
+            if self.backend.generation != self.generation:
+                raise TransactionConflict()
+
+            if not self.tx_backend.changed:
+                # Read only, nothing for writers to conflict with
+                return False
+
+            self.backend.nodes = self.tx_backend.nodes
+            self.backend.generation += 1
+
+        for path in self.tx_backend.changed:
+            self.backend._fire(path)
+
+
+class MemoryBackend(XenstoreBackend):
+    """
+        xenstore held in a dict, used to exercise the agent and compare the
+        other backends without a hypervisor
+    """
+    name = 'memory'
+
+    def __init__(self, nodes=None):
+        self.lock = threading.RLock()
+        self.nodes = {}
+        self.watches = []
+        self.generation = 0
+        self.changed = set()
+        for path, value in (nodes or {}).items():
+            self.write(path, value)
+
+    @classmethod
+    def probe(cls):
+        return None
+
+    def _path(self, path):
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+
+        return path.strip('/')
+
+    def _missing(self, path):
+        from pyxs.exceptions import PyXSError
+
+        return PyXSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def _fire(self, path):
+        for watch_path, monitor in self.watches:
+            if path == watch_path or path.startswith(watch_path + '/'):
+                monitor.fire()
+
+    def read(self, path):
+        path = self._path(path)
+        with self.lock:
+            if path not in self.nodes:
+                raise self._missing(path)
+
+            return self.nodes[path]
+
+    def list_iter(self, path):
+        path = self._path(path)
+        prefix = path + '/'
+        with self.lock:
+            if path not in self.nodes:
+                raise self._missing(path)
+
+            children = sorted(
+                node[len(prefix):] for node in self.nodes
+                if node.startswith(prefix) and '/' not in node[len(prefix):]
+            )
+
+        return iter(children)
+
+    def write(self, path, value):
+        path = self._path(path)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+
+        with self.lock:
+            parts = path.split('/')
+            for count in range(1, len(parts)):
+                self.nodes.setdefault('/'.join(parts[:count]), '')
+
+            self.nodes[path] = value.strip()
+            self.generation += 1
+            self.changed.add(path)
+
+        self._fire(path)
+
+    def delete(self, path):
+        path = self._path(path)
+        prefix = path + '/'
+        with self.lock:
+            if path not in self.nodes:
+                raise self._missing(path)
+
+            for node in list(self.nodes):
+                if node == path or node.startswith(prefix):
+                    del self.nodes[node]
+
+            self.generation += 1
+            self.changed.add(path)
+
+        self._fire(path)
+
+    def watch(self, path, token):
+        monitor = MemoryMonitor()
+        with self.lock:
+            self.watches.append((self._path(path), monitor))
+
+        # xenstore fires every watch once when it is registered
+        monitor.fire()
+        return monitor
+
+    def transaction(self):
+        return MemoryTransaction(self)
+
+
+# Tried in order at startup, the first one that can be used is kept
+BACKENDS = (XenBusBackend, UnixSocketBackend, SubprocessBackend)
+
+
+def select_backend(backends=BACKENDS):
+    """
+        Probe the backends in order and return the first one that connects.
+        The xenstore-* tools are the last resort and always available.
+    """
+    from pyxs.exceptions import PyXSError
+
+    for backend_type in backends:
+        backend = backend_type.probe()
+        if backend is None:
+            continue
+
+        try:
+            backend.connect()
+        except PyXSError as e:
+            log.error(
+                'Unable to connect to xenstore via {0}: {1}'.format(
+                    backend.name,
+                    str(e)
+                )
+            )
+            continue
+
+        log.info('Connected to xenstore via {0}'.format(backend.name))
+        return backend
+
+    return SubprocessBackend()
+
+
+class ManagedMonitor(object):
+    """Watch that is registered again whenever the connection is reopened"""
+    def __init__(self, manager, path, token):
+        self.manager = manager
+        self.path = path
+        self.token = token
+        self.backend = None
+        self.monitor = None
+        self._register(manager.current())
+
+    def _register(self, backend):
+        self.close()
+        self.backend = backend
+        try:
+            self.monitor = backend.watch(self.path, self.token)
+        except Exception as e:
+            log.warning(
+                'Unable to watch {0} via {1}: {2}'.format(
+                    self.path,
+                    backend.name,
+                    str(e)
+                )
+            )
+
+    def wait_event(self, timeout=None):
+        backend = self.manager.current()
+        if backend is not self.backend:
+            # Anything written while the watch was gone was missed
+            self._register(backend)
+            return True
+
+        if self.monitor is None:
+            time.sleep(1)
+            return True
+
+        return self.monitor.wait_event(timeout)
+
+    def close(self):
+        monitor, self.monitor = self.monitor, None
+        if monitor is None or not hasattr(monitor, 'close'):
+            return
+
+        try:
+            monitor.close()
+        except Exception as e:
+            log.debug('Unable to close watch: {0}'.format(str(e)))
+
+
+class ConnectionManager(XenstoreBackend):
+    """
+        Backend that selects and connects the real backend on first use
+        and replaces it when the connection is lost, for example when the
+        xenbus device goes away during live migration.
+
+        While only the xenstore-* tools are available the backends are
+        probed again with exponential backoff, so a persistent connection
+        is picked up once it comes back.
+    """
+    name = 'managed'
+
+    def __init__(self, backends=BACKENDS):
+        self.backends = backends
+        self.lock = threading.Lock()
+        self.backend = None
+        self.delay = RECONNECT_BACKOFF
+        self.next_attempt = 0
+
+    def current(self):
+        """Return the backend to use, connecting first if needed"""
+        with self.lock:
+            if self.backend is not None and not self.backend.connected:
+                log.warning(
+                    'Lost connection to xenstore via {0}'.format(
+                        self.backend.name
+                    )
+                )
+                self._drop()
+
+            if self.backend is None or (
+                isinstance(self.backend, SubprocessBackend) and
+                time.time() >= self.next_attempt
+            ):
+                self.backend = select_backend(self.backends)
+                if isinstance(self.backend, SubprocessBackend):
+                    self.next_attempt = time.time() + self.delay
+                    self.delay = min(self.delay * 2, RECONNECT_MAX)
+                else:
+                    self.delay = RECONNECT_BACKOFF
+
+            return self.backend
+
+    def _drop(self):
+        backend, self.backend = self.backend, None
+        try:
+            backend.close()
+        except Exception as e:
+            log.debug('Unable to close {0}: {1}'.format(backend.name, str(e)))
+
+    def _lost(self, backend):
+        with self.lock:
+            if backend is self.backend:
+                log.warning(
+                    'Lost connection to xenstore via {0}'.format(backend.name)
+                )
+                self._drop()
+
+    def _is_lost(self, backend, error):
+        from pyxs.exceptions import ConnectionError
+
+        return isinstance(error, ConnectionError) or not backend.connected
+
+    @contextlib.contextmanager
+    def _guard(self, backend):
+        try:
+            yield
+        except Exception as e:
+            if self._is_lost(backend, e):
+                self._lost(backend)
+
+            raise
+
+    def close(self):
+        with self.lock:
+            if self.backend is not None:
+                self._drop()
+
+    def read(self, path):
+        backend = self.current()
+        with self._guard(backend):
+            return backend.read(path)
+
+    def list_iter(self, path):
+        backend = self.current()
+        with self._guard(backend):
+            for item in backend.list_iter(path):
+                yield item
+
+    def write(self, path, value):
+        backend = self.current()
+        with self._guard(backend):
+            backend.write(path, value)
+
+    def delete(self, path):
+        backend = self.current()
+        with self._guard(backend):
+            backend.delete(path)
+
+    def watch(self, path, token):
+        return ManagedMonitor(self, path, token)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        backend = self.current()
+        with self._guard(backend):
+            with backend.transaction() as tx_backend:
+                yield tx_backend
+
+    def pipeline(self):
+        return ManagedPipeline(self)
+
+
+class ManagedPipeline(Pipeline):
+    """
+        Pipeline of a ConnectionManager. The operations are queued here and
+        handed to the pipeline of the current connection on execute, if
+        that connection is lost they are run once more on a new one.
+    """
+    def execute(self):
+        manager = self.backend
+        operations, self.operations = self.operations, []
+        for attempt in range(2):
+            backend = manager.current()
+            pipeline = backend.pipeline()
+            for name, args in operations:
+                getattr(pipeline, name)(*args)
+
+            try:
+                with manager._guard(backend):
+                    return pipeline.execute()
+            except Exception as e:
+                if attempt > 0 or not manager._is_lost(backend, e):
+                    raise
+
+                log.warning(
+                    'Running pipeline again after losing {0}'.format(
+                        backend.name
+                    )
+                )
+
+
+def get_backend(client):
+    """
+        Accept a backend, a pyxs client or None for the xenstore-* tools so
+        callers that still pass a client keep working
+    """
+    if isinstance(client, XenstoreBackend):
+        return client
+
+    if client is None:
+        return SubprocessBackend()
+
+    return PyxsBackend(client)
@@ -1,88 +1,151 @@
 
-from subprocess import PIPE
-from subprocess import Popen
+from novaagent.xenstore.backends import TransactionConflict
+from novaagent.xenstore.backends import get_backend
 
 
+import logging
+import errno
 import json
+import time
 
 
-def xenstore_read(path, client, to_json=False):
-    result = None
-    if client is None:
-        p = Popen(
-            ['xenstore-read', path],
-            stdout=PIPE,
-            stderr=PIPE
+log = logging.getLogger(__name__)
+
+
+# Attempts made to commit a transaction that conflicts with host writes
+TRANSACTION_ATTEMPTS = 5
+TRANSACTION_BACKOFF = 0.01
+
+
+def _is_conflict(exc):
+    from pyxs.exceptions import PyXSError
+
+    if isinstance(exc, TransactionConflict):
+        return True
+
+    return isinstance(exc, PyXSError) and exc.args[0] == errno.EAGAIN
+
+
+def run_transaction(func, client, attempts=TRANSACTION_ATTEMPTS):
+    """
+        Call func with a backend inside a transaction and commit it, retrying
+        with exponential backoff while xenstore reports a conflict. Backends
+        without transactions, like the xenstore-* tools, call func directly.
+    """
+    backend = get_backend(client)
+    delay = TRANSACTION_BACKOFF
+    for attempt in range(attempts):
+        try:
+            with backend.transaction() as tx_backend:
+                return func(tx_backend)
+        except Exception as e:
+            if not _is_conflict(e) or attempt == attempts - 1:
+                raise
+
+        log.debug(
+            'Transaction conflict, retrying in {0} seconds'.format(delay)
         )
-        output, _ = p.communicate()
-        if p.returncode == 0:
-            result = output.decode('utf-8').strip()
-    else:
-        result = client.read(path).decode('utf-8').strip()
+        time.sleep(delay)
+        delay *= 2
 
+
+def xenstore_read(path, client, to_json=False):
+    result = get_backend(client).read(path)
     if result and to_json:
         return json.loads(result)
 
     return result
 
 
-def xenstore_list(path, client):
-    result = []
-    if client is None:
-        p = Popen(
-            ['xenstore-ls', path],
-            stdout=PIPE,
-            stderr=PIPE
-        )
-        out, _ = p.communicate()
-        if p.returncode == 0:
-            decoded_out = out.decode('utf-8').split('\n')
-            result = [
-                item.split(' = ')[0] for item in decoded_out if item
-            ]
-    else:
-        for item in client.list(path):
-            result.append(item.decode('utf-8').strip())
+def xenstore_read_many(paths, client, to_json=False):
+    """
+        Read several paths at once. Backends that can pipeline send the
+        reads together so they share a single round trip. A path that
+        cannot be read is returned as None.
+    """
+    pipeline = get_backend(client).pipeline()
+    for path in paths:
+        pipeline.read(path)
 
-    return result
+    results = [
+        None if isinstance(result, Exception) else result
+        for result in pipeline.execute()
+    ]
+    if to_json:
+        return [json.loads(result) if result else None for result in results]
 
+    return results
 
-def xenstore_write(write_path, write_value, client):
-    if client is None:
-        p = Popen(
-            ['xenstore-write', write_path, write_value],
-            stdout=PIPE,
-            stderr=PIPE
-        )
-        p.communicate()
-        if p.returncode != 0:
-            raise ValueError(
-                'Shell to xenstore-write returned invalid code {0}'.format(
-                    p.returncode
-                )
-            )
-    else:
-        client.write(write_path, write_value)
 
-    return
+def xenstore_update_many(deletes, writes, client):
+    """
+        Delete and write several paths, deletes first, as one pipelined
+        batch. Returns one result per operation, None when it succeeded or
+        the exception it raised.
+    """
+    pipeline = get_backend(client).pipeline()
+    for path in deletes:
+        pipeline.delete(path)
+
+    for write_path, write_value in writes:
+        pipeline.write(write_path, write_value)
+
+    return pipeline.execute()
+
+
+def xenstore_snapshot(path, client, children=None):
+    """
+        Read every value below path into a flat dict keyed by the path
+        relative to it, e.g. 'networking/BC764E206C5B'. Each level of the
+        tree is fetched in one pipelined batch of lists and reads. When
+        children is given only those children of path are read.
+    """
+    backend = get_backend(client)
+    values = {}
+    level = list(children) if children is not None else [b'']
+    while level:
+        pipeline = backend.pipeline()
+        for item in level:
+            pipeline.list(path + b'/' + item if item else path)
+            pipeline.read(path + b'/' + item if item else path)
+
+        results = pipeline.execute()
+        next_level = []
+        for item, children, value in zip(level, results[0::2], results[1::2]):
+            if item and value is not None and not isinstance(value, Exception):
+                values[item.decode('utf-8')] = value
+
+            if isinstance(children, Exception):
+                continue
+
+            for child in children:
+                child = _encode_path(child)
+                next_level.append(item + b'/' + child if item else child)
+
+        level = next_level
+
+    return values
+
+
+def _encode_path(path):
+    try:
+        return bytes(path)
+    except TypeError:
+        return bytes(path, 'utf-8')
+
+
+def xenstore_list_iter(path, client):
+    """Yield the names of the immediate children of path"""
+    return get_backend(client).list_iter(path)
+
+
+def xenstore_list(path, client):
+    return get_backend(client).list(path)
+
+
+def xenstore_write(write_path, write_value, client):
+    get_backend(client).write(write_path, write_value)
 
 
 def xenstore_delete(path, client):
-    if client is None:
-        p = Popen(
-            ['xenstore-rm', path],
-            stdout=PIPE,
-            stderr=PIPE
-        )
-        _out, _err = p.communicate()
-        if p.returncode != 0:
-            raise ValueError(
-                'Shell to xenstore-rm returned invalid code {0}'.format(
-                    p.returncode
-                )
-            )
-
-    else:
-        client.delete(path)
-
-    return
+    get_backend(client).delete(path)
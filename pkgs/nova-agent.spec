@@ -25,12 +25,14 @@ BuildRequires: python%{?with_python3:3}-setuptools
 BuildRequires: python%{?with_python3:3}-nose
 %{?el6:BuildRequires: python-unittest2}
 %{?el6:BuildRequires: python-argparse}
+%{!?with_python3:BuildRequires: python-ipaddress}
 BuildRequires: python%{?with_python3:3}-crypto
 BuildRequires: python%{?with_python3:3}-netifaces
 BuildRequires: python%{?with_python3:3}-pyxs
 %endif
 
 %{?el6:Requires: python-argparse}
+%{!?with_python3:Requires: python-ipaddress}
 Requires: python%{?with_python3:3}-crypto
 Requires: python%{?with_python3:3}-netifaces
 Requires: python%{?with_python3:3}-pyxs
@@ -9,6 +9,9 @@ requirements = ['netifaces', 'pyxs', 'pycrypto']
 if sys.version_info[:2] < (2, 7):
     requirements.append('argparse')
 
+if sys.version_info[:2] < (3, 3):
+    requirements.append('ipaddress')
+
 
 test_requirements = ['mock', 'nose']
 if sys.version_info[:2] < (2, 7):
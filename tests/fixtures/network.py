@@ -108,7 +108,8 @@ DEBIAN_INTERFACES_CONFIG = [
     '\tgateway fe80::def\n',
     '\n',
     'iface eth0:1 inet6 static\n',
-    '\taddress 2001:4802:7802:104:be76:4eff:fe20:7573\tnetmask 64\n',
+    '\taddress 2001:4802:7802:104:be76:4eff:fe20:7573\n',
+    '\tnetmask 64\n',
     '\n',
     '# Label private\n',
     '\n',
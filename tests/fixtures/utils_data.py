@@ -8,11 +8,9 @@ def get_hostname(use_bytes=True):
 
 
 def get_xen_host_events():
-    return (
-        b"""
-748dee41-c47f-4ec7-b2cd-037e51da4031 = "{"name": "keyinit"\n""",
-        b''
-    )
+    return [
+        b'748dee41-c47f-4ec7-b2cd-037e51da4031\n'
+    ]
 
 
 def get_xen_guest_events():
@@ -32,12 +30,10 @@ def get_xen_host_event_details():
 
 
 def get_mac_addresses():
-    return (
-        b"""
-BC764E206C5B = "{"label": "private", "broadcast": "10.208.255.255", "ips": [\\..."\n
-BC764E206C5A = "{"ip6s": [{"ip": "2001:4802:7802:104:be76:4eff:fe20:6c5a", "\\..."\n""",  # noqa
-        b''
-    )
+    return [
+        b'BC764E206C5B\n',
+        b'BC764E206C5A\n'
+    ]
 
 
 def get_network_interface():
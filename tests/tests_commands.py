@@ -0,0 +1,133 @@
+
+from novaagent import commands
+
+
+import logging
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class EntryPoint(object):
+    """ Stand in for a setuptools entry point """
+    def __init__(self, name, loaded=None, error=None):
+        self.name = name
+        self.loaded = loaded
+        self.error = error
+        self.load_count = 0
+
+    def load(self):
+        self.load_count += 1
+        if self.error is not None:
+            raise self.error
+
+        return self.loaded
+
+
+class TestCommands(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def create_registry(self, entry_points):
+        registry = commands.CommandRegistry()
+        registry.register(commands.Command('version', idempotent=True))
+        patcher = mock.patch(
+            'novaagent.commands._iter_entry_points',
+            return_value=entry_points
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return registry
+
+    def test_entry_point_loaded_on_first_use(self):
+        def handler(server_os, name, value, client):
+            return ('0', value)
+
+        entry_point = EntryPoint('echo', handler)
+        registry = self.create_registry([entry_point])
+        self.assertEqual(
+            registry.supported(object()),
+            ['echo'],
+            'Entry point command was not listed'
+        )
+        self.assertEqual(
+            entry_point.load_count,
+            0,
+            'Entry point was imported to list its command'
+        )
+        command = registry.get('echo')
+        self.assertEqual(
+            command.run(object(), 'test', None),
+            ('0', 'test'),
+            'Entry point handler was not run'
+        )
+        registry.get('echo')
+        self.assertEqual(
+            entry_point.load_count,
+            1,
+            'Entry point was not loaded exactly once'
+        )
+
+    def test_entry_point_command_metadata(self):
+        entry_point = EntryPoint(
+            'sync',
+            commands.Command('other', resources=('files',), timeout=5)
+        )
+        registry = self.create_registry([entry_point])
+        command = registry.get('sync')
+        self.assertEqual(
+            (command.name, command.resources, command.timeout),
+            ('sync', ('files',), 5),
+            'Entry point command metadata was not kept'
+        )
+
+    def test_entry_point_load_failure(self):
+        registry = self.create_registry(
+            [EntryPoint('broken', error=ImportError('Test error'))]
+        )
+        self.assertEqual(
+            registry.get('broken'),
+            None,
+            'Command returned for an entry point that failed to load'
+        )
+        self.assertEqual(
+            registry.supported(object()),
+            [],
+            'Command that failed to load is still listed'
+        )
+
+    def test_entry_point_cannot_replace_builtin(self):
+        entry_point = EntryPoint('version', mock.Mock())
+        registry = self.create_registry([entry_point])
+        registry.supported(object())
+        self.assertEqual(
+            registry.get('version').handler,
+            None,
+            'Entry point replaced a built in command'
+        )
+
+    def test_supported_needs_handler(self):
+        class ServerOS(object):
+            def version(self, name, value, client):
+                return ('0', '1.0')
+
+        registry = self.create_registry([])
+        registry.register(commands.Command('resetnetwork'))
+        self.assertEqual(
+            registry.supported(ServerOS()),
+            ['version'],
+            'Command without a handler on the ServerOS was listed'
+        )
@@ -0,0 +1,101 @@
+
+from novaagent.common import aes
+
+
+import binascii
+import logging
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+# CBC-AES128 vector from NIST SP 800-38A F.2.1
+KEY = binascii.unhexlify('2b7e151628aed2a6abf7158809cf4f3c')
+IV = binascii.unhexlify('000102030405060708090a0b0c0d0e0f')
+PLAINTEXT = binascii.unhexlify('6bc1bee22e409f96e93d7e117393172a')
+CIPHERTEXT = binascii.unhexlify('7649abac8119b246cee98e9b12e9197d')
+
+
+class MissingBackend(aes.AESBackend):
+    name = 'missing'
+
+    def load(self):
+        raise ImportError('Test error')
+
+
+class TestAES(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def available_backends(self):
+        backends = []
+        for backend_class in aes.AES_BACKENDS:
+            try:
+                backends.append(aes.load_backend(backend_class.name))
+            except ImportError:
+                pass
+
+        return backends
+
+    def test_backends_vector(self):
+        backends = self.available_backends()
+        self.assertNotEqual(backends, [], 'No AES backend is available')
+        for backend in backends:
+            self.assertEqual(
+                (
+                    backend.encrypt(KEY, IV, PLAINTEXT),
+                    backend.decrypt(KEY, IV, CIPHERTEXT)
+                ),
+                (CIPHERTEXT, PLAINTEXT),
+                'Backend {0} did not match the test vector'.format(
+                    backend.name
+                )
+            )
+
+    def test_openssl_backend_invalid_length(self):
+        try:
+            backend = aes.load_backend('openssl')
+        except ImportError:
+            self.skipTest('libcrypto is not available')
+
+        with self.assertRaises(ValueError):
+            backend.decrypt(KEY, IV, CIPHERTEXT[:10])
+
+    def test_get_backend_fallback(self):
+        with mock.patch.object(
+            aes,
+            'AES_BACKENDS',
+            (MissingBackend,) + aes.AES_BACKENDS
+        ):
+            with mock.patch.object(aes, '_backend', None):
+                backend = aes.get_backend()
+                self.assertIs(
+                    aes.get_backend(),
+                    backend,
+                    'Backend was not kept after the first use'
+                )
+
+        self.assertNotEqual(
+            backend.name,
+            'missing',
+            'Unavailable backend was chosen'
+        )
+
+    def test_get_backend_none_available(self):
+        with mock.patch.object(aes, 'AES_BACKENDS', (MissingBackend,)):
+            with mock.patch.object(aes, '_backend', None):
+                with self.assertRaises(ImportError):
+                    aes.get_backend()
@@ -1,9 +1,15 @@
 
+from novaagent.common import crypt_worker
+from novaagent.common import aes
 from novaagent.common import password
 
 
+import subprocess
+import tempfile
 import logging
+import shutil
 import base64
+import errno
 import glob
 import sys
 import os
@@ -187,6 +193,69 @@ class TestHelpers(TestCase):
             'Unexpected type on second value of tuple should be string'
         )
 
+    def test_compute_public_key_known_value(self):
+        temp_private = 242416858127415443985927051233248666254
+        test = password.PasswordCommands()
+        self.assertEqual(
+            test._dh_compute_public_key(temp_private),
+            29146890515040234272807524713655,
+            'Public key did not match the known value'
+        )
+
+    def test_key_pool(self):
+        keypairs = iter([(1, 5), (2, 25), (3, 125)])
+        pool = password.KeyPool(lambda: next(keypairs), 2)
+        pool.fill()
+        with mock.patch.object(pool, 'start') as start:
+            self.assertEqual(
+                (pool.get(), pool.get()),
+                ((1, 5), (2, 25)),
+                'Pool did not hand out the generated keypairs in order'
+            )
+            self.assertEqual(
+                pool.get(),
+                (3, 125),
+                'Empty pool did not generate a keypair'
+            )
+
+        self.assertEqual(
+            start.call_count,
+            3,
+            'Pool was not refilled after a keypair was taken'
+        )
+
+    def test_key_pool_disabled(self):
+        pool = password.KeyPool(mock.Mock(), 0)
+        with mock.patch(
+            'novaagent.common.password.threading.Thread'
+        ) as thread:
+            pool.start()
+
+        self.assertEqual(
+            thread.call_count,
+            0,
+            'Pool with a size of 0 started a thread'
+        )
+
+    def test_key_init_pooled(self):
+        test = password.PasswordCommands(key_pool_size=1)
+        test.key_pool.thread.join()
+        private_key, public_key = test.key_pool.keys[0]
+        remote_public_key = 29146890515040234272807524713655
+        keyinit = test.keyinit_cmd(remote_public_key)
+        self.assertEqual(
+            keyinit,
+            ('D0', str(public_key)),
+            'keyinit did not answer with the pooled public key'
+        )
+        self.assertEqual(
+            test.aes_key,
+            test._compute_aes_key(
+                str(pow(remote_public_key, private_key, test.prime))
+            ),
+            'Shared key was not computed from the pooled private key'
+        )
+
     def test_change_password_test_mode(self):
         test = password.PasswordCommands(testmode=True)
         self.assertEqual(
@@ -302,6 +371,79 @@ class TestHelpers(TestCase):
             'Did not receive expected error on invalid password data'
         )
 
+    def test_password_cmd_sessions(self):
+        test = password.PasswordCommands(testmode=True, key_pool_size=0)
+        host_private = 242416858127415443985927051233248666254
+        host_public = pow(test.base, host_private, test.prime)
+        first = test.keyinit_cmd('first:{0}'.format(host_public))
+        second = test.keyinit_cmd('second:{0}'.format(host_public))
+        self.assertEqual(
+            sorted(test.sessions.keys),
+            ['first', 'second'],
+            'Overlapping key exchanges did not get a key each'
+        )
+
+        data = {}
+        for session, keyinit in (('first', first), ('second', second)):
+            aes_key = test._compute_aes_key(
+                str(pow(long(keyinit[1]), host_private, test.prime))
+            )
+            data[session] = base64.b64encode(
+                aes.get_backend().encrypt(
+                    aes_key[0],
+                    aes_key[1],
+                    b'new_password' + b'\x04' * 4
+                )
+            ).decode('utf-8')
+
+        with mock.patch(
+            'novaagent.common.password.PasswordCommands._change_password'
+        ) as change:
+            self.assertEqual(
+                test.password_cmd('second:{0}'.format(data['second'])),
+                ('0', ''),
+                'Password was not decrypted with the key of its session'
+            )
+
+        change.assert_called_once_with(b'new_password')
+        self.assertEqual(
+            list(test.sessions.keys),
+            ['first'],
+            'Only the key of the used session should be wiped'
+        )
+
+    def test_key_sessions_ttl(self):
+        sessions = password.KeySessions(ttl=10, size=2)
+        with mock.patch('novaagent.common.password.time.time') as now:
+            now.return_value = 100
+            sessions.set('first', 'Key 1')
+            now.return_value = 105
+            sessions.set('second', 'Key 2')
+            self.assertEqual(
+                sessions.get('first'),
+                'Key 1',
+                'Key was not returned before it expired'
+            )
+            now.return_value = 110
+            self.assertEqual(
+                (sessions.get('first'), sessions.get('second')),
+                (None, 'Key 2'),
+                'Key was returned after it expired'
+            )
+
+    def test_key_sessions_size(self):
+        sessions = password.KeySessions(ttl=10, size=2)
+        with mock.patch('novaagent.common.password.time.time') as now:
+            for count, session in enumerate(('first', 'second', 'third')):
+                now.return_value = 100 + count
+                sessions.set(session, session)
+
+        self.assertEqual(
+            sorted(sessions.keys),
+            ['second', 'third'],
+            'Oldest key was not dropped when the table was full'
+        )
+
     def test_make_salt(self):
         length = 16
         salt_value = password._make_salt(length)
@@ -346,6 +488,364 @@ class TestHelpers(TestCase):
             except Exception:
                 pass
 
+    def test_create_temp_password_file_streamed(self):
+        original = (
+            b'root:$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.:17333:0:99999:7:::\n'
+            b'  bin:*:17110:0:99999:7:::  \n'
+            b'#root:*:17110:0:99999:7:::\n'
+            b'root\n'
+            b'testuser:*:17352:0:99999:7:::'
+        )
+        with open('/tmp/passwd', 'wb') as f:
+            f.write(original)
+
+        for user in ('root', 'testuser'):
+            with mock.patch(
+                'novaagent.common.password.crypt.crypt'
+            ) as crypt:
+                crypt.return_value = '$1$NEWSALT$NEWHASH'
+                temp_file = password._create_temp_password_file(
+                    user,
+                    'password',
+                    '/tmp/passwd'
+                )
+
+            with open(temp_file, 'rb') as f:
+                rewritten = f.read()
+
+            os.remove(temp_file)
+            old_line = [
+                line for line in original.split(b'\n')
+                if line.startswith(user.encode('utf-8') + b':')
+            ][0]
+            self.assertEqual(
+                rewritten,
+                original.replace(
+                    old_line,
+                    old_line.replace(
+                        old_line.split(b':')[1],
+                        b'$1$NEWSALT$NEWHASH'
+                    )
+                ),
+                'Only the password of {0} should have changed'.format(user)
+            )
+
+    def test_copy_range_without_sendfile(self):
+        with open('/tmp/passwd', 'wb') as f:
+            f.write(b'0123456789')
+
+        src_fd = os.open('/tmp/passwd', os.O_RDONLY)
+        dst_fd = os.open('/tmp/passwd.copy', os.O_CREAT | os.O_WRONLY)
+        try:
+            with mock.patch(
+                'novaagent.common.password.os.sendfile',
+                side_effect=OSError(errno.EINVAL, 'Invalid argument'),
+                create=True
+            ):
+                with mock.patch(
+                    'novaagent.common.password.COPY_BLOCK_SIZE',
+                    3
+                ):
+                    password._copy_range(src_fd, dst_fd, 2, 7)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        with open('/tmp/passwd.copy', 'rb') as f:
+            self.assertEqual(
+                f.read(),
+                b'2345678',
+                'Range was not copied when sendfile is unavailable'
+            )
+
+    def test_set_password_tcb(self):
+        self.setup_test_pw_file()
+        tcb_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tcb_dir, 'testuser'))
+        tcb_shadow = os.path.join(tcb_dir, 'testuser', 'shadow')
+        original_line = (
+            'testuser:$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.:17352:0:99999:7:::\n'
+        )
+        with open(tcb_shadow, 'w') as f:
+            f.write(original_line)
+
+        with open('/tmp/passwd') as f:
+            original_shadow = f.read()
+
+        password.PASSWD_FILES = ['/tmp/passwd']
+        try:
+            with mock.patch('novaagent.common.password.TCB_DIR', tcb_dir):
+                password.set_password('testuser', 'test')
+
+            with open(tcb_shadow) as f:
+                self.assertNotEqual(
+                    f.read(),
+                    original_line,
+                    'Password was not changed in the tcb shadow file'
+                )
+
+            self.assertEqual(
+                os.listdir(os.path.join(tcb_dir, 'testuser')),
+                ['shadow'],
+                'Temporary files were left in the tcb directory'
+            )
+        finally:
+            shutil.rmtree(tcb_dir)
+
+        with open('/tmp/passwd') as f:
+            self.assertEqual(
+                f.read(),
+                original_shadow,
+                'Shadow file was rewritten when the user has a tcb file'
+            )
+
+    def test_password_files_no_tcb(self):
+        password.PASSWD_FILES = ['/tmp/passwd']
+        with mock.patch(
+            'novaagent.common.password.TCB_DIR',
+            '/tmp/missing_tcb'
+        ):
+            self.assertEqual(
+                (
+                    password._password_files('root'),
+                    password._password_files('../root')
+                ),
+                (['/tmp/passwd'], ['/tmp/passwd']),
+                'Did not fall back to the shadow file without tcb'
+            )
+
+    def test_set_passwords(self):
+        self.setup_test_pw_file()
+        password.PASSWD_FILES = ['/tmp/passwd']
+        with open('/tmp/passwd') as f:
+            original = f.readlines()
+
+        with mock.patch(
+            'novaagent.common.password.os.rename',
+            wraps=os.rename
+        ) as rename:
+            password.set_passwords(
+                [('root', 'password1'), ('testuser', 'password2')]
+            )
+
+        self.assertEqual(
+            rename.call_count,
+            1,
+            'Password file was not replaced once for the whole batch'
+        )
+        with open('/tmp/passwd') as f:
+            changed = [
+                line.split(':', 1)[0]
+                for old, line in zip(original, f.readlines())
+                if old != line
+            ]
+
+        self.assertEqual(
+            changed,
+            ['root', 'testuser'],
+            'Did not change the password of every user in the batch'
+        )
+
+    def test_set_password_leading_whitespace(self):
+        with open('/tmp/passwd', 'w') as f:
+            f.write(
+                'root:*:17333:0:99999:7:::\n'
+                '  testuser:$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.:17352:::::\n'
+                'notestuser:*:17352:0:99999:7:::\n'
+            )
+
+        password.PASSWD_FILES = ['/tmp/passwd']
+        password.set_password('testuser', 'test')
+        with open('/tmp/passwd') as f:
+            lines = f.readlines()
+
+        self.assertEqual(
+            (
+                lines[0],
+                lines[1].split('$', 1)[0],
+                lines[1].split(':', 2)[2],
+                lines[2]
+            ),
+            (
+                'root:*:17333:0:99999:7:::\n',
+                '  testuser:',
+                '17352:::::\n',
+                'notestuser:*:17352:0:99999:7:::\n'
+            ),
+            'Line with leading whitespace was not updated in place'
+        )
+        self.assertNotIn(
+            '1acAVn1Kn.DWH1ycSknWR.',
+            lines[1],
+            'Password was not changed'
+        )
+
+    def test_set_passwords_unknown_user(self):
+        self.setup_test_pw_file()
+        password.PASSWD_FILES = ['/tmp/passwd']
+        with open('/tmp/passwd') as f:
+            original = f.read()
+
+        with self.assertRaises(password.PasswordError) as e:
+            password.set_passwords(
+                [('root', 'password1'), ('nosuchuser', 'password2')]
+            )
+
+        self.assertEqual(
+            str(e.exception),
+            '500: Unknown user nosuchuser',
+            'Unknown user was not reported'
+        )
+        with open('/tmp/passwd') as f:
+            self.assertEqual(
+                f.read(),
+                original,
+                'Password file was changed for a batch with an unknown user'
+            )
+
+        self.assertEqual(
+            glob.glob('/tmp/passwd*'),
+            ['/tmp/passwd'],
+            'Temporary password file was left behind'
+        )
+
+    def test_batch_password_cmd(self):
+        test = password.PasswordCommands()
+        test.aes_key = 'Test Key'
+        with mock.patch(
+            'novaagent.common.password.PasswordCommands._decode_password'
+        ) as decode:
+            decode.return_value = (
+                b'[["root", "password1\\n"], ["testuser", "password2"]]'
+            )
+            with mock.patch(
+                'novaagent.common.password.set_passwords'
+            ) as set_passwords:
+                message = test.batch_password_cmd('Test Pass')
+
+        self.assertEqual(
+            message,
+            ('0', ''),
+            'Did not receive expected message on batch password'
+        )
+        set_passwords.assert_called_once_with(
+            [('root', 'password1'), ('testuser', 'password2')],
+            None,
+            None,
+            test.crypt_worker
+        )
+        self.assertEqual(
+            test.sessions.get(password.DEFAULT_SESSION),
+            None,
+            'Key was not wiped after the batch'
+        )
+
+    def test_batch_password_cmd_invalid_batch(self):
+        test = password.PasswordCommands(testmode=True)
+        test.aes_key = 'Test Key'
+        for batch in (b'not json', b'[["root"]]', b'{"root:x": "test"}'):
+            with mock.patch(
+                'novaagent.common.password.PasswordCommands._decode_password'
+            ) as decode:
+                decode.return_value = batch
+                self.assertEqual(
+                    test.batch_password_cmd('Test Pass'),
+                    (500, 'Invalid password batch received'),
+                    'Invalid batch {0!r} was accepted'.format(batch)
+                )
+
+    def test_parse_hash(self):
+        self.assertEqual(
+            [
+                password._parse_hash(old_hash) for old_hash in (
+                    '$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.',
+                    '$6$rounds=65536$0123456789abcdef$hash',
+                    'p9I3huSF$1acAVn1Kn.DWH1ycSknWR.'
+                )
+            ],
+            [('1', None, 8), ('6', 65536, 16), ('1', None, 8)],
+            'Hashes were not parsed into scheme, rounds and salt length'
+        )
+
+    def test_hash_password_scheme_rounds(self):
+        with mock.patch('novaagent.common.password.crypt.crypt') as crypt:
+            crypt.return_value = 'Hash'
+            with mock.patch(
+                'novaagent.common.password._make_salt',
+                side_effect=lambda length: 's' * length
+            ):
+                password._hash_password(
+                    'test',
+                    '$6$rounds=65536$0123456789abcdef$hash'
+                )
+                password._hash_password(
+                    'test',
+                    '$1$p9I3huSF$1acAVn1Kn.DWH1ycSknWR.',
+                    'sha512',
+                    5000
+                )
+                password._hash_password(
+                    'test',
+                    '$6$rounds=65536$0123456789abcdef$hash',
+                    'md5'
+                )
+
+        self.assertEqual(
+            [call[0][1] for call in crypt.call_args_list],
+            [
+                '$6$rounds=65536$ssssssssssssssss$',
+                '$6$rounds=5000$ssssssssssssssss$',
+                '$1$ssssssss$'
+            ],
+            'Salt did not honor the scheme and rounds'
+        )
+
+    def test_crypt_worker(self):
+        worker = crypt_worker.CryptWorker()
+        try:
+            self.assertEqual(
+                worker.crypt('test', '$1$p9I3huSF$'),
+                password.crypt.crypt('test', '$1$p9I3huSF$'),
+                'Worker did not return the hash'
+            )
+            worker.process.kill()
+            worker.process.wait()
+            self.assertEqual(
+                worker.crypt('test', '$1$p9I3huSF$'),
+                password.crypt.crypt('test', '$1$p9I3huSF$'),
+                'Hash was not computed after the worker exited'
+            )
+            with self.assertRaises(crypt_worker.CryptError):
+                worker.crypt('test', '$99$p9I3huSF$')
+        finally:
+            worker.stop()
+
+    def test_crypt_worker_timeout(self):
+        worker = crypt_worker.CryptWorker(timeout=0.1)
+        hung = subprocess.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(30)'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        worker.process = hung
+        try:
+            self.assertEqual(
+                worker.crypt('test', '$1$p9I3huSF$'),
+                password.crypt.crypt('test', '$1$p9I3huSF$'),
+                'Hash was not computed after the worker did not answer'
+            )
+            self.assertNotEqual(
+                hung.poll(),
+                None,
+                'Worker that did not answer was not killed'
+            )
+        finally:
+            if hung.poll() is None:
+                hung.kill()
+                hung.wait()
+
+            worker.stop()
+
     def test_set_password_invalid_file(self):
         password.PASSWD_FILES = ['/tmp/bad_password_file']
         try:
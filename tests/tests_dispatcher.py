@@ -0,0 +1,159 @@
+
+from novaagent import dispatcher
+
+
+import threading
+import logging
+import time
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+class Recorder(object):
+    """ Handler that records the order events start and finish """
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, uuids, event):
+        uuid = uuids[0]
+        with self.lock:
+            self.calls.append(('start', uuid))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(self.delays.get(event['name'], 0.01))
+        with self.lock:
+            self.running -= 1
+            self.calls.append(('end', uuid))
+
+
+class TestDispatcher(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def run_events(self, recorder, events, workers=4, limits=None):
+        temp = dispatcher.Dispatcher(recorder, workers, limits)
+        temp.start()
+        for uuid, name in events:
+            temp.submit([uuid], {'name': name, 'value': ''})
+
+        for count in range(500):
+            if not temp.pending:
+                break
+
+            time.sleep(0.01)
+
+        temp.stop()
+        return temp
+
+    def test_independent_commands_run_concurrently(self):
+        recorder = Recorder({'resetnetwork': 0.2})
+        self.run_events(
+            recorder,
+            [('1', 'resetnetwork'), ('2', 'version'), ('3', 'features')]
+        )
+        self.assertLess(
+            recorder.calls.index(('end', '2')),
+            recorder.calls.index(('end', '1')),
+            'Query was blocked behind resetnetwork'
+        )
+
+    def test_shared_resource_is_serialized_in_order(self):
+        recorder = Recorder({'keyinit': 0.1})
+        self.run_events(
+            recorder,
+            [('1', 'keyinit'), ('2', 'password'), ('3', 'version')]
+        )
+        self.assertLess(
+            recorder.calls.index(('end', '1')),
+            recorder.calls.index(('start', '2')),
+            'Password started before keyinit finished'
+        )
+
+    def test_command_limit(self):
+        recorder = Recorder()
+        self.run_events(
+            recorder,
+            [(str(count), 'version') for count in range(6)],
+            limits={'version': 1}
+        )
+        self.assertEqual(
+            recorder.max_running,
+            1,
+            'Command limit was not honored'
+        )
+
+    def test_command_not_concurrent(self):
+        recorder = Recorder()
+        self.run_events(
+            recorder,
+            [(str(count), 'agentupdate') for count in range(3)]
+        )
+        self.assertEqual(
+            recorder.max_running,
+            1,
+            'Command that cannot run concurrently overlapped'
+        )
+
+    def test_handler_exception(self):
+        def handler(uuids, event):
+            raise ValueError('Test error')
+
+        temp = self.run_events(handler, [('1', 'version')])
+        self.assertEqual(
+            temp.is_pending('1'),
+            False,
+            'Failed event was left pending'
+        )
+
+    def test_coalesce_events(self):
+        events = [
+            ('1', {'name': 'resetnetwork', 'value': ''}),
+            ('2', {'name': 'version', 'value': ''}),
+            ('3', {'name': 'resetnetwork', 'value': ''}),
+            ('4', {'name': 'resetnetwork', 'value': ''})
+        ]
+        groups = dispatcher.coalesce_events(events)
+        self.assertEqual(
+            [uuids for uuids, event in groups],
+            [['1', '3', '4'], ['2']],
+            'Queued resetnetwork events were not coalesced'
+        )
+
+    def test_coalesce_events_password_value(self):
+        events = [
+            ('1', {'name': 'password', 'value': 'abc'}),
+            ('2', {'name': 'password', 'value': 'abc'}),
+            ('3', {'name': 'password', 'value': 'def'})
+        ]
+        groups = dispatcher.coalesce_events(events)
+        self.assertEqual(
+            [uuids for uuids, event in groups],
+            [['1', '2'], ['3']],
+            'Password events with different values were coalesced'
+        )
+
+    def test_coalesce_events_not_across_resource(self):
+        events = [
+            ('1', {'name': 'password', 'value': 'abc'}),
+            ('2', {'name': 'keyinit', 'value': '1234'}),
+            ('3', {'name': 'password', 'value': 'abc'})
+        ]
+        groups = dispatcher.coalesce_events(events)
+        self.assertEqual(
+            [uuids for uuids, event in groups],
+            [['1'], ['2'], ['3']],
+            'Password events were coalesced across a keyinit'
+        )
@@ -0,0 +1,36 @@
+
+from novaagent import importprofile
+
+
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+class TestImportProfile(TestCase):
+    def test_profiler_records_new_modules(self):
+        sys.modules.pop('colorsys', None)
+        with importprofile.ImportProfiler() as profiler:
+            import colorsys  # noqa: F401
+            import sys as already_loaded  # noqa: F401
+
+        self.assertEqual(
+            [record[0] for record in profiler.records],
+            ['colorsys'],
+            'Profiler did not record only the newly loaded module'
+        )
+
+    def test_profiler_restores_import(self):
+        original_import = importprofile.builtins.__import__
+        with importprofile.ImportProfiler():
+            pass
+
+        self.assertEqual(
+            importprofile.builtins.__import__,
+            original_import,
+            'Import hook was left installed'
+        )
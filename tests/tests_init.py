@@ -1,4 +1,7 @@
 
+from novaagent.libs import redhat
+from novaagent import netconfig
+from novaagent import commands
 from novaagent import libs
 
 
@@ -43,19 +46,37 @@ class TestHelpers(TestCase):
 
     def test_libs_init_features(self):
         temp = libs.DefaultOS()
+        with mock.patch.object(commands.REGISTRY, 'entry_points', {}):
+            features = temp.features('Name', 'Value', 'Client')
+
         self.assertEqual(
-            temp.features('Name', 'Value', 'Client'),
+            features,
             (
                 '0',
-                'kmsactivate,resetnetwork,version,keyinit,'
-                'features,password,agentupdate,injectfile'
+                'version,keyinit,features,password,batchpassword,injectfile'
             ),
             'Did not get expected value on features'
         )
 
+    def test_libs_features_distribution(self):
+        with mock.patch.object(commands.REGISTRY, 'entry_points', {}):
+            features = redhat.ServerOS().features('Name', 'Value', 'Client')
+
+        self.assertEqual(
+            features,
+            (
+                '0',
+                'kmsactivate,resetnetwork,version,keyinit,'
+                'features,password,batchpassword,injectfile'
+            ),
+            'Features did not list the commands the distribution handles'
+        )
+
     def test_libs_init_inject_file(self):
         temp = libs.DefaultOS()
-        with mock.patch('novaagent.libs.FileInject.injectfile_cmd') as fin:
+        with mock.patch(
+            'novaagent.common.file_inject.FileInject.injectfile_cmd'
+        ) as fin:
             fin.return_value = ('0', '')
             self.assertEqual(
                 temp.injectfile('Name', 'Value', 'Client'),
@@ -65,7 +86,9 @@ class TestHelpers(TestCase):
 
     def test_libs_init_password(self):
         temp = libs.DefaultOS()
-        with mock.patch('novaagent.libs.PasswordCommands.password_cmd') as pas:
+        with mock.patch(
+            'novaagent.common.password.PasswordCommands.password_cmd'
+        ) as pas:
             pas.return_value = ('0', '')
             self.assertEqual(
                 temp.password('Name', 'Value', 'Client'),
@@ -73,12 +96,139 @@ class TestHelpers(TestCase):
                 'Did not get expected value on password'
             )
 
+    def test_libs_init_batch_password(self):
+        temp = libs.DefaultOS()
+        with mock.patch(
+            'novaagent.common.password.PasswordCommands.batch_password_cmd'
+        ) as pas:
+            pas.return_value = ('0', '')
+            self.assertEqual(
+                temp.batchpassword('Name', 'Value', 'Client'),
+                ('0', ''),
+                'Did not get expected value on batch password'
+            )
+
     def test_libs_init_key_init(self):
         temp = libs.DefaultOS()
-        with mock.patch('novaagent.libs.PasswordCommands.keyinit_cmd') as key:
+        with mock.patch(
+            'novaagent.common.password.PasswordCommands.keyinit_cmd'
+        ) as key:
             key.return_value = ('0', '')
             self.assertEqual(
                 temp.keyinit('Name', 'Value', 'Client'),
                 ('0', ''),
                 'Did not get expected value on keyinit'
             )
+
+    def test_apply_netlink(self):
+        temp = libs.DefaultOS()
+        config0 = mock.Mock(dns=[])
+        config1 = mock.Mock(dns=[])
+        with mock.patch('novaagent.netlink.NetlinkSocket'):
+            with mock.patch('novaagent.netlink.apply_interface') as apply:
+                timings = temp._apply_netlink(['eth0', 'eth1'], {
+                    'eth0': config0,
+                    'eth1': config1
+                })
+
+        self.assertEqual(
+            [timing.split(':')[0] for timing in timings.split(', ')],
+            ['eth0', 'eth1'],
+            'Timing was not returned for every interface'
+        )
+        self.assertEqual(
+            [call[0][1:] for call in apply.call_args_list],
+            [('eth0', config0), ('eth1', config1)],
+            'Interfaces were not applied'
+        )
+
+    def test_apply_netlink_failure(self):
+        from novaagent import netlink
+        temp = libs.DefaultOS()
+        with mock.patch('novaagent.netlink.NetlinkSocket'):
+            with mock.patch(
+                'novaagent.netlink.apply_interface',
+                side_effect=netlink.NetlinkError('Test error')
+            ):
+                self.assertEqual(
+                    temp._apply_netlink(['eth0'], {'eth0': mock.Mock(dns=[])}),
+                    None,
+                    'Failure was not reported'
+                )
+
+    def test_apply_netlink_dns_changed(self):
+        temp = libs.DefaultOS()
+        iface = netconfig.parse_interface({
+            'label': 'public',
+            'ips': [{'ip': '10.1.0.5', 'netmask': '255.255.255.0'}],
+            'dns': ['69.20.0.164', '69.20.0.196']
+        })
+        with mock.patch(
+            'novaagent.utils.get_nameservers',
+            return_value=['69.20.0.164', '72.3.128.240']
+        ):
+            with mock.patch('novaagent.netlink.NetlinkSocket'):
+                with mock.patch(
+                    'novaagent.netlink.apply_interface'
+                ) as apply:
+                    self.assertEqual(
+                        temp._apply_netlink(['eth0'], {'eth0': iface}),
+                        None,
+                        'Changed DNS servers did not need the scripts'
+                    )
+
+        self.assertEqual(
+            apply.call_count,
+            0,
+            'Interface was applied over netlink with new DNS servers'
+        )
+
+    def test_interface_in_sync(self):
+        temp = libs.DefaultOS()
+        with mock.patch('novaagent.utils.interface_is_up', return_value=True):
+            with mock.patch('novaagent.netlink.NetlinkSocket'):
+                with mock.patch(
+                    'novaagent.netlink.interface_in_sync',
+                    return_value=True
+                ) as in_sync:
+                    self.assertTrue(
+                        temp._interface_in_sync('eth0', 'config0'),
+                        'Interface was not in sync'
+                    )
+
+        self.assertEqual(
+            in_sync.call_args[0][1:],
+            ('eth0', 'config0'),
+            'Interface was not compared with the kernel'
+        )
+
+    def test_interface_in_sync_down(self):
+        temp = libs.DefaultOS()
+        with mock.patch(
+            'novaagent.utils.interface_is_up',
+            return_value=False
+        ):
+            with mock.patch('novaagent.netlink.interface_in_sync') as in_sync:
+                self.assertFalse(
+                    temp._interface_in_sync('eth0', 'config0'),
+                    'Interface that is down was in sync'
+                )
+
+        self.assertEqual(
+            in_sync.call_count,
+            0,
+            'Interface that is down was compared with the kernel'
+        )
+
+    def test_interface_in_sync_failure(self):
+        from novaagent import netlink
+        temp = libs.DefaultOS()
+        with mock.patch('novaagent.utils.interface_is_up', return_value=True):
+            with mock.patch(
+                'novaagent.netlink.NetlinkSocket',
+                side_effect=netlink.NetlinkError('Test error')
+            ):
+                self.assertFalse(
+                    temp._interface_in_sync('eth0', 'config0'),
+                    'Interface that could not be read was in sync'
+                )
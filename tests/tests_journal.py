@@ -0,0 +1,122 @@
+
+from novaagent import journal
+
+
+import logging
+import glob
+import sys
+import os
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.path = '/tmp/nova-agent-test/journal'
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        for item in glob.glob('/tmp/nova-agent-test/*'):
+            os.remove(item)
+
+        if os.path.exists('/tmp/nova-agent-test'):
+            os.rmdir('/tmp/nova-agent-test')
+
+    def run_event(self, temp, uuids, command):
+        start_time = temp.start(uuids, command)
+        temp.finish(
+            uuids,
+            command,
+            start_time,
+            {'message': command, 'returncode': '0'}
+        )
+
+    def test_replay_completed_event(self):
+        temp = journal.Journal(self.path)
+        temp.open()
+        self.run_event(temp, ['1', '2'], 'resetnetwork')
+        temp.start(['3'], 'version')
+        temp.close()
+
+        temp = journal.Journal(self.path)
+        temp.open()
+        self.assertEqual(
+            temp.get_result('2'),
+            {'message': 'resetnetwork', 'returncode': '0'},
+            'Completed event was not replayed from the journal'
+        )
+        self.assertEqual(
+            temp.get_result('3'),
+            None,
+            'Event that never finished was treated as completed'
+        )
+        temp.close()
+
+    def test_keyinit_not_replayed(self):
+        temp = journal.Journal(self.path)
+        temp.open()
+        self.run_event(temp, ['1'], 'keyinit')
+        self.assertEqual(
+            temp.get_result('1'),
+            None,
+            'keyinit was answered from the journal'
+        )
+        temp.close()
+
+    def test_corrupt_line(self):
+        temp = journal.Journal(self.path)
+        temp.open()
+        self.run_event(temp, ['1'], 'version')
+        temp.close()
+        with open(self.path, 'a') as f:
+            f.write('{"uuids": ["2"], "comm')
+
+        temp = journal.Journal(self.path)
+        temp.open()
+        self.assertEqual(
+            temp.get_result('1'),
+            {'message': 'version', 'returncode': '0'},
+            'Journal was not replayed past a partial line'
+        )
+        temp.close()
+
+    def test_compaction(self):
+        temp = journal.Journal(self.path, max_entries=5)
+        temp.open()
+        for count in range(20):
+            self.run_event(temp, [str(count)], 'version')
+
+        temp.close()
+        with open(self.path) as f:
+            lines = f.readlines()
+
+        self.assertLessEqual(
+            len(lines),
+            10,
+            'Journal was not compacted'
+        )
+        self.assertEqual(
+            temp.get_result('0'),
+            None,
+            'Oldest event was not dropped from the journal'
+        )
+        self.assertNotEqual(
+            temp.get_result('19'),
+            None,
+            'Newest event was dropped from the journal'
+        )
+
+    def test_file_mode(self):
+        temp = journal.Journal(self.path)
+        temp.open()
+        temp.close()
+        self.assertEqual(
+            os.stat(self.path).st_mode & 0o777,
+            0o600,
+            'Journal is readable by other users'
+        )
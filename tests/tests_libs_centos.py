@@ -1,5 +1,7 @@
 
 from novaagent.libs import centos
+from novaagent import netconfig
+from novaagent import utils
 from .fixtures import xen_data
 from .fixtures import network
 
@@ -116,8 +118,12 @@ class TestHelpers(TestCase):
             'novaagent.libs.centos.ServerOS._setup_hostname'
         ) as hostname:
             hostname.return_value = 0, 'test_hostname'
-            with mock.patch('novaagent.utils.list_xenstore_macaddrs') as mac:
-                mac.return_value = ['BC764E206C5B']
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
                 with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
                     hwint.return_value = ['eth1', 'lo']
                     mock_response = mock.Mock()
@@ -130,27 +136,21 @@ class TestHelpers(TestCase):
                         side_effect=mock_response
                     ):
                         with mock.patch(
-                            'novaagent.utils.get_interface'
-                        ) as inter:
-                            inter.return_value = (
-                                xen_data.check_network_interface()
-                            )
+                            'novaagent.utils.get_ifcfg_files_to_remove'
+                        ) as ifcfg_files:
+                            ifcfg_files.return_value = ['/tmp/ifcfg-eth1']
                             with mock.patch(
-                                'novaagent.utils.get_ifcfg_files_to_remove'
-                            ) as ifcfg_files:
-                                ifcfg_files.return_value = ['/tmp/ifcfg-eth1']
-                                with mock.patch(
-                                    'novaagent.libs.centos.Popen'
-                                ) as p:
-                                    p.return_value.communicate.return_value = (
-                                        'out', 'error'
-                                    )
-                                    p.return_value.returncode = 0
-                                    result = temp.resetnetwork(
-                                        'name',
-                                        'value',
-                                        'dummy_client'
-                                    )
+                                'novaagent.libs.centos.Popen'
+                            ) as p:
+                                p.return_value.communicate.return_value = (
+                                    'out', 'error'
+                                )
+                                p.return_value.returncode = 0
+                                result = temp.resetnetwork(
+                                    'name',
+                                    'value',
+                                    'dummy_client'
+                                )
 
         self.assertEqual(
             result,
@@ -182,11 +182,7 @@ class TestHelpers(TestCase):
             'Localhost ifcfg file was moved out of the way and should not have'
         )
 
-    def test_reset_network_error(self):
-        self.setup_temp_route()
-        self.setup_temp_interface_config('eth1')
-        self.setup_temp_interface_config('lo')
-        self.setup_temp_network()
+    def test_reset_network_unchanged(self):
         temp = centos.ServerOS()
         temp.netconfig_dir = '/tmp'
         temp.network_file = '/tmp/network'
@@ -194,35 +190,322 @@ class TestHelpers(TestCase):
             'novaagent.libs.centos.ServerOS._setup_hostname'
         ) as hostname:
             hostname.return_value = 0, 'test_hostname'
-            with mock.patch('novaagent.utils.list_xenstore_macaddrs') as mac:
-                mac.return_value = ['BC764E206C5B']
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
                 with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
                     hwint.return_value = ['eth1']
-                    with mock.patch('novaagent.utils.get_hw_addr') as addr:
-                        addr.return_value = 'BC764E206C5B'
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        return_value='BC764E206C5B'
+                    ):
                         with mock.patch(
-                            'novaagent.utils.get_interface'
-                        ) as inter:
-                            inter.return_value = (
-                                xen_data.check_network_interface()
-                            )
+                            'novaagent.utils.get_ifcfg_files_to_remove',
+                            return_value=[]
+                        ):
                             with mock.patch(
-                                'novaagent.utils.get_ifcfg_files_to_remove'
-                            ) as ifcfg_files:
-                                ifcfg_files.return_value = ['/tmp/ifcfg-eth1']
+                                'novaagent.libs.DefaultOS._interface_in_sync',
+                                return_value=True
+                            ):
                                 with mock.patch(
                                     'novaagent.libs.centos.Popen'
                                 ) as p:
                                     p.return_value.communicate.return_value = (
                                         'out', 'error'
                                     )
-                                    p.return_value.returncode = 1
+                                    p.return_value.returncode = 0
+                                    results = [
+                                        temp.resetnetwork(
+                                            'name',
+                                            'value',
+                                            'dummy_client'
+                                        ) for count in range(2)
+                                    ]
+
+        self.assertEqual(
+            results,
+            [('0', ''), ('0', '')],
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            p.call_count,
+            1,
+            'Network was restarted when the configuration did not change'
+        )
+        self.assertEqual(
+            len(glob.glob('/tmp/ifcfg-eth1*')),
+            1,
+            'Unchanged interface file was backed up and written again'
+        )
+
+    def test_reset_network_kernel_drift(self):
+        temp = centos.ServerOS()
+        temp.netconfig_dir = '/tmp'
+        temp.network_file = '/tmp/network'
+        with mock.patch(
+            'novaagent.libs.centos.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth1']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        return_value='BC764E206C5B'
+                    ):
+                        with mock.patch(
+                            'novaagent.utils.get_ifcfg_files_to_remove',
+                            return_value=[]
+                        ):
+                            with mock.patch(
+                                'novaagent.libs.DefaultOS._interface_in_sync',
+                                return_value=False
+                            ):
+                                with mock.patch(
+                                    'novaagent.libs.centos.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = (
+                                        'out', 'error'
+                                    )
+                                    p.return_value.returncode = 0
+                                    results = [
+                                        temp.resetnetwork(
+                                            'name',
+                                            'value',
+                                            'dummy_client'
+                                        ) for count in range(2)
+                                    ]
+
+        self.assertEqual(
+            results,
+            [('0', ''), ('0', '')],
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            [call[0][0] for call in p.call_args_list[1:]],
+            [['ifdown', 'eth1'], ['ifup', 'eth1']],
+            'Interface the kernel no longer runs as configured was not '
+            'restarted'
+        )
+
+    def reset_network_interfaces(
+        self,
+        returncodes,
+        timings=False,
+        hostname='test_hostname',
+        removed=None
+    ):
+        with open('/tmp/network', 'w') as f:
+            f.write(
+                'NETWORKING=yes\n'
+                'NOZEROCONF=yes\n'
+                'NETWORKING_IPV6=yes\n'
+                'HOSTNAME={0}\n'.format(hostname)
+            )
+
+        self.setup_temp_interface_config('eth1')
+        temp = centos.ServerOS()
+        temp.netconfig_dir = '/tmp'
+        temp.network_file = '/tmp/network'
+        if timings is not False:
+            temp.network_engine = 'netlink'
+            patcher = mock.patch(
+                'novaagent.libs.DefaultOS._apply_netlink',
+                return_value=timings
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        def popen(command, **kwargs):
+            process = mock.Mock()
+            process.communicate.return_value = ('out', 'error')
+            process.returncode = returncodes.get(command[0], 0)
+            return process
+
+        exists = os.path.exists
+
+        with mock.patch(
+            'novaagent.libs.centos.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth1']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        return_value='BC764E206C5B'
+                    ):
+                        with mock.patch(
+                            'novaagent.utils.get_ifcfg_files_to_remove',
+                            return_value=removed or []
+                        ):
+                            with mock.patch(
+                                'novaagent.libs.centos.os.path.exists',
+                                side_effect=lambda path: (
+                                    path == '/usr/bin/systemctl' or
+                                    exists(path)
+                                )
+                            ):
+                                with mock.patch(
+                                    'novaagent.libs.centos.Popen',
+                                    side_effect=popen
+                                ) as p:
                                     result = temp.resetnetwork(
                                         'name',
                                         'value',
                                         'dummy_client'
                                     )
 
+        return result, [call[0][0] for call in p.call_args_list]
+
+    def test_reset_network_interfaces(self):
+        result, commands = self.reset_network_interfaces({})
+        self.assertEqual(
+            result,
+            ('0', ''),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [['ifdown', 'eth1'], ['ifup', 'eth1']],
+            'Changed interface was not restarted on its own'
+        )
+
+    def test_reset_network_interfaces_fallback(self):
+        result, commands = self.reset_network_interfaces({'ifup': 1})
+        self.assertEqual(
+            result,
+            ('0', ''),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [
+                ['ifdown', 'eth1'],
+                ['ifup', 'eth1'],
+                ['systemctl', 'restart', 'network.service']
+            ],
+            'Network service was not restarted after ifup failed'
+        )
+
+    def test_reset_network_interfaces_removed_file(self):
+        with open('/tmp/ifcfg-eth9', 'w') as f:
+            f.write('DEVICE=eth9\n')
+
+        result, commands = self.reset_network_interfaces(
+            {},
+            removed=['/tmp/ifcfg-eth9']
+        )
+        self.assertEqual(
+            result,
+            ('0', ''),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [['ifdown', 'eth1'], ['ifup', 'eth1']],
+            'Network service was restarted for a removed interface file'
+        )
+        self.assertFalse(
+            os.path.exists('/tmp/ifcfg-eth9'),
+            'Removed interface file was not moved out of the way'
+        )
+
+    def test_reset_network_hostname_changed(self):
+        result, commands = self.reset_network_interfaces(
+            {},
+            'eth1: 0.01s',
+            hostname='old_hostname'
+        )
+        self.assertEqual(
+            result,
+            ('0', ''),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [['systemctl', 'restart', 'network.service']],
+            'Network service was not restarted for a new network file'
+        )
+
+    def test_reset_network_netlink(self):
+        result, commands = self.reset_network_interfaces({}, 'eth1: 0.01s')
+        self.assertEqual(
+            result,
+            ('0', 'eth1: 0.01s'),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [],
+            'Interface was restarted after it was applied over netlink'
+        )
+
+    def test_reset_network_netlink_fallback(self):
+        result, commands = self.reset_network_interfaces({}, None)
+        self.assertEqual(
+            result,
+            ('0', ''),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            commands,
+            [['ifdown', 'eth1'], ['ifup', 'eth1']],
+            'Interface was not restarted after netlink failed'
+        )
+
+    def test_reset_network_error(self):
+        self.setup_temp_route()
+        self.setup_temp_interface_config('eth1')
+        self.setup_temp_interface_config('lo')
+        self.setup_temp_network()
+        temp = centos.ServerOS()
+        temp.netconfig_dir = '/tmp'
+        temp.network_file = '/tmp/network'
+        with mock.patch(
+            'novaagent.libs.centos.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth1']
+                    with mock.patch('novaagent.utils.get_hw_addr') as addr:
+                        addr.return_value = 'BC764E206C5B'
+                        with mock.patch(
+                            'novaagent.utils.get_ifcfg_files_to_remove'
+                        ) as ifcfg_files:
+                            ifcfg_files.return_value = ['/tmp/ifcfg-eth1']
+                            with mock.patch(
+                                'novaagent.libs.centos.Popen'
+                            ) as p:
+                                p.return_value.communicate.return_value = (
+                                    'out', 'error'
+                                )
+                                p.return_value.returncode = 1
+                                result = temp.resetnetwork(
+                                    'name',
+                                    'value',
+                                    'dummy_client'
+                                )
+
         self.assertEqual(
             result,
             ('1', 'Error restarting network'),
@@ -274,10 +557,12 @@ class TestHelpers(TestCase):
                 'novaagent.libs.centos.ServerOS._setup_hostname'
             ) as hostname:
                 hostname.return_value = 0, 'test_hostname'
-                with mock.patch(
-                    'novaagent.utils.list_xenstore_macaddrs'
-                ) as mac:
-                    mac.return_value = ['BC764E206C5B']
+                with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                    vm_data.return_value = utils.VMDataSnapshot(
+                        xen_data.get_vm_data({
+                            'BC764E206C5B': xen_data.check_network_interface()
+                        })
+                    )
                     with mock.patch(
                         'novaagent.utils.list_hw_interfaces'
                     ) as hwint:
@@ -287,27 +572,21 @@ class TestHelpers(TestCase):
                         ) as hw_addr:
                             hw_addr.return_value = 'BC764E206C5B'
                             with mock.patch(
-                                'novaagent.utils.get_interface'
-                            ) as inter:
-                                inter.return_value = (
-                                    xen_data.check_network_interface()
-                                )
+                                'novaagent.utils.get_ifcfg_files_to_remove'
+                            ) as ifcfg_files:
+                                ifcfg_files.return_value = [
+                                    '/tmp/ifcfg-eth1'
+                                ]
                                 with mock.patch(
-                                    'novaagent.utils.get_ifcfg_files_to_remove'
-                                ) as ifcfg_files:
-                                    ifcfg_files.return_value = [
-                                        '/tmp/ifcfg-eth1'
-                                    ]
-                                    with mock.patch(
-                                        'novaagent.libs.centos.Popen'
-                                    ) as p:
-                                        p.return_value.communicate.return_value = ('out', 'error')  # noqa
-                                        p.return_value.returncode = 0
-                                        result = temp.resetnetwork(
-                                            'name',
-                                            'value',
-                                            'dummy_client'
-                                        )
+                                    'novaagent.libs.centos.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = ('out', 'error')  # noqa
+                                    p.return_value.returncode = 0
+                                    result = temp.resetnetwork(
+                                        'name',
+                                        'value',
+                                        'dummy_client'
+                                    )
 
         self.assertEqual(
             result,
@@ -359,10 +638,12 @@ class TestHelpers(TestCase):
                 'novaagent.libs.centos.ServerOS._setup_hostname'
             ) as hostname:
                 hostname.return_value = 0, 'test_hostname'
-                with mock.patch(
-                    'novaagent.utils.list_xenstore_macaddrs'
-                ) as mac:
-                    mac.return_value = ['BC764E206C5B']
+                with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                    vm_data.return_value = utils.VMDataSnapshot(
+                        xen_data.get_vm_data({
+                            'BC764E206C5B': xen_data.check_network_interface()
+                        })
+                    )
                     with mock.patch(
                         'novaagent.utils.list_hw_interfaces'
                     ) as hwint:
@@ -372,27 +653,21 @@ class TestHelpers(TestCase):
                         ) as hw_addr:
                             hw_addr.return_value = 'BC764E206C5B'
                             with mock.patch(
-                                'novaagent.utils.get_interface'
-                            ) as inter:
-                                inter.return_value = (
-                                    xen_data.check_network_interface()
-                                )
+                                'novaagent.utils.get_ifcfg_files_to_remove'
+                            ) as ifcfg_files:
+                                ifcfg_files.return_value = [
+                                    '/tmp/ifcfg-eth1'
+                                ]
                                 with mock.patch(
-                                    'novaagent.utils.get_ifcfg_files_to_remove'
-                                ) as ifcfg_files:
-                                    ifcfg_files.return_value = [
-                                        '/tmp/ifcfg-eth1'
-                                    ]
-                                    with mock.patch(
-                                        'novaagent.libs.centos.Popen'
-                                    ) as p:
-                                        p.return_value.communicate.return_value = ('out', 'error')  # noqa
-                                        p.return_value.returncode = 1
-                                        result = temp.resetnetwork(
-                                            'name',
-                                            'value',
-                                            'dummy_client'
-                                        )
+                                    'novaagent.libs.centos.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = ('out', 'error')  # noqa
+                                    p.return_value.returncode = 1
+                                    result = temp.resetnetwork(
+                                        'name',
+                                        'value',
+                                        'dummy_client'
+                                    )
 
         self.assertEqual(
             result,
@@ -428,7 +703,9 @@ class TestHelpers(TestCase):
         self.setup_temp_route()
         temp = centos.ServerOS()
         temp.netconfig_dir = '/tmp'
-        temp_iface = xen_data.check_network_interface()
+        temp_iface = netconfig.parse_interface(
+            xen_data.check_network_interface()
+        )
         temp._setup_routes('eth1', temp_iface)
         files = glob.glob('/tmp/route-eth1*')
         self.assertEqual(
@@ -450,7 +727,7 @@ class TestHelpers(TestCase):
         self.setup_temp_interface_config('eth0')
         temp = centos.ServerOS()
         temp.netconfig_dir = '/tmp'
-        temp_iface = network.ETH0_INTERFACE
+        temp_iface = netconfig.parse_interface(network.ETH0_INTERFACE)
         temp._setup_interface('eth0', temp_iface)
 
         files = glob.glob('/tmp/ifcfg-eth0*')
@@ -473,7 +750,9 @@ class TestHelpers(TestCase):
         self.setup_temp_interface_config('eth1')
         temp = centos.ServerOS()
         temp.netconfig_dir = '/tmp'
-        temp_iface = xen_data.check_network_interface()
+        temp_iface = netconfig.parse_interface(
+            xen_data.check_network_interface()
+        )
         temp._setup_interface('eth1', temp_iface)
 
         files = glob.glob('/tmp/ifcfg-eth1*')
@@ -1,5 +1,8 @@
 
 from novaagent.libs import debian
+from novaagent import netconfig
+from novaagent import netlink
+from novaagent import utils
 from .fixtures import xen_data
 from .fixtures import network
 
@@ -25,6 +28,13 @@ except ImportError:
 class TestHelpers(TestCase):
     def setUp(self):
         logging.disable(logging.ERROR)
+        # The test interfaces do not exist, do not wait on their links
+        patcher = mock.patch(
+            'novaagent.utils.wait_for_link',
+            return_value=True
+        )
+        self.wait_for_link = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         logging.disable(logging.NOTSET)
@@ -45,21 +55,6 @@ class TestHelpers(TestCase):
         with open('/tmp/interfaces', 'a+') as f:
             f.write('#This is a test file\n')
 
-    def test_setup_loopback(self):
-        temp = debian.ServerOS()
-        temp.netconfig_file = '/tmp/interfaces'
-        temp._setup_loopback()
-
-        with open('/tmp/interfaces') as f:
-            written_data = f.readlines()
-
-        for index, line in enumerate(written_data):
-            self.assertEqual(
-                line,
-                network.DEBIAN_INTERFACES_LOOPBACK[index],
-                'Written file did not match expected value'
-            )
-
     def test_reset_network_hostname_failure(self):
         self.setup_temp_hostname()
         self.setup_temp_interfaces()
@@ -88,8 +83,12 @@ class TestHelpers(TestCase):
             'novaagent.libs.debian.ServerOS._setup_hostname'
         ) as hostname:
             hostname.return_value = 0, 'test_hostname'
-            with mock.patch('novaagent.utils.list_xenstore_macaddrs') as mac:
-                mac.return_value = ['BC764E206C5B']
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
                 with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
                     hwint.return_value = ['eth1']
                     mock_hw_address = mock.Mock()
@@ -100,26 +99,18 @@ class TestHelpers(TestCase):
                         'novaagent.utils.get_hw_addr',
                         side_effect=mock_hw_address
                     ):
-                        mock_interface = mock.Mock()
-                        mock_interface.side_effect = [
-                            xen_data.check_network_interface()
-                        ]
                         with mock.patch(
-                            'novaagent.utils.get_interface',
-                            side_effect=mock_interface
-                        ):
-                            with mock.patch(
-                                'novaagent.libs.debian.Popen'
-                            ) as p:
-                                p.return_value.communicate.return_value = (
-                                    'out', 'error'
-                                )
-                                p.return_value.returncode = 1
-                                result = temp.resetnetwork(
-                                    'name',
-                                    'value',
-                                    'dummy_client'
-                                )
+                            'novaagent.libs.debian.Popen'
+                        ) as p:
+                            p.return_value.communicate.return_value = (
+                                'out', 'error'
+                            )
+                            p.return_value.returncode = 1
+                            result = temp.resetnetwork(
+                                'name',
+                                'value',
+                                'dummy_client'
+                            )
 
         self.assertEqual(
             result,
@@ -143,8 +134,12 @@ class TestHelpers(TestCase):
             'novaagent.libs.debian.ServerOS._setup_hostname'
         ) as hostname:
             hostname.return_value = 0, 'test_hostname'
-            with mock.patch('novaagent.utils.list_xenstore_macaddrs') as mac:
-                mac.return_value = ['BC764E206C5B']
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
                 with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
                     hwint.return_value = ['eth1']
                     mock_hw_address = mock.Mock()
@@ -155,30 +150,22 @@ class TestHelpers(TestCase):
                         'novaagent.utils.get_hw_addr',
                         side_effect=mock_hw_address
                     ):
-                        mock_interface = mock.Mock()
-                        mock_interface.side_effect = [
-                            xen_data.check_network_interface()
+                        mock_popen = mock.Mock()
+                        mock_comm = mock.Mock()
+                        mock_comm.return_value = ('out', 'error')
+                        mock_popen.side_effect = [
+                            mock.Mock(returncode=0, communicate=mock_comm),
+                            mock.Mock(returncode=1, communicate=mock_comm)
                         ]
                         with mock.patch(
-                            'novaagent.utils.get_interface',
-                            side_effect=mock_interface
+                            'novaagent.libs.debian.Popen',
+                            side_effect=mock_popen
                         ):
-                            mock_popen = mock.Mock()
-                            mock_comm = mock.Mock()
-                            mock_comm.return_value = ('out', 'error')
-                            mock_popen.side_effect = [
-                                mock.Mock(returncode=0, communicate=mock_comm),
-                                mock.Mock(returncode=1, communicate=mock_comm)
-                            ]
-                            with mock.patch(
-                                'novaagent.libs.debian.Popen',
-                                side_effect=mock_popen
-                            ):
-                                result = temp.resetnetwork(
-                                    'name',
-                                    'value',
-                                    'dummy_client'
-                                )
+                            result = temp.resetnetwork(
+                                'name',
+                                'value',
+                                'dummy_client'
+                            )
 
         self.assertEqual(
             result,
@@ -192,6 +179,123 @@ class TestHelpers(TestCase):
             'Incorrect number of interface files'
         )
 
+    def test_reset_network_error_every_interface(self):
+        temp = debian.ServerOS()
+        temp.netconfig_file = '/tmp/interfaces'
+
+        def popen(command, **kwargs):
+            process = mock.Mock()
+            process.communicate.return_value = ('out', 'error')
+            process.returncode = int(
+                command in (['ifdown', 'eth0'], ['ifup', 'eth1'])
+            )
+            return process
+
+        with mock.patch(
+            'novaagent.libs.debian.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E207572': network.ETH0_INTERFACE,
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth0', 'eth1']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        side_effect=['BC764E207572', 'BC764E206C5B']
+                    ):
+                        with mock.patch(
+                            'novaagent.libs.debian.Popen',
+                            side_effect=popen
+                        ) as p:
+                            result = temp.resetnetwork(
+                                'name',
+                                'value',
+                                'dummy_client'
+                            )
+
+        self.assertEqual(
+            result,
+            (
+                '1',
+                'Error stopping network: eth0, '
+                'Error starting network: eth1'
+            ),
+            'Every failed interface was not reported'
+        )
+        self.assertIn(
+            mock.call(
+                ['ifup', 'eth1'],
+                stdout=mock.ANY,
+                stderr=mock.ANY,
+                stdin=mock.ANY
+            ),
+            p.call_args_list,
+            'Interface after the failed one was not restarted'
+        )
+
+    def test_reset_network_netlink_partly_applied(self):
+        temp = debian.ServerOS()
+        temp.netconfig_file = '/tmp/interfaces'
+        temp.network_engine = 'netlink'
+        with mock.patch(
+            'novaagent.libs.debian.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E207572': network.ETH0_INTERFACE,
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth0', 'eth1']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        side_effect=['BC764E207572', 'BC764E206C5B']
+                    ):
+                        with mock.patch('novaagent.netlink.NetlinkSocket'):
+                            # eth0 is applied and eth1 fails part way
+                            with mock.patch(
+                                'novaagent.netlink.apply_interface',
+                                side_effect=[
+                                    None,
+                                    netlink.NetlinkError(
+                                        'eth1: add route 10.208.0.0/12 via '
+                                        '10.208.224.1 (Network is unreachable)'
+                                    )
+                                ]
+                            ):
+                                with mock.patch(
+                                    'novaagent.libs.debian.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = (
+                                        'out', 'error'
+                                    )
+                                    p.return_value.returncode = 0
+                                    result = temp.resetnetwork(
+                                        'name',
+                                        'value',
+                                        'dummy_client'
+                                    )
+
+        self.assertEqual(result[0], '0', 'Result was not the expected value')
+        self.assertEqual(
+            sorted(call[0][0] for call in p.call_args_list),
+            [
+                ['ifdown', 'eth0'],
+                ['ifdown', 'eth1'],
+                ['ifup', 'eth0'],
+                ['ifup', 'eth1']
+            ],
+            'Every interface was not restored after netlink failed'
+        )
+
     def test_reset_network_success(self):
         self.setup_temp_hostname()
         self.setup_temp_interfaces()
@@ -202,8 +306,13 @@ class TestHelpers(TestCase):
             'novaagent.libs.debian.ServerOS._setup_hostname'
         ) as hostname:
             hostname.return_value = 0, 'test_hostname'
-            with mock.patch('novaagent.utils.list_xenstore_macaddrs') as mac:
-                mac.return_value = ['BC764E207572', 'BC764E206C5B']
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E207572': network.ETH0_INTERFACE,
+                        'BC764E206C5B': xen_data.check_network_interface()
+                    })
+                )
                 with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
                     hwint.return_value = ['eth0', 'eth1']
                     mock_hw_address = mock.Mock()
@@ -215,39 +324,40 @@ class TestHelpers(TestCase):
                         'novaagent.utils.get_hw_addr',
                         side_effect=mock_hw_address
                     ):
-                        mock_interface = mock.Mock()
-                        mock_interface.side_effect = [
-                            network.ETH0_INTERFACE,
-                            xen_data.check_network_interface()
+                        mock_popen = mock.Mock()
+                        mock_comm = mock.Mock()
+                        mock_comm.return_value = ('out', 'error')
+                        mock_popen.side_effect = [
+                            mock.Mock(returncode=0, communicate=mock_comm),
+                            mock.Mock(returncode=0, communicate=mock_comm),
+                            mock.Mock(returncode=0, communicate=mock_comm),
+                            mock.Mock(returncode=0, communicate=mock_comm)
                         ]
                         with mock.patch(
-                            'novaagent.utils.get_interface',
-                            side_effect=mock_interface
+                            'novaagent.libs.debian.Popen',
+                            side_effect=mock_popen
                         ):
-                            mock_popen = mock.Mock()
-                            mock_comm = mock.Mock()
-                            mock_comm.return_value = ('out', 'error')
-                            mock_popen.side_effect = [
-                                mock.Mock(returncode=0, communicate=mock_comm),
-                                mock.Mock(returncode=0, communicate=mock_comm),
-                                mock.Mock(returncode=0, communicate=mock_comm),
-                                mock.Mock(returncode=0, communicate=mock_comm)
-                            ]
-                            with mock.patch(
-                                'novaagent.libs.debian.Popen',
-                                side_effect=mock_popen
-                            ):
-                                result = temp.resetnetwork(
-                                    'name',
-                                    'value',
-                                    'dummy_client'
-                                )
+                            result = temp.resetnetwork(
+                                'name',
+                                'value',
+                                'dummy_client'
+                            )
 
         self.assertEqual(
-            result,
-            ('0', ''),
+            result[0],
+            '0',
             'Result was not the expected value'
         )
+        self.assertEqual(
+            [timing.split(':')[0] for timing in result[1].split(', ')],
+            ['eth0', 'eth1'],
+            'Timing was not reported for every interface'
+        )
+        self.assertEqual(
+            self.wait_for_link.call_count,
+            4,
+            'Link state was not waited on after ifdown and ifup'
+        )
         interface_files = glob.glob('/tmp/interfaces*')
         self.assertEqual(
             len(interface_files),
@@ -257,46 +367,203 @@ class TestHelpers(TestCase):
         with open('/tmp/interfaces') as f:
             written_data = f.readlines()
 
-        update_config = network.DEBIAN_INTERFACES_CONFIG
-        del update_config[0]
-        loopback = [
-            '# The loopback network interface\n',
-            'auto lo\n',
-            'iface lo inet loopback\n',
-            '\n'
-        ]
-        check_success = loopback + update_config
-        for index, line in enumerate(written_data):
+        self.assertEqual(
+            written_data,
+            (
+                network.DEBIAN_INTERFACES_LOOPBACK +
+                network.DEBIAN_INTERFACES_CONFIG[1:]
+            ),
+            'Written file did not match expected value'
+        )
+
+    def test_reset_network_only_changed(self):
+        temp = debian.ServerOS()
+        temp.netconfig_file = '/tmp/interfaces'
+        eth1 = xen_data.check_network_interface()
+        with open('/tmp/interfaces', 'w') as f:
+            f.write(
+                debian.LOOPBACK_CONFIG +
+                temp._render_interface(
+                    'eth0',
+                    netconfig.parse_interface(network.ETH0_INTERFACE)
+                ) +
+                temp._render_interface('eth1', netconfig.parse_interface(eth1))
+            )
+
+        eth1['ips'][0]['ip'] = '10.0.0.99'
+        with mock.patch(
+            'novaagent.libs.debian.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({
+                        'BC764E207572': network.ETH0_INTERFACE,
+                        'BC764E206C5B': eth1
+                    })
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth0', 'eth1']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        side_effect=['BC764E207572', 'BC764E206C5B']
+                    ):
+                        with mock.patch(
+                            'novaagent.libs.DefaultOS._interface_in_sync',
+                            return_value=True
+                        ):
+                            with mock.patch(
+                                'novaagent.libs.debian.time'
+                            ) as mock_time:
+                                mock_time.time.side_effect = [10.0, 11.5]
+                                with mock.patch(
+                                    'novaagent.libs.debian.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = (
+                                        'out', 'error'
+                                    )
+                                    p.return_value.returncode = 0
+                                    result = temp.resetnetwork(
+                                        'name',
+                                        'value',
+                                        'dummy_client'
+                                    )
+
+        self.assertEqual(
+            result,
+            ('0', 'eth1: 1.50s'),
+            'Result was not the expected value'
+        )
+        self.assertEqual(
+            [call[0][0] for call in p.call_args_list],
+            [['ifdown', 'eth1'], ['ifup', 'eth1']],
+            'Only the changed interface should have been restarted'
+        )
+        with open('/tmp/interfaces') as f:
             self.assertIn(
-                line,
-                check_success,
-                'Written file did not match expected value'
+                '\taddress 10.0.0.99\n',
+                f.read(),
+                'Changed interface was not written'
             )
 
-    def test_interface_setup(self):
-        self.setup_temp_interfaces()
+    def test_current_interfaces(self):
         temp = debian.ServerOS()
         temp.netconfig_file = '/tmp/interfaces'
-        temp_iface = network.ETH0_INTERFACE
-        temp._setup_interface('eth0', temp_iface)
-        temp_iface = xen_data.check_network_interface()
-        temp._setup_interface('eth1', temp_iface)
-        files = glob.glob('/tmp/interfaces*')
+        eth0 = temp._render_interface(
+            'eth0',
+            netconfig.parse_interface(network.ETH0_INTERFACE)
+        )
+        eth1 = temp._render_interface(
+            'eth1',
+            netconfig.parse_interface(xen_data.check_network_interface())
+        )
+        with open('/tmp/interfaces', 'w') as f:
+            f.write(debian.LOOPBACK_CONFIG + eth0 + eth1)
+
         self.assertEqual(
-            len(files),
-            1,
-            'Did not find correct number of files'
+            temp._current_interfaces(),
+            {'eth0': eth0, 'eth1': eth1},
+            'Stanzas were not split by interface'
         )
-        with open('/tmp/interfaces') as f:
-            written_data = f.readlines()
 
-        for index, line in enumerate(written_data):
-            self.assertEqual(
-                line,
-                network.DEBIAN_INTERFACES_CONFIG[index],
-                'Written file did not match expected value'
+    def test_reset_network_netlink_dns_changed(self):
+        temp = debian.ServerOS()
+        temp.netconfig_file = '/tmp/interfaces'
+        temp.network_engine = 'netlink'
+        with open('/tmp/interfaces', 'w') as f:
+            f.write(
+                debian.LOOPBACK_CONFIG +
+                temp._render_interface(
+                    'eth0',
+                    netconfig.parse_interface(network.ETH0_INTERFACE)
+                )
             )
 
+        eth0 = dict(network.ETH0_INTERFACE, dns=['72.3.128.240'])
+        with mock.patch(
+            'novaagent.libs.debian.ServerOS._setup_hostname'
+        ) as hostname:
+            hostname.return_value = 0, 'test_hostname'
+            with mock.patch('novaagent.utils.snapshot_vm_data') as vm_data:
+                vm_data.return_value = utils.VMDataSnapshot(
+                    xen_data.get_vm_data({'BC764E207572': eth0})
+                )
+                with mock.patch('novaagent.utils.list_hw_interfaces') as hwint:
+                    hwint.return_value = ['eth0']
+                    with mock.patch(
+                        'novaagent.utils.get_hw_addr',
+                        return_value='BC764E207572'
+                    ):
+                        with mock.patch(
+                            'novaagent.utils.get_nameservers',
+                            return_value=['69.20.0.164', '69.20.0.196']
+                        ):
+                            with mock.patch(
+                                'novaagent.netlink.apply_interface'
+                            ) as apply:
+                                with mock.patch(
+                                    'novaagent.libs.debian.Popen'
+                                ) as p:
+                                    p.return_value.communicate.return_value = (
+                                        'out', 'error'
+                                    )
+                                    p.return_value.returncode = 0
+                                    result = temp.resetnetwork(
+                                        'name',
+                                        'value',
+                                        'dummy_client'
+                                    )
+
+        self.assertEqual(result[0], '0', 'Result was not the expected value')
+        self.assertEqual(
+            (
+                apply.call_count,
+                [call[0][0] for call in p.call_args_list]
+            ),
+            (0, [['ifdown', 'eth0'], ['ifup', 'eth0']]),
+            'New DNS servers were not applied by ifdown and ifup'
+        )
+
+    def test_render_interface(self):
+        temp = debian.ServerOS()
+        rendered = temp._render_interface(
+            'eth0',
+            netconfig.parse_interface(network.ETH0_INTERFACE)
+        ) + temp._render_interface(
+            'eth1',
+            netconfig.parse_interface(xen_data.check_network_interface())
+        )
+        self.assertEqual(
+            rendered.splitlines(True),
+            network.DEBIAN_INTERFACES_CONFIG[1:],
+            'Rendered stanzas did not match expected value'
+        )
+
+    def test_render_interface_ip6s(self):
+        temp = debian.ServerOS()
+        iface = netconfig.parse_interface({
+            'label': 'public',
+            'ips': [],
+            'ip6s': [
+                {'ip': '2001:db8::5', 'netmask': 64},
+                {'ip': '2001:db8::6', 'netmask': 64}
+            ]
+        })
+        self.assertEqual(
+            temp._render_interface('eth0', iface),
+            '# Label public\n'
+            '\n'
+            'iface eth0 inet6 static\n'
+            '\taddress 2001:db8::5\n'
+            '\tnetmask 64\n'
+            '\n'
+            'iface eth0:1 inet6 static\n'
+            '\taddress 2001:db8::6\n'
+            '\tnetmask 64\n'
+            '\n',
+            'Second IPv6 address was not rendered on its own line'
+        )
+
     def test_setup_hostname_hostname_success(self):
         self.setup_temp_hostname()
         temp = debian.ServerOS()
@@ -0,0 +1,95 @@
+
+from novaagent import netconfig
+from .fixtures import xen_data
+from .fixtures import network
+
+
+import ipaddress
+import logging
+import copy
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+class TestNetconfig(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_parse_interface(self):
+        iface = netconfig.parse_interface(network.ETH0_INTERFACE)
+        self.assertEqual(
+            (
+                iface.label,
+                [str(address) for address in iface.ips],
+                [address.with_prefixlen for address in iface.ip6s],
+                iface.gateway,
+                iface.gateway_v6,
+                [str(dns) for dns in iface.dns],
+                iface.routes
+            ),
+            (
+                'public',
+                ['104.130.4.72/24', '104.130.4.73/24'],
+                [
+                    '2001:4802:7802:104:be76:4eff:fe20:7572/64',
+                    '2001:4802:7802:104:be76:4eff:fe20:7573/64'
+                ],
+                ipaddress.ip_address(u'104.130.4.1'),
+                ipaddress.ip_address(u'fe80::def'),
+                ['69.20.0.164', '69.20.0.196'],
+                None
+            ),
+            'Interface was not parsed into the model'
+        )
+
+    def test_parse_interface_routes(self):
+        iface = netconfig.parse_interface(xen_data.check_network_interface())
+        self.assertEqual(
+            [
+                (str(route.route), str(route.netmask), str(route.gateway))
+                for route in iface.routes
+            ],
+            [
+                ('10.208.0.0', '255.240.0.0', '10.208.224.1'),
+                ('10.176.0.0', '255.240.0.0', '10.208.224.1')
+            ],
+            'Routes were not parsed into the model'
+        )
+        self.assertEqual(
+            iface.gateway,
+            None,
+            'Null gateway was not parsed as None'
+        )
+
+    def test_parse_interface_invalid(self):
+        def changed(key, value):
+            data = copy.deepcopy(xen_data.check_network_interface())
+            if value is None:
+                del data[key]
+            else:
+                data[key] = value
+
+            return data
+
+        for data in (
+            changed('label', None),
+            changed('ips', None),
+            changed('ips', [{'ip': '10.0.0.300', 'netmask': '255.0.0.0'}]),
+            changed('ips', [{'ip': '10.0.0.3'}]),
+            changed('ips', [{'ip': 'fe80::1', 'netmask': 64}]),
+            changed('ips', [{'ip': '10.0.0.3', 'netmask': '255.0.255.0'}]),
+            changed('routes', [{'route': '10.0.0.0', 'netmask': '255.0.0.0'}]),
+            changed('gateway', 'gateway.example.com'),
+            changed('dns', '8.8.8.8'),
+            'not an interface'
+        ):
+            with self.assertRaises(netconfig.NetworkConfigError):
+                netconfig.parse_interface(data)
@@ -0,0 +1,327 @@
+
+from novaagent import netconfig
+from novaagent import netlink
+
+
+import subprocess
+import logging
+import socket
+import struct
+import json
+import sys
+import os
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+INTERFACE = {
+    'label': 'private',
+    'ips': [
+        {'ip': '10.1.0.5', 'netmask': '255.255.255.0'},
+        {'ip': '10.1.0.6', 'netmask': '255.255.255.0'}
+    ],
+    'ip6s': [{'ip': '2001:db8::5', 'netmask': 64}],
+    'gateway': '10.1.0.1',
+    'routes': [
+        {
+            'route': '10.208.0.0',
+            'netmask': '255.240.0.0',
+            'gateway': '10.1.0.1'
+        }
+    ]
+}
+
+
+# Run in a new user and network namespace against a veth pair, the first
+# apply has to remove addresses left by someone else, one of them the
+# primary address of the configured subnet, and the second one the route
+# and address that were dropped from the configuration. The interface is
+# compared with each configuration after it is applied and again after
+# its gateway was removed
+NAMESPACE_SCRIPT = '''
+import subprocess
+import json
+import sys
+from novaagent import netconfig
+from novaagent import netlink
+
+
+def ip(*args):
+    return subprocess.check_output(('ip',) + args).decode('utf-8')
+
+
+first, second = json.loads(sys.argv[1])
+ip('link', 'add', 'veth0', 'type', 'veth', 'peer', 'name', 'veth1')
+ip('link', 'set', 'veth1', 'up')
+ip('addr', 'add', '192.0.2.99/24', 'dev', 'veth0')
+ip('addr', 'add', '10.1.0.99/24', 'dev', 'veth0')
+results = []
+with netlink.NetlinkSocket() as nl:
+    for data in (first, second):
+        iface = netconfig.parse_interface(data)
+        netlink.apply_interface(nl, 'veth0', iface)
+        results.append((
+            ip('-o', 'link', 'show', 'dev', 'veth0'),
+            ip('-o', 'addr', 'show', 'dev', 'veth0', 'scope', 'global'),
+            ip('route', 'show', 'dev', 'veth0'),
+            netlink.interface_in_sync(nl, 'veth0', iface)
+        ))
+
+    # Someone removes the gateway behind the back of the agent
+    ip('route', 'del', 'default', 'dev', 'veth0')
+    drifted = netlink.interface_in_sync(nl, 'veth0', iface)
+
+print(json.dumps({'results': results, 'drifted': drifted}))
+'''
+
+
+def namespace_available():
+    try:
+        return subprocess.call(
+            ['unshare', '-r', '-n', 'ip', 'link', 'show'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        ) == 0
+    except OSError:
+        return False
+
+
+class FakeNetlink(object):
+    def __init__(self, dumps):
+        self.dumps = dumps
+
+    def dump(self, msg_type, payload):
+        return self.dumps.get(msg_type, [])
+
+
+class TestNetlink(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_attributes(self):
+        data = netlink._attr(netlink.RTA_OIF, struct.pack('=i', 3))
+        data += netlink._attr(netlink.RTA_DST, b'\x0a\x01')
+        self.assertEqual(len(data), 16, 'Attributes were not padded')
+        self.assertEqual(
+            netlink._parse_attrs(data),
+            {
+                netlink.RTA_OIF: struct.pack('=i', 3),
+                netlink.RTA_DST: b'\x0a\x01'
+            },
+            'Attributes were not parsed back'
+        )
+
+    def test_interface_requests(self):
+        stale = netlink.IFADDRMSG.pack(
+            socket.AF_INET,
+            24,
+            0,
+            netlink.RT_SCOPE_UNIVERSE,
+            3
+        ) + netlink._attr(netlink.IFA_LOCAL, socket.inet_aton('192.0.2.99'))
+        link_local = netlink.IFADDRMSG.pack(
+            socket.AF_INET6,
+            64,
+            0,
+            253,
+            3
+        ) + netlink._attr(
+            netlink.IFA_ADDRESS,
+            socket.inet_pton(socket.AF_INET6, 'fe80::1')
+        )
+        kept = netlink.IFADDRMSG.pack(
+            socket.AF_INET,
+            24,
+            0,
+            netlink.RT_SCOPE_UNIVERSE,
+            3
+        ) + netlink._attr(netlink.IFA_LOCAL, socket.inet_aton('10.1.0.5'))
+        nl = FakeNetlink({
+            netlink.RTM_GETADDR: [
+                (netlink.RTM_NEWADDR, stale),
+                (netlink.RTM_NEWADDR, link_local),
+                (netlink.RTM_NEWADDR, kept)
+            ]
+        })
+        with mock.patch(
+            'novaagent.netlink.interface_index',
+            return_value=3
+        ):
+            requests = netlink.interface_requests(
+                nl,
+                'eth1',
+                netconfig.parse_interface(INTERFACE)
+            )
+
+        self.assertEqual(
+            [request.description for request in requests],
+            [
+                'link up',
+                'add address 10.1.0.5/24',
+                'add address 10.1.0.6/24',
+                'add address 2001:db8::5/64',
+                'add route 0.0.0.0/0 via 10.1.0.1',
+                'add route 10.208.0.0/12 via 10.1.0.1',
+                'delete address 192.0.2.99/24',
+                'add address 10.1.0.5/24',
+                'add address 10.1.0.6/24',
+                'add address 2001:db8::5/64',
+                'add route 0.0.0.0/0 via 10.1.0.1',
+                'add route 10.208.0.0/12 via 10.1.0.1'
+            ],
+            'Requests for the interface were not as expected'
+        )
+
+    def test_interface_in_sync(self):
+        addresses = [
+            (
+                netlink.RTM_NEWADDR,
+                netlink.IFADDRMSG.pack(
+                    family,
+                    prefixlen,
+                    0,
+                    netlink.RT_SCOPE_UNIVERSE,
+                    3
+                ) + netlink._attr(
+                    netlink.IFA_ADDRESS,
+                    socket.inet_pton(family, address)
+                )
+            ) for family, address, prefixlen in (
+                (socket.AF_INET, '10.1.0.5', 24),
+                (socket.AF_INET, '10.1.0.6', 24),
+                (socket.AF_INET6, '2001:db8::5', 64)
+            )
+        ]
+        routes = [
+            (
+                netlink.RTM_NEWROUTE,
+                netlink.RTMSG.pack(
+                    socket.AF_INET,
+                    dst_len,
+                    0,
+                    0,
+                    netlink.RT_TABLE_MAIN,
+                    netlink.RTPROT_BOOT,
+                    netlink.RT_SCOPE_UNIVERSE,
+                    netlink.RTN_UNICAST,
+                    0
+                ) + dst + netlink._attr(
+                    netlink.RTA_GATEWAY,
+                    socket.inet_aton('10.1.0.1')
+                ) + netlink._attr(netlink.RTA_OIF, struct.pack('=i', 3))
+            ) for dst_len, dst in (
+                (0, b''),
+                (
+                    12,
+                    netlink._attr(
+                        netlink.RTA_DST,
+                        socket.inet_aton('10.208.0.0')
+                    )
+                )
+            )
+        ]
+        iface = netconfig.parse_interface(INTERFACE)
+        results = []
+        with mock.patch(
+            'novaagent.netlink.interface_index',
+            return_value=3
+        ):
+            for current_addresses, current_routes in (
+                (addresses, routes),
+                (addresses[:1] + addresses[2:], routes),
+                (addresses, routes[:1])
+            ):
+                nl = FakeNetlink({
+                    netlink.RTM_GETADDR: current_addresses,
+                    netlink.RTM_GETROUTE: current_routes
+                })
+                results.append(netlink.interface_in_sync(nl, 'eth1', iface))
+
+        self.assertEqual(
+            results,
+            [True, False, False],
+            'Missing address or route was not noticed'
+        )
+
+    def test_apply_interface_failure(self):
+        nl = mock.Mock()
+        nl.batch.return_value = [('add address 10.1.0.5/24', 'File exists')]
+        with mock.patch(
+            'novaagent.netlink.interface_requests',
+            return_value=[]
+        ):
+            with self.assertRaises(netlink.NetlinkError) as e:
+                netlink.apply_interface(nl, 'eth1', None)
+
+        self.assertEqual(
+            str(e.exception),
+            'eth1: add address 10.1.0.5/24 (File exists)',
+            'Failed request was not reported'
+        )
+
+    def test_apply_interface_namespace(self):
+        if not namespace_available():
+            self.skipTest('Network namespaces are not available')
+
+        second = dict(INTERFACE)
+        second['ips'] = INTERFACE['ips'][:1]
+        second['routes'] = []
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(netlink.__file__))
+        )
+        output = subprocess.check_output(
+            [
+                'unshare',
+                '-r',
+                '-n',
+                sys.executable,
+                '-c',
+                NAMESPACE_SCRIPT,
+                json.dumps([INTERFACE, second])
+            ],
+            env=env
+        )
+        output = json.loads(output.decode('utf-8'))
+        first, second = output['results']
+        self.assertIn('UP', first[0], 'Link was not brought up')
+        for address in ('10.1.0.5/24', '10.1.0.6/24', '2001:db8::5/64'):
+            self.assertIn(address, first[1], 'Address was not added')
+
+        self.assertNotIn('192.0.2.99', first[1], 'Stale address was kept')
+        self.assertNotIn('10.1.0.99', first[1], 'Stale primary was kept')
+        self.assertIn(
+            'default via 10.1.0.1',
+            first[2],
+            'Gateway was not added'
+        )
+        self.assertIn(
+            '10.208.0.0/12 via 10.1.0.1',
+            first[2],
+            'Route was not added'
+        )
+        self.assertNotIn('10.1.0.6/24', second[1], 'Address was not removed')
+        self.assertNotIn('10.208.0.0/12', second[2], 'Route was not removed')
+        self.assertIn(
+            'default via 10.1.0.1',
+            second[2],
+            'Gateway was removed'
+        )
+        self.assertEqual(
+            (first[3], second[3], output['drifted']),
+            (True, True, False),
+            'Interface was not compared with the kernel'
+        )
@@ -1,11 +1,15 @@
 
 from novaagent import novaagent as agent
+from novaagent.xenstore.backends import MemoryBackend
 from novaagent.libs import centos
+from novaagent import commands
 
 
 import novaagent
+import threading
 import logging
 import fcntl
+import json
 import time
 import stat
 import sys
@@ -55,19 +59,15 @@ class TestHelpers(TestCase):
             with mock.patch('novaagent.utils.get_xen_event') as xen_event:
                 xen_event.return_value = test_xen_event
                 with mock.patch(
-                    'novaagent.utils.remove_xenhost_event'
-                ) as remove:
-                    remove.return_value = True
-                    with mock.patch(
-                        'novaagent.utils.update_xenguest_event'
-                    ) as update:
-                        update.return_value = True
-                        try:
-                            novaagent.novaagent.action(temp_os, 'dummy_client')
-                        except:
-                            assert False, (
-                                'An exception was thrown during action'
-                            )
+                    'novaagent.utils.answer_xen_events'
+                ) as answer:
+                    answer.return_value = True
+                    try:
+                        novaagent.novaagent.action(temp_os, 'dummy_client')
+                    except:
+                        assert False, (
+                            'An exception was thrown during action'
+                        )
 
     def test_xen_action_action_success(self):
         temp_os = centos.ServerOS()
@@ -82,22 +82,306 @@ class TestHelpers(TestCase):
                 with mock.patch('novaagent.libs.DefaultOS.keyinit') as keyinit:
                     keyinit.return_value = ('D0', 'SECRET_STRING')
                     with mock.patch(
-                        'novaagent.utils.remove_xenhost_event'
-                    ) as remove:
-                        remove.return_value = True
+                        'novaagent.utils.answer_xen_events'
+                    ) as answer:
+                        answer.return_value = True
+                        try:
+                            novaagent.novaagent.action(
+                                temp_os,
+                                'dummy_client'
+                            )
+                        except:
+                            assert False, (
+                                'An exception was thrown during action'
+                            )
+
+    def test_handle_event_timeout(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(server_os, name, value, client):
+            started.set()
+            release.wait(5)
+            return ('0', '')
+
+        command = commands.Command('slow', handler=handler, timeout=0.05)
+        with mock.patch.object(
+            novaagent.novaagent.REGISTRY,
+            'get',
+            return_value=command
+        ):
+            with mock.patch('novaagent.utils.answer_xen_events') as answer:
+                thread = threading.Thread(
+                    target=agent.handle_event,
+                    args=(
+                        centos.ServerOS(),
+                        ['1234'],
+                        {'name': 'slow', 'value': ''}
+                    )
+                )
+                thread.start()
+                started.wait(5)
+                for count in range(100):
+                    if answer.called:
+                        break
+
+                    time.sleep(0.01)
+
+                self.assertEqual(
+                    answer.call_args[0][1]['returncode'],
+                    '500',
+                    'Timed out event was not answered with an error'
+                )
+                self.assertEqual(
+                    thread.is_alive(),
+                    True,
+                    'Event finished before the command returned'
+                )
+                release.set()
+                thread.join(5)
+
+    def test_handle_event_exception(self):
+        calls = []
+
+        def handler(server_os, name, value, client):
+            calls.append(value)
+            raise ValueError('Test error')
+
+        backend = MemoryBackend({
+            'data/host/1234': json.dumps({'name': 'failing', 'value': ''})
+        })
+        command = commands.Command('failing', handler=handler)
+        with mock.patch.object(
+            novaagent.novaagent.REGISTRY,
+            'get',
+            return_value=command
+        ):
+            dispatcher = agent.create_dispatcher(
+                centos.ServerOS(),
+                backend,
+                1,
+                {},
+                None
+            )
+            try:
+                for count in range(2):
+                    agent.action(centos.ServerOS(), backend, dispatcher)
+                    for wait in range(100):
+                        if not dispatcher.is_pending('1234'):
+                            break
+
+                        time.sleep(0.01)
+            finally:
+                dispatcher.stop()
+
+        self.assertEqual(len(calls), 1, 'Failing event was run again')
+        self.assertEqual(
+            (
+                backend.list(b'data/host'),
+                json.loads(backend.read(b'data/guest/1234'))
+            ),
+            ([], {'message': 'Test error', 'returncode': '500'}),
+            'Failing event was not answered with an error'
+        )
+
+    def test_handle_event_journal_failure(self):
+        backend = MemoryBackend({
+            'data/host/1234': json.dumps({'name': 'working', 'value': ''})
+        })
+        command = commands.Command(
+            'working',
+            handler=lambda server_os, name, value, client: ('0', 'done')
+        )
+        journal = mock.Mock()
+        journal.start.side_effect = OSError(28, 'No space left on device')
+        journal.finish.side_effect = IOError(5, 'Input/output error')
+        with mock.patch.object(
+            novaagent.novaagent.REGISTRY,
+            'get',
+            return_value=command
+        ):
+            agent.handle_event(
+                centos.ServerOS(),
+                ['1234'],
+                {'name': 'working', 'value': ''},
+                backend,
+                journal
+            )
+
+        self.assertEqual(
+            (
+                backend.list(b'data/host'),
+                json.loads(backend.read(b'data/guest/1234'))
+            ),
+            ([], {'message': 'done', 'returncode': '0'}),
+            'Event was not answered when the journal could not be written'
+        )
+
+    def test_xen_action_event_removed(self):
+        backend = MemoryBackend({
+            'data/host/1234': json.dumps({'name': 'keyinit', 'value': ''}),
+            'data/host/5678': json.dumps(['not', 'an', 'event'])
+        })
+        dispatcher = mock.Mock()
+
+        def is_pending(uuid):
+            # A worker answers the event after it was listed
+            if uuid == '1234':
+                backend.delete(b'data/host/1234')
+
+            return False
+
+        dispatcher.is_pending.side_effect = is_pending
+        agent.action(centos.ServerOS(), backend, dispatcher)
+        self.assertEqual(
+            dispatcher.submit.call_count,
+            0,
+            'Removed or invalid event was dispatched'
+        )
+
+    def test_listen_action_exception(self):
+        with mock.patch('novaagent.novaagent.create_lock_file'):
+            with mock.patch('novaagent.novaagent.ConnectionManager'):
+                with mock.patch('novaagent.novaagent.create_dispatcher'):
+                    with mock.patch(
+                        'novaagent.utils.watch_xen_events',
+                        return_value=None
+                    ):
                         with mock.patch(
-                            'novaagent.utils.update_xenguest_event'
-                        ) as update:
-                            update.return_value = True
-                            try:
-                                novaagent.novaagent.action(
-                                    temp_os,
-                                    'dummy_client'
-                                )
-                            except:
-                                assert False, (
-                                    'An exception was thrown during action'
-                                )
+                            'novaagent.novaagent.action',
+                            side_effect=[ValueError('Test error'), None]
+                        ) as action:
+                            with mock.patch(
+                                'novaagent.novaagent.time.sleep',
+                                side_effect=[None, KeyboardInterrupt]
+                            ):
+                                with self.assertRaises(KeyboardInterrupt):
+                                    agent.nova_agent_listen(
+                                        centos,
+                                        centos.ServerOS(),
+                                        journal_path=''
+                                    )
+
+        self.assertEqual(
+            action.call_count,
+            2,
+            'Listening stopped after a failed scan'
+        )
+
+    def test_xen_action_dispatcher(self):
+        temp_os = centos.ServerOS()
+        test_xen_event = {
+            "name": "version",
+            "value": ""
+        }
+        dispatcher = mock.Mock()
+        dispatcher.is_pending.side_effect = [True, False]
+        with mock.patch('novaagent.utils.list_xen_events') as xen_list:
+            xen_list.return_value = [
+                '748dee41-c47f-4ec7-b2cd-037e51da4031',
+                '9f1a4dc1-4fa6-4b17-8e1b-05d4e5ea4b0f'
+            ]
+            with mock.patch('novaagent.utils.get_xen_event') as xen_event:
+                xen_event.return_value = test_xen_event
+                novaagent.novaagent.action(
+                    temp_os,
+                    'dummy_client',
+                    dispatcher
+                )
+
+        dispatcher.submit.assert_called_once_with(
+            ['9f1a4dc1-4fa6-4b17-8e1b-05d4e5ea4b0f'],
+            test_xen_event
+        )
+
+    def test_xen_action_coalesced(self):
+        temp_os = centos.ServerOS()
+        test_xen_event = {
+            "name": "resetnetwork",
+            "value": ""
+        }
+        test_uuids = [
+            '748dee41-c47f-4ec7-b2cd-037e51da4031',
+            '9f1a4dc1-4fa6-4b17-8e1b-05d4e5ea4b0f'
+        ]
+        with mock.patch('novaagent.utils.list_xen_events') as xen_list:
+            xen_list.return_value = test_uuids
+            with mock.patch('novaagent.utils.get_xen_event') as xen_event:
+                xen_event.return_value = test_xen_event
+                with mock.patch(
+                    'novaagent.libs.centos.ServerOS.resetnetwork'
+                ) as reset:
+                    reset.return_value = ('0', '')
+                    with mock.patch(
+                        'novaagent.utils.answer_xen_events'
+                    ) as answer:
+                        novaagent.novaagent.action(
+                            temp_os,
+                            'dummy_client'
+                        )
+
+        self.assertEqual(
+            reset.call_count,
+            1,
+            'Queued resetnetwork events were not coalesced'
+        )
+        answer.assert_called_once_with(
+            test_uuids,
+            {'message': '', 'returncode': '0'},
+            'dummy_client'
+        )
+
+    def test_xen_action_journal_completed(self):
+        temp_os = centos.ServerOS()
+        journal = mock.Mock()
+        journal.get_result.return_value = {
+            'message': '',
+            'returncode': '0'
+        }
+        with mock.patch('novaagent.utils.list_xen_events') as xen_list:
+            xen_list.return_value = ['748dee41-c47f-4ec7-b2cd-037e51da4031']
+            with mock.patch('novaagent.utils.get_xen_event') as xen_event:
+                with mock.patch(
+                    'novaagent.utils.answer_xen_events'
+                ) as answer:
+                    novaagent.novaagent.action(
+                        temp_os,
+                        'dummy_client',
+                        journal=journal
+                    )
+
+        self.assertEqual(
+            xen_event.call_count,
+            0,
+            'Completed event was read and run again'
+        )
+        answer.assert_called_once_with(
+            ['748dee41-c47f-4ec7-b2cd-037e51da4031'],
+            {'message': '', 'returncode': '0'},
+            'dummy_client'
+        )
+
+    def test_parse_command_limits(self):
+        parser = agent.create_parser()
+        limits = agent.parse_command_limits(
+            parser,
+            ['resetnetwork=1', 'version=8']
+        )
+        self.assertEqual(
+            limits,
+            {'resetnetwork': 1, 'version': 8},
+            'Command limits were not parsed'
+        )
+
+    def test_parse_command_limits_invalid(self):
+        parser = agent.create_parser()
+        with mock.patch.object(parser, 'error', side_effect=SystemExit):
+            self.assertRaises(
+                SystemExit,
+                agent.parse_command_limits,
+                parser,
+                ['resetnetwork']
+            )
 
     def test_main_success(self):
         class Test(object):
@@ -105,6 +389,14 @@ class TestHelpers(TestCase):
                 self.logfile = '-'
                 self.loglevel = 'info'
                 self.no_fork = False
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 0
 
         test_args = Test()
         mock_response = mock.Mock()
@@ -148,6 +440,14 @@ class TestHelpers(TestCase):
                 self.logfile = '-'
                 self.loglevel = 'info'
                 self.no_fork = True
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 0
 
         test_args = Test()
         mock_response = mock.Mock()
@@ -180,12 +480,67 @@ class TestHelpers(TestCase):
                             except:
                                 assert False, 'An unknown exception was thrown'
 
+    def test_main_key_pool(self):
+        class Test(object):
+            def __init__(self):
+                self.logfile = '-'
+                self.loglevel = 'info'
+                self.no_fork = True
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 2
+
+        test_args = Test()
+        with mock.patch(
+            'novaagent.novaagent.argparse.ArgumentParser.parse_args'
+        ) as parse_args:
+            parse_args.return_value = test_args
+            with mock.patch(
+                'novaagent.novaagent.get_server_type'
+            ) as server_type:
+                server_type.return_value = centos
+                with mock.patch(
+                    'novaagent.libs.centos.ServerOS.start_password_commands'
+                ) as start:
+                    with mock.patch('novaagent.novaagent.action'):
+                        with mock.patch(
+                            'novaagent.novaagent.os.path.exists'
+                        ) as exists:
+                            exists.return_value = False
+                            with mock.patch(
+                                'novaagent.novaagent.time.sleep',
+                                side_effect=KeyboardInterrupt
+                            ):
+                                try:
+                                    novaagent.novaagent.main()
+                                except KeyboardInterrupt:
+                                    pass
+
+        self.assertEqual(
+            start.call_count,
+            1,
+            'Keypair pool was not started with the agent'
+        )
+
     def test_main_success_with_xenbus(self):
         class Test(object):
             def __init__(self):
                 self.logfile = '-'
                 self.loglevel = 'info'
                 self.no_fork = False
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 0
 
         test_args = Test()
         mock_response = mock.Mock()
@@ -209,21 +564,84 @@ class TestHelpers(TestCase):
                             'novaagent.novaagent.os.path.exists'
                         ) as exists:
                             exists.return_value = True
-                            with mock.patch('novaagent.novaagent.Client'):
+                            with mock.patch(
+                                'pyxs.client.Client'
+                            ):
                                 with mock.patch('novaagent.novaagent.action'):
                                     with mock.patch(
-                                        'novaagent.novaagent.time.sleep',
-                                        side_effect=mock_response
-                                    ):
-                                        try:
-                                            novaagent.novaagent.main()
-                                        except KeyboardInterrupt:
-                                            pass
-                                        except:
-                                            assert False, (
-                                                'An unknown exception'
-                                                'was thrown'
-                                            )
+                                        'novaagent.utils.watch_xen_events'
+                                    ) as watch:
+                                        watch.return_value = None
+                                        with mock.patch(
+                                            'novaagent.novaagent.time.sleep',
+                                            side_effect=mock_response
+                                        ):
+                                            try:
+                                                novaagent.novaagent.main()
+                                            except KeyboardInterrupt:
+                                                pass
+                                            except:
+                                                assert False, (
+                                                    'An unknown exception'
+                                                    'was thrown'
+                                                )
+
+    def test_main_success_with_xenbus_watch(self):
+        class Test(object):
+            def __init__(self):
+                self.logfile = '-'
+                self.loglevel = 'info'
+                self.no_fork = True
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 0
+
+        test_args = Test()
+        monitor = mock.Mock()
+        monitor.wait_event.side_effect = [True, False, KeyboardInterrupt]
+        with mock.patch(
+            'novaagent.novaagent.argparse.ArgumentParser.parse_args'
+        ) as parse_args:
+            parse_args.return_value = test_args
+            with mock.patch(
+                'novaagent.novaagent.get_server_type'
+            ) as server_type:
+                server_type.return_value = centos
+                with mock.patch(
+                    'novaagent.novaagent.os.path.exists'
+                ) as exists:
+                    exists.return_value = True
+                    with mock.patch('pyxs.client.Client'):
+                        with mock.patch(
+                            'novaagent.novaagent.action'
+                        ) as action:
+                            with mock.patch(
+                                'novaagent.utils.watch_xen_events'
+                            ) as watch:
+                                watch.return_value = monitor
+                                with mock.patch(
+                                    'novaagent.novaagent.time.sleep'
+                                ) as sleep:
+                                    try:
+                                        novaagent.novaagent.main()
+                                    except KeyboardInterrupt:
+                                        pass
+
+        self.assertEqual(
+            action.call_count,
+            3,
+            'Action was not run once per watch wake up'
+        )
+        self.assertEqual(
+            sleep.call_count,
+            0,
+            'Agent slept instead of waiting on the watch'
+        )
 
     def test_main_os_error(self):
         class Test(object):
@@ -231,6 +649,14 @@ class TestHelpers(TestCase):
                 self.logfile = '-'
                 self.loglevel = 'info'
                 self.no_fork = False
+                self.workers = 4
+                self.command_limits = []
+                self.journal = ''
+                self.profile_imports = False
+                self.password_scheme = None
+                self.password_rounds = None
+                self.network_engine = 'scripts'
+                self.key_pool_size = 0
 
         test_args = Test()
         mock_response = mock.Mock()
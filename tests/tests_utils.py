@@ -1,10 +1,13 @@
 
 from .fixtures import utils_data
 from .fixtures import xen_data
+from novaagent.xenstore.backends import MemoryBackend
+from novaagent.xenstore import xenstore
 from novaagent import utils
 
 
 import logging
+import json
 import glob
 import sys
 import os
@@ -81,7 +84,7 @@ class TestHelpers(TestCase):
         )
 
     def test_get_hostname_success_popen(self):
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (
                 utils_data.get_hostname(True)
             )
@@ -95,7 +98,7 @@ class TestHelpers(TestCase):
         )
 
     def test_get_hostname_failure_popen(self):
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
             with mock.patch('novaagent.utils.socket') as get:
@@ -113,7 +116,7 @@ class TestHelpers(TestCase):
 
     def test_get_hostname_exception_popen(self):
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             with mock.patch('novaagent.utils.socket') as get:
@@ -149,9 +152,10 @@ class TestHelpers(TestCase):
 
     def test_list_host_xen_events_popen(self):
         check_events = ['748dee41-c47f-4ec7-b2cd-037e51da4031']
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (
-                utils_data.get_xen_host_events()
+                b''.join(utils_data.get_xen_host_events()),
+                b''
             )
             popen.return_value.returncode = 0
             event_list = utils.list_xen_events(None)
@@ -162,8 +166,23 @@ class TestHelpers(TestCase):
             'Event list does not match expected list'
         )
 
+    def test_list_host_xen_events_popen_one_level(self):
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
+            popen.return_value.communicate.return_value = (
+                b''.join(utils_data.get_xen_host_events()),
+                b''
+            )
+            popen.return_value.returncode = 0
+            utils.list_xen_events(None)
+
+        self.assertEqual(
+            popen.call_args[0][0],
+            ['xenstore-list', b'data/host'],
+            'Did not use the non-recursive xenstore-list command'
+        )
+
     def test_list_host_xen_events_failure_popen(self):
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -175,9 +194,19 @@ class TestHelpers(TestCase):
             'Event list does not match expected list after failure'
         )
 
+    def test_list_popen_failure(self):
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
+            popen.return_value.communicate.return_value = (
+                b'',
+                b'could not list: No such file or directory'
+            )
+            popen.return_value.returncode = 1
+            with self.assertRaises(ValueError):
+                xenstore.xenstore_list(b'data/missing', None)
+
     def test_list_host_xen_events_popen_exception(self):
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             event_list = utils.list_xen_events(None)
@@ -188,6 +217,303 @@ class TestHelpers(TestCase):
             'Event list should be an empty list with exception'
         )
 
+    def test_watch_xen_events(self):
+        client = mock.Mock()
+        monitor = utils.watch_xen_events(client)
+        self.assertEqual(
+            monitor.watched,
+            set([b'data/host']),
+            'Monitor is not watching data/host'
+        )
+
+    def test_watch_xen_events_failure(self):
+        client = mock.Mock()
+        client.ack.side_effect = ValueError
+        with mock.patch('novaagent.xenbus.copy.copy') as copy:
+            copy.return_value = client
+            monitor = utils.watch_xen_events(client)
+
+        self.assertEqual(
+            monitor,
+            None,
+            'Monitor returned when the watch could not be registered'
+        )
+
+    def test_read_many_pipeline(self):
+        with mock.patch(
+            'novaagent.xenbus.XenGuestPipeline'
+        ) as pipeline:
+            pipeline.return_value.execute.return_value = [
+                xen_data.get_network_interface(),
+                ValueError('Test error')
+            ]
+            results = xenstore.xenstore_read_many(
+                [
+                    b'vm-data/networking/BC764E206C5B',
+                    b'vm-data/networking/BC764E206C5A'
+                ],
+                'dummy_client',
+                True
+            )
+
+        self.assertEqual(
+            results,
+            [xen_data.check_network_interface(), None],
+            'Pipelined reads did not return the expected values'
+        )
+
+    def test_read_many_popen(self):
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
+            popen.return_value.communicate.return_value = (
+                utils_data.get_hostname(True)
+            )
+            popen.return_value.returncode = 0
+            results = xenstore.xenstore_read_many(
+                [b'vm-data/hostname', b'vm-data/hostname'],
+                None
+            )
+
+        self.assertEqual(
+            results,
+            ['test-server', 'test-server'],
+            'Reads did not return the expected values'
+        )
+
+    def test_snapshot_vm_data(self):
+        levels = [
+            [
+                ValueError('Test error'),
+                xen_data.get_hostname(True),
+                [b'BC764E206C5B'],
+                b''
+            ],
+            [[], xen_data.get_network_interface()]
+        ]
+        pipelines = [mock.Mock() for level in levels]
+        for pipeline, level in zip(pipelines, levels):
+            pipeline.execute.return_value = level
+
+        with mock.patch(
+            'novaagent.xenbus.XenGuestPipeline',
+            side_effect=pipelines
+        ):
+            with mock.patch(
+                'novaagent.xenstore.xenstore.run_transaction',
+                side_effect=lambda func, client: func(client)
+            ):
+                snapshot = utils.snapshot_vm_data('dummy_client')
+
+        self.assertEqual(
+            snapshot.hostname,
+            'test-server',
+            'Hostname does not match expected output'
+        )
+        self.assertEqual(
+            snapshot.mac_addresses,
+            ['BC764E206C5B'],
+            'Mac addrs do not match expected output'
+        )
+        self.assertEqual(
+            snapshot.get_interface('BC764E206C5B'),
+            xen_data.check_network_interface(),
+            'Interface does not match expected output'
+        )
+        pipelines[1].read.assert_called_once_with(
+            b'vm-data/networking/BC764E206C5B'
+        )
+
+    def test_snapshot_vm_data_skips_metadata(self):
+        backend = MemoryBackend({
+            'vm-data/hostname': 'test-server',
+            'vm-data/networking/BC764E206C5B': json.dumps(
+                xen_data.check_network_interface()
+            ),
+            'vm-data/user-metadata/large': 'x' * 4096
+        })
+        paths = []
+        read = MemoryBackend.read
+
+        def record_read(self, path):
+            paths.append(path)
+            return read(self, path)
+
+        # Transactions read through a copy of the backend
+        with mock.patch.object(MemoryBackend, 'read', record_read):
+            snapshot = utils.snapshot_vm_data(backend)
+
+        self.assertEqual(
+            (snapshot.hostname, snapshot.mac_addresses),
+            ('test-server', ['BC764E206C5B']),
+            'Snapshot did not contain the hostname and interfaces'
+        )
+        self.assertEqual(
+            sorted(paths),
+            [
+                b'vm-data/hostname',
+                b'vm-data/networking',
+                b'vm-data/networking/BC764E206C5B'
+            ],
+            'Metadata outside of hostname and networking was read'
+        )
+
+    def test_run_transaction_commit(self):
+        client = mock.Mock()
+        client.commit.return_value = True
+        client.read.return_value = xen_data.get_hostname(True)
+        with mock.patch('novaagent.xenstore.backends.copy') as copy:
+            copy.copy.return_value = client
+            result = xenstore.run_transaction(
+                lambda tx_client: tx_client.read(b'vm-data/hostname'),
+                'dummy_client'
+            )
+
+        self.assertEqual(
+            result,
+            'test-server',
+            'Transaction did not return the result of the function'
+        )
+        self.assertEqual(
+            client.commit.call_count,
+            1,
+            'Transaction was not committed'
+        )
+
+    def test_run_transaction_rollback(self):
+        client = mock.Mock()
+        with mock.patch('novaagent.xenstore.backends.copy') as copy:
+            copy.copy.return_value = client
+            with self.assertRaises(ValueError):
+                xenstore.run_transaction(
+                    mock.Mock(side_effect=ValueError('Test error')),
+                    'dummy_client'
+                )
+
+        self.assertEqual(
+            (client.rollback.call_count, client.commit.call_count),
+            (1, 0),
+            'Failed transaction was not rolled back'
+        )
+
+    def test_run_transaction_retry(self):
+        client = mock.Mock()
+        client.commit.side_effect = [False, False, True]
+        func = mock.Mock()
+        with mock.patch('novaagent.xenstore.backends.copy') as copy:
+            copy.copy.return_value = client
+            with mock.patch('novaagent.xenstore.xenstore.time.sleep'):
+                xenstore.run_transaction(func, 'dummy_client')
+
+        self.assertEqual(
+            func.call_count,
+            3,
+            'Conflicting transaction was not retried'
+        )
+
+    def test_run_transaction_retry_exhausted(self):
+        client = mock.Mock()
+        client.commit.return_value = False
+        with mock.patch('novaagent.xenstore.backends.copy') as copy:
+            copy.copy.return_value = client
+            with mock.patch('novaagent.xenstore.xenstore.time.sleep'):
+                with self.assertRaises(xenstore.TransactionConflict):
+                    xenstore.run_transaction(
+                        mock.Mock(),
+                        'dummy_client',
+                        attempts=2
+                    )
+
+    def test_answer_xen_events(self):
+        pipeline = mock.Mock()
+        pipeline.execute.return_value = [
+            ValueError('Test error'),
+            None,
+            None,
+            None
+        ]
+        with mock.patch(
+            'novaagent.xenbus.XenGuestPipeline',
+            return_value=pipeline
+        ):
+            with mock.patch(
+                'novaagent.xenstore.xenstore.run_transaction',
+                side_effect=lambda func, client: func(client)
+            ):
+                success = utils.answer_xen_events(
+                    ['1234', '5678'],
+                    {'message': '', 'returncode': '0'},
+                    'dummy_client'
+                )
+
+        self.assertEqual(
+            success,
+            True,
+            'Failed delete stopped the answer being written'
+        )
+        self.assertEqual(
+            [write[0][0] for write in pipeline.write.call_args_list],
+            [b'data/guest/1234', b'data/guest/5678'],
+            'Answers were not written for every event'
+        )
+
+    def test_answer_xen_events_write_failure(self):
+        pipeline = mock.Mock()
+        pipeline.execute.return_value = [None, ValueError('Test error')]
+        with mock.patch(
+            'novaagent.xenbus.XenGuestPipeline',
+            return_value=pipeline
+        ):
+            with mock.patch(
+                'novaagent.xenstore.xenstore.run_transaction',
+                side_effect=lambda func, client: func(client)
+            ):
+                success = utils.answer_xen_events(
+                    ['1234'],
+                    {'message': '', 'returncode': '0'},
+                    'dummy_client'
+                )
+
+        self.assertEqual(
+            success,
+            False,
+            'Failed write was reported as success'
+        )
+
+    def test_snapshot_vm_data_read_only(self):
+        snapshot = utils.VMDataSnapshot(
+            xen_data.get_vm_data({
+                'BC764E206C5B': xen_data.check_network_interface()
+            })
+        )
+        interface = snapshot.get_interface('BC764E206C5B')
+        interface['label'] = 'changed'
+        self.assertEqual(
+            snapshot.get_interface('BC764E206C5B')['label'],
+            'private',
+            'Snapshot was changed through a returned interface'
+        )
+        with self.assertRaises(AttributeError):
+            snapshot.hostname = 'changed'
+
+    def test_snapshot_vm_data_exception(self):
+        with mock.patch(
+            'novaagent.xenstore.xenstore.xenstore_snapshot',
+            side_effect=ValueError
+        ):
+            with mock.patch('novaagent.utils.socket') as get:
+                get.gethostname.return_value = xen_data.get_hostname(False)
+                snapshot = utils.snapshot_vm_data('dummy_client')
+
+        self.assertEqual(
+            snapshot.hostname,
+            'test-server',
+            'Hostname did not fall back to the system hostname'
+        )
+        self.assertEqual(
+            snapshot.mac_addresses,
+            [],
+            'Mac addrs returned is not empty list after error'
+        )
+
     def test_get_host_event(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         event_check = {
@@ -218,7 +544,7 @@ class TestHelpers(TestCase):
             "name": "keyinit",
             "value": "68436575764933852815830951574296"
         }
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (
                 utils_data.get_xen_host_event_details()
             )
@@ -233,7 +559,7 @@ class TestHelpers(TestCase):
 
     def test_get_host_event_failure_popen(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -248,7 +574,7 @@ class TestHelpers(TestCase):
     def test_get_host_event_popen_exception(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             event_details = utils.get_xen_event(host_event_id, None)
@@ -280,7 +606,7 @@ class TestHelpers(TestCase):
 
     def test_remove_xenhost_event_success_popen(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 0
 
@@ -294,7 +620,7 @@ class TestHelpers(TestCase):
 
     def test_remove_xenhost_event_failure_popen(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -309,7 +635,7 @@ class TestHelpers(TestCase):
     def test_remove_xenhost_event_exception_popen(self):
         host_event_id = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             success = utils.remove_xenhost_event(host_event_id, None)
@@ -348,7 +674,7 @@ class TestHelpers(TestCase):
     def test_write_xenguest_event_success_popen(self):
         event_uuid = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         write_data = {"message": "", "returncode": "0"}
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 0
 
@@ -363,7 +689,7 @@ class TestHelpers(TestCase):
     def test_write_xenguest_event_failure_popen(self):
         event_uuid = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         write_data = {"message": "", "returncode": "0"}
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -378,7 +704,7 @@ class TestHelpers(TestCase):
         event_uuid = '748dee41-c47f-4ec7-b2cd-037e51da4031'
         write_data = {"message": "", "returncode": "0"}
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             success = utils.update_xenguest_event(event_uuid, write_data, None)
@@ -411,7 +737,7 @@ class TestHelpers(TestCase):
 
     def test_network_get_interfaces_success_popen(self):
         mac_address = 'BC764E206C5B'
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (
                 utils_data.get_network_interface()
             )
@@ -427,7 +753,7 @@ class TestHelpers(TestCase):
 
     def test_network_get_interfaces_failure_popen(self):
         mac_address = 'BC764E206C5B'
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -442,7 +768,7 @@ class TestHelpers(TestCase):
     def test_network_get_interfaces_exception_popen(self):
         mac_address = 'BC764E206C5B'
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
 
@@ -484,9 +810,10 @@ class TestHelpers(TestCase):
 
     def test_network_get_mac_addresses_success_popen(self):
         check_mac_addrs = ['BC764E206C5B', 'BC764E206C5A']
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (
-                utils_data.get_mac_addresses()
+                b''.join(utils_data.get_mac_addresses()),
+                b''
             )
             popen.return_value.returncode = 0
 
@@ -500,7 +827,7 @@ class TestHelpers(TestCase):
 
     def test_network_get_mac_addresses_exception_popen(self):
         with mock.patch(
-            'novaagent.xenstore.xenstore.Popen',
+            'novaagent.xenstore.backends.Popen',
             side_effect=ValueError
         ):
             mac_addrs = utils.list_xenstore_macaddrs(None)
@@ -512,7 +839,7 @@ class TestHelpers(TestCase):
         )
 
     def test_network_get_mac_addresses_failure_popen(self):
-        with mock.patch('novaagent.xenstore.xenstore.Popen') as popen:
+        with mock.patch('novaagent.xenstore.backends.Popen') as popen:
             popen.return_value.communicate.return_value = (b'', '')
             popen.return_value.returncode = 1
 
@@ -543,9 +870,9 @@ class TestHelpers(TestCase):
         interfaces = ['lo', 'eth1', 'eth0']
         with mock.patch('novaagent.utils.os.path.exists') as os_path:
             os_path.return_value = False
-            with mock.patch('novaagent.utils.netifaces.interfaces') as netif:
-                netif.return_value = interfaces
-
+            with mock.patch('novaagent.utils.netifaces') as netif:
+                netif.interfaces.return_value = interfaces
+                utils.HAS_NETIFACES = True
                 list_interfaces = utils.list_hw_interfaces()
 
         self.assertEqual(
@@ -716,6 +1043,98 @@ class TestHelpers(TestCase):
         utils.backup_file(rename_file)
         assert True, 'Move interface did not generate error'
 
+    def test_update_file(self):
+        rename_file = '/tmp/ifcfg-eth0'
+        self.assertEqual(
+            (
+                utils.update_file(rename_file, 'DEVICE=eth0\n'),
+                utils.update_file(rename_file, 'DEVICE=eth0\n')
+            ),
+            (True, False),
+            'File was not only written when its contents changed'
+        )
+        self.assertEqual(
+            len(glob.glob('/tmp/ifcfg-eth0.*.*.bak')),
+            1,
+            'File was not backed up once before it was changed'
+        )
+
+    def test_interface_is_up(self):
+        with mock.patch('novaagent.utils.read_file') as read_file:
+            read_file.side_effect = ['up\n', 'unknown\n', 'down\n', None]
+            self.assertEqual(
+                [utils.interface_is_up('eth0') for count in range(4)],
+                [True, True, False, False],
+                'Operstate was not mapped to the link being up'
+            )
+
+    def test_get_nameservers(self):
+        with mock.patch('novaagent.utils.read_file') as read_file:
+            read_file.side_effect = [
+                '# Generated\nsearch example.com\n'
+                'nameserver 69.20.0.164\nnameserver  69.20.0.196\n',
+                None
+            ]
+            self.assertEqual(
+                [utils.get_nameservers() for count in range(2)],
+                [['69.20.0.164', '69.20.0.196'], []],
+                'Nameservers were not read from resolv.conf'
+            )
+
+    def test_get_ipv4_addr(self):
+        with mock.patch('novaagent.utils.fcntl.ioctl') as ioctl:
+            ioctl.return_value = b'eth0'.ljust(20, b'\x00') + (
+                b'\x0a\x00\x00\x05'
+            ).ljust(236, b'\x00')
+            self.assertEqual(
+                utils.get_ipv4_addr('eth0'),
+                '10.0.0.5',
+                'Address was not read from the ioctl result'
+            )
+            ioctl.side_effect = IOError
+            self.assertEqual(
+                utils.get_ipv4_addr('eth0'),
+                None,
+                'Interface without an address did not return None'
+            )
+
+    def test_wait_for_link(self):
+        with mock.patch(
+            'novaagent.utils.interface_is_up',
+            side_effect=[False, False, True]
+        ) as is_up:
+            with mock.patch('novaagent.utils.time.sleep'):
+                self.assertTrue(
+                    utils.wait_for_link('eth0'),
+                    'Link coming up was not detected'
+                )
+
+        self.assertEqual(is_up.call_count, 3, 'Link was not polled')
+        with mock.patch('novaagent.utils.interface_is_up', return_value=True):
+            self.assertFalse(
+                utils.wait_for_link('eth0', False, 0),
+                'Link that stayed up was reported down'
+            )
+
+    def test_run_parallel(self):
+        def square(item):
+            if item == 3:
+                raise ValueError('Test error')
+
+            return item * item
+
+        results = utils.run_parallel(square, [1, 2, 3, 4], 2)
+        self.assertEqual(
+            (results[1], results[2], results[4]),
+            (1, 4, 16),
+            'Results were not returned for every item'
+        )
+        self.assertIsInstance(
+            results[3],
+            ValueError,
+            'Exception was not returned as the result'
+        )
+
     def test_encoding_to_bytes(self):
         test_string = 'this is a test'
         compare_string = b'this is a test'
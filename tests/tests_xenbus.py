@@ -1,6 +1,9 @@
 
 from pyxs.client import Client
 from pyxs.connection import XenBusConnection
+from pyxs.exceptions import PyXSError
+from pyxs._internal import Packet
+from pyxs._internal import Op
 
 
 from novaagent import xenbus
@@ -10,6 +13,12 @@ import logging
 import sys
 
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
 if sys.version_info[:2] >= (2, 7):
     from unittest import TestCase
 else:
@@ -27,3 +36,129 @@ class TestXenBus(TestCase):
         c = Client(router=xenbus.XenGuestRouter(XenBusConnection()))
         assert isinstance(c.router.connection, XenBusConnection)
         assert not c.router.thread.is_alive()
+
+    def test_monitor_wait_event(self):
+        monitor = xenbus.XenGuestMonitor(mock.Mock())
+        monitor.events.put(('data/host/1', 'nova-agent'))
+        monitor.events.put(('data/host/2', 'nova-agent'))
+        self.assertEqual(
+            monitor.wait_event(0.1),
+            True,
+            'Did not report an event that was queued'
+        )
+        self.assertEqual(
+            monitor.events.qsize(),
+            0,
+            'Queued events were not drained after wake up'
+        )
+
+    def test_monitor_wait_event_timeout(self):
+        monitor = xenbus.XenGuestMonitor(mock.Mock())
+        self.assertEqual(
+            monitor.wait_event(0.01),
+            False,
+            'Did not time out without any events'
+        )
+
+    def send_requests(self, router, rq_ids):
+        rvars = []
+        for rq_id in rq_ids:
+            rvars.append(
+                router.send(Packet(Op.READ, b'data/host\x00', rq_id=rq_id))
+            )
+
+        return rvars
+
+    def test_router_match_rq_id(self):
+        router = xenbus.XenGuestRouter(mock.Mock())
+        rvars = self.send_requests(router, [1, 2])
+        self.assertEqual(
+            router.pop_rvar(2),
+            rvars[1],
+            'Reply was not matched on rq_id'
+        )
+        self.assertEqual(
+            router.pop_rvar(1),
+            rvars[0],
+            'Reply was not matched on rq_id'
+        )
+        self.assertEqual(
+            len(router.outstanding),
+            0,
+            'Answered requests were left in the FIFO'
+        )
+
+    def test_router_match_unknown_rq_id_fifo(self):
+        router = xenbus.XenGuestRouter(mock.Mock())
+        rvars = self.send_requests(router, [1, 2, 3])
+        self.assertEqual(
+            router.pop_rvar(99),
+            rvars[0],
+            'Unknown rq_id was not matched to the oldest request'
+        )
+        self.assertEqual(
+            router.pop_rvar(2),
+            rvars[1],
+            'Reply was not matched on rq_id'
+        )
+        self.assertEqual(
+            router.pop_rvar(98),
+            rvars[2],
+            'Unknown rq_id was not matched to the oldest request'
+        )
+        self.assertEqual(
+            router.pop_rvar(97),
+            None,
+            'Reply matched when no request was outstanding'
+        )
+
+    def test_router_fail_outstanding(self):
+        router = xenbus.XenGuestRouter(mock.Mock())
+        monitor = xenbus.XenGuestMonitor(mock.Mock())
+        router.subscribe(b'nova-agent', monitor)
+        rvars = self.send_requests(router, [1, 2])
+        router.fail_outstanding()
+        self.assertEqual(
+            [rvar.get().op for rvar in rvars],
+            [Op.ERROR, Op.ERROR],
+            'Outstanding requests were not failed'
+        )
+        self.assertEqual(
+            monitor.wait_event(0.01),
+            True,
+            'Monitor was not woken when the router stopped'
+        )
+
+    def test_pipeline_execute(self):
+        client = mock.Mock()
+        client.tx_id = 0
+        client.router = xenbus.XenGuestRouter(mock.Mock())
+        pipeline = xenbus.XenGuestPipeline(client)
+        pipeline.read(b'vm-data/hostname')
+        pipeline.list(b'vm-data/networking')
+        pipeline.read(b'vm-data/missing')
+        self.assertEqual(
+            client.router.connection.send.call_count,
+            3,
+            'Requests were not all sent before collecting replies'
+        )
+        client.router.pop_rvar(0).set(
+            Packet(Op.READ, b'test-server\x00', rq_id=0)
+        )
+        client.router.pop_rvar(0).set(
+            Packet(Op.DIRECTORY, b'BC764E206C5B\x00BC764E206C5A\x00', 0)
+        )
+        client.router.pop_rvar(0).set(
+            Packet(Op.ERROR, b'ENOENT\x00', rq_id=0)
+        )
+        results = pipeline.execute()
+        self.assertEqual(
+            results[:2],
+            [b'test-server', [b'BC764E206C5B', b'BC764E206C5A']],
+            'Pipelined replies did not match the requests'
+        )
+        self.assertIsInstance(
+            results[2],
+            PyXSError,
+            'Failed request was not returned as an error'
+        )
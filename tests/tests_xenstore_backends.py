@@ -0,0 +1,322 @@
+
+from novaagent.xenstore import backends
+from novaagent.xenstore import xenstore
+
+
+from pyxs.exceptions import ConnectionError
+from pyxs.exceptions import PyXSError
+
+
+import logging
+import sys
+
+
+if sys.version_info[:2] >= (2, 7):
+    from unittest import TestCase
+else:
+    from unittest2 import TestCase
+
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class FlakyBackend(backends.MemoryBackend):
+    """ Memory backend whose connection can be dropped by the test """
+    name = 'flaky'
+    created = []
+
+    @classmethod
+    def probe(cls):
+        backend = cls()
+        cls.created.append(backend)
+        return backend
+
+    def __init__(self, nodes=None):
+        super(FlakyBackend, self).__init__(nodes)
+        self.connected = True
+
+
+class TestBackends(TestCase):
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_select_backend_dev_xenbus(self):
+        with mock.patch(
+            'novaagent.xenstore.backends.os.path.exists'
+        ) as exists:
+            exists.return_value = True
+            with mock.patch('pyxs.client.Client'):
+                backend = backends.select_backend()
+
+        self.assertEqual(
+            (backend.name, backend.path),
+            ('xenbus', '/dev/xen/xenbus'),
+            'Did not use /dev/xen/xenbus when it exists'
+        )
+
+    def test_select_backend_proc_xenbus(self):
+        with mock.patch(
+            'novaagent.xenstore.backends.os.path.exists',
+            side_effect=[False, True]
+        ):
+            with mock.patch('pyxs.client.Client'):
+                backend = backends.select_backend()
+
+        self.assertEqual(
+            (backend.name, backend.path),
+            ('xenbus', '/proc/xen/xenbus'),
+            'Did not fall back to /proc/xen/xenbus'
+        )
+
+    def test_select_backend_unix_socket(self):
+        with mock.patch(
+            'novaagent.xenstore.backends.os.path.exists',
+            side_effect=[False, False, True]
+        ):
+            with mock.patch('pyxs.client.Client'):
+                backend = backends.select_backend()
+
+        self.assertEqual(
+            backend.name,
+            'unix-socket',
+            'Did not fall back to the xenstored socket'
+        )
+
+    def test_select_backend_connect_failure(self):
+        with mock.patch(
+            'novaagent.xenstore.backends.os.path.exists'
+        ) as exists:
+            exists.return_value = True
+            with mock.patch('pyxs.client.Client') as client:
+                client.return_value.connect.side_effect = ConnectionError(
+                    'Test error'
+                )
+                backend = backends.select_backend()
+
+        self.assertEqual(
+            backend.name,
+            'subprocess',
+            'Did not fall back to the xenstore-* tools'
+        )
+
+    def test_get_backend(self):
+        memory = backends.MemoryBackend()
+        self.assertEqual(
+            (
+                backends.get_backend(memory),
+                backends.get_backend(None).name,
+                backends.get_backend(mock.Mock()).name
+            ),
+            (memory, 'subprocess', 'pyxs'),
+            'Clients were not mapped to the expected backends'
+        )
+
+    def test_memory_backend(self):
+        backend = backends.MemoryBackend()
+        backend.write(b'vm-data/networking/BC764E206C5B', b'{}')
+        backend.write(b'vm-data/hostname', b'test-server')
+        self.assertEqual(
+            (
+                backend.read(b'vm-data/hostname'),
+                backend.list(b'vm-data'),
+                backend.list(b'vm-data/networking')
+            ),
+            ('test-server', ['hostname', 'networking'], ['BC764E206C5B']),
+            'Memory backend did not return what was written'
+        )
+
+        backend.delete(b'vm-data/networking')
+        with self.assertRaises(PyXSError):
+            backend.read(b'vm-data/networking/BC764E206C5B')
+
+    def test_memory_backend_pipeline(self):
+        backend = backends.MemoryBackend({'vm-data/hostname': 'test-server'})
+        pipeline = backend.pipeline()
+        pipeline.read(b'vm-data/hostname')
+        pipeline.read(b'vm-data/missing')
+        hostname, missing = pipeline.execute()
+        self.assertEqual(
+            hostname,
+            'test-server',
+            'Pipeline did not return the value'
+        )
+        self.assertIsInstance(
+            missing,
+            PyXSError,
+            'Failed read was not returned as its error'
+        )
+
+    def test_memory_backend_watch(self):
+        backend = backends.MemoryBackend()
+        monitor = backend.watch(b'data/host', b'nova-agent')
+        self.assertEqual(
+            monitor.wait_event(0),
+            True,
+            'Watch did not fire when it was registered'
+        )
+        self.assertEqual(
+            monitor.wait_event(0),
+            False,
+            'Watch fired without a write'
+        )
+        backend.write(b'data/guest/1234', b'{}')
+        self.assertEqual(
+            monitor.wait_event(0),
+            False,
+            'Watch fired for a write outside the watched path'
+        )
+        backend.write(b'data/host/1234', b'{}')
+        self.assertEqual(
+            monitor.wait_event(0),
+            True,
+            'Watch did not fire for a write to the watched path'
+        )
+
+    def test_memory_backend_transaction_retry(self):
+        backend = backends.MemoryBackend({'data/host/1234': '{}'})
+        attempts = []
+
+        def answer(tx_backend):
+            attempts.append(tx_backend)
+            if len(attempts) == 1:
+                backend.write(b'data/host/5678', b'{}')
+
+            tx_backend.delete(b'data/host/1234')
+            tx_backend.write(b'data/guest/1234', b'{}')
+
+        with mock.patch('novaagent.xenstore.xenstore.time.sleep'):
+            xenstore.run_transaction(answer, backend)
+
+        self.assertEqual(
+            len(attempts),
+            2,
+            'Conflicting transaction was not retried'
+        )
+        self.assertEqual(
+            (backend.list(b'data/host'), backend.list(b'data/guest')),
+            (['5678'], ['1234']),
+            'Transaction was not committed'
+        )
+
+    def test_memory_backend_transaction_read_only(self):
+        backend = backends.MemoryBackend({'data/host/1234': '{}'})
+        monitor = backend.watch(b'data/host', b'nova-agent')
+        monitor.wait_event(0)
+        generation = backend.generation
+        with backend.transaction() as tx_backend:
+            tx_backend.read(b'data/host/1234')
+
+        self.assertEqual(
+            (monitor.wait_event(0), backend.generation),
+            (False, generation),
+            'Read only transaction fired a watch or counted as a write'
+        )
+        with backend.transaction() as tx_backend:
+            tx_backend.delete(b'data/host/1234')
+
+        self.assertEqual(
+            monitor.wait_event(0),
+            True,
+            'Transaction that wrote did not fire the watch'
+        )
+
+    def test_snapshot_memory_backend(self):
+        backend = backends.MemoryBackend()
+        backend.write(b'vm-data/hostname', b'test-server')
+        backend.write(b'vm-data/networking/BC764E206C5B', b'{}')
+        self.assertEqual(
+            xenstore.xenstore_snapshot(b'vm-data', backend),
+            {
+                'hostname': 'test-server',
+                'networking': '',
+                'networking/BC764E206C5B': '{}'
+            },
+            'Snapshot did not contain every value'
+        )
+
+    def test_connection_manager_lazy(self):
+        probe = mock.Mock(return_value=None)
+        with mock.patch.object(backends.XenBusBackend, 'probe', probe):
+            backends.ConnectionManager()
+            self.assertEqual(
+                probe.call_count,
+                0,
+                'Backends were probed before the connection was used'
+            )
+
+    def test_connection_manager_reconnect(self):
+        FlakyBackend.created = []
+        manager = backends.ConnectionManager((FlakyBackend,))
+        manager.write(b'data/host/1234', b'{}')
+        FlakyBackend.created[0].connected = False
+        monitor = manager.watch(b'data/host', b'nova-agent')
+        self.assertEqual(
+            len(FlakyBackend.created),
+            2,
+            'Lost connection was not replaced'
+        )
+        FlakyBackend.created[1].connected = False
+        self.assertEqual(
+            monitor.wait_event(0),
+            True,
+            'Watch did not report a possible missed event on reconnect'
+        )
+        self.assertEqual(
+            monitor.backend,
+            FlakyBackend.created[2],
+            'Watch was not registered again after reconnecting'
+        )
+
+    def test_connection_manager_pipeline_reconnect(self):
+        FlakyBackend.created = []
+        manager = backends.ConnectionManager((FlakyBackend,))
+        lost = manager.current()
+
+        def execute():
+            lost.connected = False
+            raise ConnectionError('Test error')
+
+        lost_pipeline = mock.Mock()
+        lost_pipeline.execute.side_effect = execute
+        with mock.patch.object(lost, 'pipeline', return_value=lost_pipeline):
+            pipeline = manager.pipeline()
+            pipeline.write(b'data/guest/1234', b'{}')
+            pipeline.read(b'data/guest/1234')
+            results = pipeline.execute()
+
+        self.assertEqual(
+            (len(FlakyBackend.created), results),
+            (2, [None, '{}']),
+            'Pipeline was not run again on a new connection'
+        )
+        lost_pipeline.write.assert_called_once_with(b'data/guest/1234', b'{}')
+
+    def test_connection_manager_backoff(self):
+        probe = mock.Mock(return_value=None)
+        with mock.patch.object(backends.XenBusBackend, 'probe', probe):
+            with mock.patch(
+                'novaagent.xenstore.backends.time.time'
+            ) as now:
+                now.return_value = 100
+                manager = backends.ConnectionManager(
+                    (backends.XenBusBackend, backends.SubprocessBackend)
+                )
+                for count in range(3):
+                    manager.current()
+
+                now.return_value = 101
+                manager.current()
+                now.return_value = 102
+                manager.current()
+
+        self.assertEqual(
+            (probe.call_count, manager.delay),
+            (2, 4),
+            'Backends were not probed again with backoff'
+        )